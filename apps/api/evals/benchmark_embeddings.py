@@ -0,0 +1,97 @@
+"""Compare the local fastembed query embeddings with the OpenAI baseline on the eval dataset.
+
+For each backend every question is embedded without the embedding cache, then searched
+dense-only and with the production hybrid query (dense + BM25, RRF). The report gives
+recall@k, MRR and NDCG@k per search mode and p50/p95 latency of embedding and search.
+The collection must have been ingested with --local-vector.
+"""
+
+import argparse
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import FusionQuery
+
+from evals.sweep_retriever import load_examples, ranking_metrics
+from src.server.agents.local_embeddings import get_local_embedder
+from src.server.agents.retrieval_generation import REMOTE_VECTOR, create_embeddings_batch, hybrid_prefetch
+from src.server.core.config import config
+
+
+def embed_remote(question: str) -> List[float]:
+    return create_embeddings_batch([question], batch_size=1)[0]
+
+
+def embed_local(question: str) -> List[float]:
+    return get_local_embedder().embed_queries([question])[0]
+
+
+def percentiles(timings: List[float]) -> Dict[str, float]:
+    p50, p95 = np.percentile(timings, [50, 95]) * 1000
+    return {"p50_ms": round(float(p50), 1), "p95_ms": round(float(p95), 1)}
+
+
+def benchmark_backend(qd_client: QdrantClient, examples: List[Dict[str, Any]], embed, vector_name: str,
+                      k: int) -> Dict[str, Any]:
+    embed_timings, search_timings = [], []
+    relevance = {"dense": np.zeros((len(examples), k)), "hybrid": np.zeros((len(examples), k))}
+
+    for i, example in enumerate(examples):
+        question = example["question"]
+        start = time.perf_counter()
+        embedding = embed(question)
+        embed_timings.append(time.perf_counter() - start)
+
+        searches = {
+            "dense": {"query": embedding, "using": vector_name},
+            "hybrid": {"prefetch": hybrid_prefetch(embedding, question, using=vector_name),
+                       "query": FusionQuery(fusion="rrf")},
+        }
+        relevant = set(example["relevant_ids"])
+        for mode, search in searches.items():
+            start = time.perf_counter()
+            response = qd_client.query_points(collection_name=config.collection_name, limit=k,
+                                              with_payload=["parent_asin"], **search)
+            if mode == "hybrid":
+                search_timings.append(time.perf_counter() - start)
+            ranked = [point.payload["parent_asin"] for point in response.points]
+            relevance[mode][i, :len(ranked)] = [doc_id in relevant for doc_id in ranked]
+
+    n_relevant = np.array([len(example["relevant_ids"]) for example in examples])
+    return {
+        "embedding": percentiles(embed_timings),
+        "hybrid_search": percentiles(search_timings),
+        "end_to_end": percentiles([e + s for e, s in zip(embed_timings, search_timings)]),
+        **{mode: ranking_metrics(matrix, n_relevant, k) for mode, matrix in relevance.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default="rag-evaluation-dataset")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    examples = load_examples(args.dataset)
+    qd_client = QdrantClient(url=config.qdrant_url)
+    local_embedder = get_local_embedder()  # load the ONNX model before timing
+    backends = {
+        f"openai:{REMOTE_VECTOR}": (embed_remote, REMOTE_VECTOR),
+        f"local:{local_embedder.model_name}": (embed_local, local_embedder.vector_name),
+    }
+
+    print(f"{'backend':>40} {'mode':>6} {'recall':>7} {'mrr':>7} {'ndcg':>7} "
+          f"{'embed p50/p95 ms':>18} {'total p50/p95 ms':>18}")
+    for name, (embed, vector_name) in backends.items():
+        report = benchmark_backend(qd_client, examples, embed, vector_name, args.k)
+        for mode in ("dense", "hybrid"):
+            quality = report[mode]
+            print(f"{name:>40} {mode:>6} {quality['recall']:>7.3f} {quality['mrr']:>7.3f} {quality['ndcg']:>7.3f} "
+                  f"{report['embedding']['p50_ms']:>8}/{report['embedding']['p95_ms']:<9} "
+                  f"{report['end_to_end']['p50_ms']:>8}/{report['end_to_end']['p95_ms']:<9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Measure the per-request cost of LangSmith tracing with tracing off, sampled and on.
+
+A synthetic request runs the span tree of the RAG pipeline (rewrite, embed, retrieve, dedup,
+rerank, prompt, generate) over realistic payloads: 50 retrieved products of ~800 chars and a
+prompt built from them. No upstream is called, so the timings are the tracing overhead plus
+a fixed amount of busy work per span. Exports go to a stub LangSmith endpoint that answers
+after --export-latency-ms, the way a remote one would, on the client's background thread.
+
+The report gives mean/p50/p95 request latency per mode, the overhead over tracing off, and how
+long the final flush of the queued spans took. "on (uncapped)" uses a plain client without
+the payload caps, for comparison.
+"""
+
+import argparse
+import json
+import random
+import time
+from array import array
+from typing import Any, Dict, List
+
+import langsmith
+import numpy as np
+import requests
+from langsmith import Client, traceable
+from langsmith.schemas import LangSmithInfo
+
+# the same modules the tracing layer imports, so the sample rates set here and the
+# RetrievalResult type it caps are the ones it sees
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.utils.tracing import make_tracing_client, request_tracing
+from server.core.config import config
+
+
+class StubExportAdapter(requests.adapters.BaseAdapter):
+    """Answers every LangSmith API call with 200 after `latency` seconds."""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.batches = 0
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        self.batches += 1
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b"{}"
+        response.headers["Content-Type"] = "application/json"
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def stub_client(adapter: StubExportAdapter, capped: bool) -> Client:
+    session = requests.Session()
+    # a longer prefix than the client's own "http://" adapter, so it takes precedence
+    session.mount("http://langsmith.stub", adapter)
+    kwargs = {"api_url": "http://langsmith.stub", "api_key": "benchmark", "session": session, "info": LangSmithInfo()}
+    return make_tracing_client(**kwargs) if capped else Client(auto_batch_tracing=True, **kwargs)
+
+
+def busy(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def make_products(n: int, description_chars: int) -> RetrievalResult:
+    words = "wireless noise cancelling headphones with long battery life and a comfortable fit".split()
+    descriptions = [" ".join(random.choices(words, k=description_chars // 7)) for _ in range(n)]
+    return RetrievalResult(ids=[f"B{i:09d}" for i in range(n)], descriptions=descriptions,
+                           ratings=[round(random.uniform(3, 5), 1) for _ in range(n)],
+                           prices=[round(random.uniform(10, 300), 2) for _ in range(n)],
+                           images=[None] * n, scores=array("d", (random.random() for _ in range(n))))
+
+
+def build_pipeline(products: RetrievalResult, work: float):
+    @traceable(name="query_rewriter_node", run_type="prompt")
+    def rewrite(question: str) -> Dict[str, Any]:
+        busy(work)
+        return {"queries": [question, question + " under 100 dollars"]}
+
+    @traceable(name="generate_embeddings", run_type="embedding")
+    def embed(query: str) -> List[float]:
+        busy(work)
+        return [random.random() for _ in range(1536)]
+
+    @traceable(name="retrieve_embedding_data", run_type="retriever")
+    def retrieve(query: str, embedding: List[float]) -> RetrievalResult:
+        busy(work)
+        return products
+
+    @traceable(name="dedup_retrieved_context", run_type="retriever")
+    def dedup(retrieved_context: RetrievalResult) -> RetrievalResult:
+        busy(work)
+        return retrieved_context.head(30)
+
+    @traceable(name="rerank_retrieved_context", run_type="embedding")
+    def rerank(query: str, retrieved_context: RetrievalResult) -> RetrievalResult:
+        busy(work)
+        return retrieved_context.head(5)
+
+    @traceable(name="build_prompt", run_type="prompt")
+    def build_prompt(preprocessed_context: str, question: str) -> str:
+        busy(work)
+        return f"Answer the question from the products below.\n{preprocessed_context}\nQuestion: {question}"
+
+    @traceable(name="generate_answer", run_type="llm")
+    def generate(prompt: str) -> Dict[str, Any]:
+        busy(work)
+        return {"answer": "These headphones fit the request. " * 20, "references": products.context_ids[:5]}
+
+    @traceable(name="rag_pipeline")
+    def pipeline(question: str) -> Dict[str, Any]:
+        queries = rewrite(question)["queries"]
+        context = None
+        for query in queries:
+            context = rerank(query, dedup(retrieve(query, embed(query))))
+        preprocessed_context = "\n".join(f"- {product_id}: {description}" for product_id, description, _ in context.rows())
+        return generate(build_prompt(preprocessed_context, question))
+
+    return pipeline
+
+
+def run_mode(pipeline, requests_count: int, mode: str, client: Client, sample: float) -> Dict[str, Any]:
+    config.trace_sample_rates["interactive"] = sample
+    timings = []
+    with langsmith.tracing_context(enabled=mode != "off"):
+        for i in range(requests_count):
+            start = time.perf_counter()
+            with request_tracing("/product_assistant/rag", "interactive", client=client):
+                pipeline(f"noise cancelling headphones #{i}")
+            timings.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    client.flush()
+    flush = time.perf_counter() - start
+    p50, p95 = np.percentile(timings, [50, 95]) * 1000
+    return {"mean_ms": round(float(np.mean(timings)) * 1000, 2), "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2), "flush_ms": round(flush * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--sample-rate", type=float, default=0.1)
+    parser.add_argument("--span-work-ms", type=float, default=0.5, help="busy work in each span")
+    parser.add_argument("--export-latency-ms", type=float, default=50.0)
+    parser.add_argument("--products", type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    pipeline = build_pipeline(make_products(args.products, 800), args.span_work_ms / 1000)
+    modes = {
+        "off": (True, 0.0),
+        f"sampled ({args.sample_rate:g})": (True, args.sample_rate),
+        "on": (True, 1.0),
+        "on (uncapped)": (False, 1.0),
+    }
+    report = {}
+    for mode, (capped, sample) in modes.items():
+        adapter = StubExportAdapter(args.export_latency_ms / 1000)
+        client = stub_client(adapter, capped)
+        # one untimed round so imports and the client's background thread are warm
+        run_mode(pipeline, 5, mode, client, sample)
+        report[mode] = {**run_mode(pipeline, args.requests, mode, client, sample), "export_calls": adapter.batches}
+
+    for result in report.values():
+        # with sampling the p50 request is usually an untraced one, the mean shows the cost
+        result["overhead_mean_ms"] = round(result["mean_ms"] - report["off"]["mean_ms"], 2)
+        result["overhead_p95_ms"] = round(result["p95_ms"] - report["off"]["p95_ms"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Small on-disk JSON cache shared by the evaluation scripts."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Optional
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(__file__), ".cache", "eval_cache.sqlite")
+
+
+def stable_hash(*parts: Any) -> str:
+    """Hashes JSON-serializable parts into a short, order-sensitive key."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class EvalCache:
+    """Key/value store (JSON values) in a SQLite file, split into namespaces."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.environ.get("EVAL_CACHE_PATH", DEFAULT_CACHE_PATH)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value, default=str)),
+            )
+            self._conn.commit()
@@ -0,0 +1,257 @@
+"""Sweep retrieval parameters offline on the LangSmith eval dataset and report quality vs latency.
+
+Query embeddings, the dense/BM25 candidate lists and reranker scores are fetched once and
+cached (see eval_cache.py). Fusion, truncation and reranking are then replayed locally for
+every configuration of the grid, and recall@k, MRR and NDCG@k are computed with NumPy.
+"""
+
+import argparse
+import itertools
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from langsmith import Client
+from qdrant_client import QdrantClient
+from qdrant_client.models import Document, FusionQuery, Prefetch
+
+from evals.eval_cache import EvalCache, stable_hash
+from src.server.agents.reranker import CohereReranker, FlashRankReranker
+from src.server.agents.retrieval_generation import create_embeddings_batch
+from src.server.core.config import config
+# the pipeline modules import server.*, so the priority must be set through that same module
+from server.agents.utils.priority import priority_scope
+
+COLLECTION_NAME = config.collection_name
+RRF_K = 2  # Qdrant's server-side RRF constant
+
+PREFETCH_LIMITS = [10, 20, 40]
+FUSIONS = ["rrf", "dbsf"]
+K_VALUES = [5, 10]
+RERANKERS = ["none", "cohere:rerank-v4.0-fast", "cohere:rerank-v3.5", "flashrank"]
+
+cache = EvalCache()
+
+
+def load_examples(dataset_name: str) -> List[Dict[str, Any]]:
+    client = Client()
+    return [
+        {"question": example.inputs["question"],
+         "relevant_ids": list(example.outputs.get("reference_chunks", []))}
+        for example in client.list_examples(dataset_name=dataset_name)
+    ]
+
+
+def fetch_candidates(qd_client: QdrantClient, questions: List[str], max_limit: int) -> List[Dict[str, Any]]:
+    """Dense and BM25 candidate lists (ids, scores, texts) per question, cached."""
+    keys = [stable_hash("candidates", COLLECTION_NAME, question, max_limit) for question in questions]
+    candidates = [cache.get("sweep_candidates", key) for key in keys]
+    missing = [i for i, candidate in enumerate(candidates) if candidate is None]
+    if not missing:
+        return candidates
+
+    embeddings = create_embeddings_batch([questions[i] for i in missing])
+    for i, embedding in zip(missing, embeddings):
+        branches = {}
+        for branch, query, using in [
+            ("dense", embedding, "text-embedding-3-small"),
+            ("bm25", Document(text=questions[i], model="qdrant/bm25"), "bm25"),
+        ]:
+            response = qd_client.query_points(
+                collection_name=COLLECTION_NAME,
+                query=query,
+                using=using,
+                limit=max_limit,
+                with_payload=["parent_asin", "description"],
+            )
+            branches[branch] = {
+                "ids": [point.payload["parent_asin"] for point in response.points],
+                "scores": [point.score for point in response.points],
+                "texts": [point.payload["description"] for point in response.points],
+            }
+        candidates[i] = branches
+        cache.set("sweep_candidates", keys[i], branches)
+    return candidates
+
+
+def _normalize_dbsf(scores: np.ndarray) -> np.ndarray:
+    if len(scores) == 0:
+        return scores
+    mean, std = scores.mean(), scores.std()
+    low, high = mean - 3 * std, mean + 3 * std
+    if high == low:
+        return np.full_like(scores, 0.5)
+    return np.clip((scores - low) / (high - low), 0.0, 1.0)
+
+
+def fuse(branches: Dict[str, Any], limit: int, fusion: str) -> Tuple[List[str], Dict[str, str]]:
+    """Replays the server-side prefetch + fusion for one question, returns ids by fused score."""
+    fused: Dict[str, float] = {}
+    texts: Dict[str, str] = {}
+    for branch in branches.values():
+        ids = branch["ids"][:limit]
+        if fusion == "rrf":
+            contributions = 1.0 / (np.arange(len(ids)) + RRF_K)
+        else:
+            contributions = _normalize_dbsf(np.asarray(branch["scores"][:limit], dtype=float))
+        for doc_id, text, contribution in zip(ids, branch["texts"], contributions):
+            fused[doc_id] = fused.get(doc_id, 0.0) + float(contribution)
+            texts[doc_id] = text
+    return sorted(fused, key=fused.get, reverse=True), texts
+
+
+def get_reranker(name: str):
+    if name.startswith("cohere:"):
+        return CohereReranker(model=name.split(":", 1)[1])
+    if name == "flashrank":
+        return FlashRankReranker()
+    raise ValueError(f"Unknown reranker: {name}")
+
+
+def rerank_scores(reranker_name: str, question: str, texts: Dict[str, str]) -> Dict[str, float]:
+    """Relevance score of every candidate of a question for one reranker, cached.
+
+    Rerank scores are per (query, document) pair, so scoring the union of all candidates once
+    is enough to replay any candidate subset.
+    """
+    key = stable_hash("rerank", reranker_name, question, sorted(texts))
+    scores = cache.get("sweep_rerank", key)
+    if scores is None:
+        ids = list(texts)
+        results = get_reranker(reranker_name).rerank(question, [texts[i] for i in ids], top_n=len(ids))
+        scores = {ids[result["index"]]: float(result["score"]) for result in results}
+        cache.set("sweep_rerank", key, scores)
+    return scores
+
+
+def ranking_metrics(relevance: np.ndarray, n_relevant: np.ndarray, k: int) -> Dict[str, float]:
+    """recall@k, MRR and NDCG@k over a (questions x k) 0/1 relevance matrix."""
+    rel = relevance[:, :k]
+    recall = rel.sum(axis=1) / np.maximum(n_relevant, 1)
+    first_hit = np.where(rel.any(axis=1), rel.argmax(axis=1) + 1, np.inf)
+    mrr = 1.0 / first_hit
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    dcg = (rel * discounts).sum(axis=1)
+    ideal = np.array([discounts[:min(int(n), k)].sum() for n in n_relevant])
+    ndcg = np.divide(dcg, ideal, out=np.zeros_like(dcg), where=ideal > 0)
+    return {"recall": float(recall.mean()), "mrr": float(mrr.mean()), "ndcg": float(ndcg.mean())}
+
+
+def measure_latencies(qd_client: QdrantClient, questions: List[str], candidates: List[Dict[str, Any]],
+                      rerankers: List[str]) -> Dict[str, Any]:
+    """Median wall time of each stage on a sample of questions, used for the latency model."""
+    latencies: Dict[str, Any] = {"search": {}, "rerank": {}}
+
+    start = time.perf_counter()
+    embeddings = create_embeddings_batch(questions, batch_size=1)
+    latencies["embedding"] = (time.perf_counter() - start) / len(questions)
+
+    for limit, fusion in itertools.product(PREFETCH_LIMITS, FUSIONS):
+        timings = []
+        for question, embedding in zip(questions, embeddings):
+            start = time.perf_counter()
+            qd_client.query_points(
+                collection_name=COLLECTION_NAME,
+                prefetch=[Prefetch(query=embedding, using="text-embedding-3-small", limit=limit),
+                          Prefetch(query=Document(text=question, model="qdrant/bm25"), using="bm25", limit=limit)],
+                query=FusionQuery(fusion=fusion),
+                limit=max(K_VALUES),
+            )
+            timings.append(time.perf_counter() - start)
+        latencies["search"][f"{limit}:{fusion}"] = float(np.median(timings))
+
+    for reranker_name in rerankers:
+        if reranker_name == "none":
+            continue
+        reranker = get_reranker(reranker_name)
+        for k in K_VALUES:
+            timings = []
+            for question, branches in zip(questions, candidates):
+                documents = branches["dense"]["texts"][:k]
+                start = time.perf_counter()
+                reranker.rerank(question, documents, top_n=min(5, k))
+                timings.append(time.perf_counter() - start)
+            latencies["rerank"][f"{reranker_name}:{k}"] = float(np.median(timings))
+    return latencies
+
+
+def pareto_frontier(rows: List[Dict[str, Any]], metric: str) -> List[Dict[str, Any]]:
+    """Configurations not beaten on both `metric` (higher) and latency (lower)."""
+    frontier, best = [], -np.inf
+    for row in sorted(rows, key=lambda r: (r["latency_ms"], -r[metric])):
+        if row[metric] > best:
+            frontier.append(row)
+            best = row[metric]
+    return frontier
+
+
+def run_sweep(dataset_name: str, rerankers: List[str], latency_sample: int) -> List[Dict[str, Any]]:
+    examples = load_examples(dataset_name)
+    questions = [example["question"] for example in examples]
+    qd_client = QdrantClient(url=config.qdrant_url)
+
+    candidates = fetch_candidates(qd_client, questions, max(PREFETCH_LIMITS))
+    latencies = measure_latencies(qd_client, questions[:latency_sample], candidates[:latency_sample], rerankers)
+    # every candidate any configuration can see, so each reranker scores a question only once
+    all_texts = [fuse(branches, max(PREFETCH_LIMITS), "rrf")[1] for branches in candidates]
+    n_relevant = np.array([len(example["relevant_ids"]) for example in examples])
+    k_max = max(K_VALUES)
+
+    rows = []
+    for limit, fusion, reranker_name in itertools.product(PREFETCH_LIMITS, FUSIONS, rerankers):
+        for k in K_VALUES:
+            relevance = np.zeros((len(examples), k_max))
+            for i, (example, branches) in enumerate(zip(examples, candidates)):
+                fused_ids, _ = fuse(branches, limit, fusion)
+                ranked = fused_ids[:k]
+                if reranker_name != "none":
+                    scores = rerank_scores(reranker_name, example["question"], all_texts[i])
+                    ranked = sorted(ranked, key=lambda doc_id: scores.get(doc_id, 0.0), reverse=True)
+                relevant = set(example["relevant_ids"])
+                relevance[i, :len(ranked)] = [doc_id in relevant for doc_id in ranked]
+
+            latency = latencies["embedding"] + latencies["search"][f"{limit}:{fusion}"]
+            latency += latencies["rerank"].get(f"{reranker_name}:{k}", 0.0)
+            rows.append({
+                "prefetch_limit": limit,
+                "fusion": fusion,
+                "k": k,
+                "reranker": reranker_name,
+                "latency_ms": round(latency * 1000, 1),
+                **ranking_metrics(relevance, n_relevant, k),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dataset", default="rag-evaluation-dataset")
+    parser.add_argument("--rerankers", nargs="+", default=RERANKERS)
+    parser.add_argument("--metric", choices=["recall", "mrr", "ndcg"], default="ndcg")
+    parser.add_argument("--min-quality", type=float, default=None,
+                        help="pick the fastest configuration with at least this value of --metric")
+    parser.add_argument("--latency-sample", type=int, default=10,
+                        help="number of questions timed per stage for the latency model")
+    args = parser.parse_args()
+
+    rows = run_sweep(args.dataset, args.rerankers, args.latency_sample)
+
+    header = f"{'prefetch':>8} {'fusion':>6} {'k':>3} {'reranker':>24} {'latency_ms':>10} {'recall':>7} {'mrr':>7} {'ndcg':>7}"
+    print("Pareto frontier on", args.metric)
+    print(header)
+    for row in pareto_frontier(rows, args.metric):
+        print(f"{row['prefetch_limit']:>8} {row['fusion']:>6} {row['k']:>3} {row['reranker']:>24} "
+              f"{row['latency_ms']:>10} {row['recall']:>7.3f} {row['mrr']:>7.3f} {row['ndcg']:>7.3f}")
+
+    if args.min_quality is not None:
+        passing = [row for row in rows if row[args.metric] >= args.min_quality]
+        if passing:
+            print("Fastest configuration meeting the bar:", min(passing, key=lambda row: row["latency_ms"]))
+        else:
+            print(f"No configuration reaches {args.metric} >= {args.min_quality}")
+    print(f"Cache hits: {cache.hits}, misses: {cache.misses}")
+
+
+if __name__ == "__main__":
+    with priority_scope("eval"):
+        main()
@@ -0,0 +1,83 @@
+"""Cassette files: recorded upstream request/response pairs, one JSON object per line."""
+
+import hashlib
+import itertools
+import json
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+# headers that describe the original transfer and must not be replayed as-is
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "content-encoding", "content-length",
+    "date", "server", "set-cookie", "alt-svc",
+}
+
+
+def request_key(method: str, path: str, body: bytes) -> str:
+    """Identifies a request by method, path and its JSON body with keys sorted."""
+    try:
+        normalized = json.dumps(json.loads(body), sort_keys=True) if body else ""
+    except (ValueError, UnicodeDecodeError):
+        normalized = body.decode("latin-1")
+    digest = hashlib.sha256(f"{method.upper()} {path}\n{normalized}".encode("utf-8")).hexdigest()
+    return digest[:32]
+
+
+class Cassette:
+    """
+    Recorded interactions of one upstream.
+
+    Lookups match on the exact request first. Unmatched requests fall back to the recorded
+    responses of the same method and path in round-robin, so a replay can serve query traffic
+    that was never recorded verbatim (e.g. new questions against the embeddings endpoint).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._by_key: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._by_route: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._cycles: Dict[str, Any] = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    if line.strip():
+                        self._index(json.loads(line))
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._by_key.values())
+
+    def _index(self, entry: Dict[str, Any]) -> None:
+        self._by_key[entry["key"]].append(entry)
+        self._by_route[f"{entry['method']} {entry['path']}"].append(entry)
+
+    def record(self, method: str, path: str, body: bytes, status: int, headers: Dict[str, str],
+               response_body: bytes, latency_ms: float) -> None:
+        entry = {
+            "key": request_key(method, path, body),
+            "method": method.upper(),
+            "path": path,
+            "status": status,
+            "headers": {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS},
+            "body": response_body.decode("utf-8", errors="replace"),
+            "latency_ms": latency_ms,
+        }
+        with self._lock:
+            self._index(entry)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+
+    def lookup(self, method: str, path: str, body: bytes) -> Optional[Dict[str, Any]]:
+        key = request_key(method, path, body)
+        route = f"{method.upper()} {path}"
+        with self._lock:
+            entries = self._by_key.get(key) or self._by_route.get(route)
+            if not entries:
+                return None
+            cycle_key = key if key in self._by_key else route
+            if cycle_key not in self._cycles:
+                self._cycles[cycle_key] = itertools.cycle(entries)
+            return next(self._cycles[cycle_key])
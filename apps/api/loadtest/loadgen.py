@@ -0,0 +1,145 @@
+"""Open-loop async load generator for the /product_assistant endpoint.
+
+Queries are read from a JSONL file (one object per line with a "query" or "question" field, e.g.
+the request log written by the API) and sent at a target rate regardless of how fast the server
+answers, so queueing shows up as latency instead of being hidden by a closed loop.
+The report covers throughput, latency percentiles, error rates, the generator's own event-loop
+lag and the server's event-loop lag (from /metrics).
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+
+def load_queries(path: str) -> List[str]:
+    queries = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            query = record.get("query") or record.get("question")
+            if query:
+                queries.append(query)
+    if not queries:
+        raise ValueError(f"No queries found in {path}")
+    return queries
+
+
+async def scrape_loop_lag(client: httpx.AsyncClient, metrics_url: str) -> Optional[Dict[str, float]]:
+    try:
+        response = await client.get(metrics_url)
+    except httpx.HTTPError:
+        return None
+    values = {}
+    for line in response.text.splitlines():
+        name, _, value = line.partition(" ")
+        if name in ("event_loop_lag_seconds_count", "event_loop_lag_seconds_sum"):
+            values[name] = float(value)
+    return values or None
+
+
+async def monitor_own_lag(samples: List[float], interval: float = 0.05) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def run_load(url: str, queries: List[str], rps: float, duration: float, timeout: float,
+                   arrival: str, max_in_flight: int) -> Dict:
+    latencies: List[float] = []
+    outcomes: Counter = Counter()
+    own_lag: List[float] = []
+    in_flight = asyncio.Semaphore(max_in_flight)
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    metrics_url = url.split("/product_assistant")[0] + "/metrics"
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+
+        async def one_request(query: str) -> None:
+            if in_flight.locked():
+                # the client itself is saturated, count it rather than silently lowering the rate
+                outcomes["dropped_client_saturated"] += 1
+                return
+            async with in_flight:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json={"query": query, "thread_id": str(uuid.uuid4())})
+                    outcomes[str(response.status_code)] += 1
+                    if response.status_code == 200:
+                        latencies.append(time.perf_counter() - start)
+                except httpx.TimeoutException:
+                    outcomes["timeout"] += 1
+                except httpx.HTTPError as e:
+                    outcomes[type(e).__name__] += 1
+
+        server_lag_before = await scrape_loop_lag(client, metrics_url)
+        lag_monitor = asyncio.create_task(monitor_own_lag(own_lag))
+        tasks = []
+        start = time.perf_counter()
+        next_send = start
+        for query in itertools.cycle(queries):
+            if next_send - start >= duration:
+                break
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            tasks.append(asyncio.create_task(one_request(query)))
+            next_send += random.expovariate(rps) if arrival == "poisson" else 1.0 / rps
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        lag_monitor.cancel()
+        server_lag_after = await scrape_loop_lag(client, metrics_url)
+
+    report = {
+        "target_rps": rps,
+        "sent": len(tasks),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "outcomes": dict(outcomes),
+        "error_rate": round(1 - len(latencies) / max(len(tasks), 1), 4),
+    }
+    if latencies:
+        p50, p90, p95, p99 = np.percentile(latencies, [50, 90, 95, 99]) * 1000
+        report["latency_ms"] = {"p50": round(p50, 1), "p90": round(p90, 1), "p95": round(p95, 1),
+                                "p99": round(p99, 1), "max": round(max(latencies) * 1000, 1)}
+    if own_lag:
+        report["client_loop_lag_ms"] = {"p99": round(float(np.percentile(own_lag, 99)) * 1000, 2),
+                                        "max": round(max(own_lag) * 1000, 2)}
+    if server_lag_before and server_lag_after:
+        count = server_lag_after["event_loop_lag_seconds_count"] - server_lag_before["event_loop_lag_seconds_count"]
+        total = server_lag_after["event_loop_lag_seconds_sum"] - server_lag_before["event_loop_lag_seconds_sum"]
+        report["server_loop_lag_ms_mean"] = round(total / count * 1000, 2) if count else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000/product_assistant/")
+    parser.add_argument("--queries", default="requests.jsonl")
+    parser.add_argument("--rps", type=float, nargs="+", default=[1.0],
+                        help="one or more target rates; several values step the load to find saturation")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per step")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    for rps in args.rps:
+        report = asyncio.run(run_load(args.url, queries, rps, args.duration, args.timeout,
+                                      args.arrival, args.max_in_flight))
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
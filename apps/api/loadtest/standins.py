@@ -0,0 +1,138 @@
+"""Record real upstream traffic into cassettes, or serve cassettes from local stand-in servers.
+
+Each upstream (OpenAI, Cohere, Qdrant) gets its own port. Point the API at the stand-ins with:
+
+    OPENAI_BASE_URL=http://localhost:9001/v1
+    CO_API_URL=http://localhost:9002
+    QDRANT_URL=http://localhost:9003
+
+In record mode requests are forwarded to the real upstream and every response is appended to
+`<cassette-dir>/<upstream>.jsonl`. In replay mode no request leaves the host: responses come
+from the cassette after a delay drawn from the configured latency distribution.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from loadtest.cassettes import Cassette
+
+UPSTREAMS = {
+    "openai": {"port": 9001, "target": "https://api.openai.com"},
+    "cohere": {"port": 9002, "target": "https://api.cohere.com"},
+    "qdrant": {"port": 9003, "target": "http://localhost:6333"},
+}
+
+
+class LatencyDistribution:
+    """
+    Latency model for replayed responses, parsed from "<kind>:<params>" in milliseconds:
+    "recorded" (the latency seen while recording), "fixed:50", "uniform:20,80",
+    "normal:100,20" or "lognormal:100,0.5" (median, sigma).
+    """
+
+    def __init__(self, spec: str = "recorded"):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")] if params else []
+        if kind not in {"recorded", "fixed", "uniform", "normal", "lognormal"}:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, recorded_ms: float) -> float:
+        """Returns a delay in seconds."""
+        if self.kind == "recorded":
+            delay = recorded_ms
+        elif self.kind == "fixed":
+            delay = self.params[0]
+        elif self.kind == "uniform":
+            delay = random.uniform(self.params[0], self.params[1])
+        elif self.kind == "normal":
+            delay = random.gauss(self.params[0], self.params[1])
+        else:
+            delay = random.lognormvariate(0, self.params[1]) * self.params[0]
+        return max(0.0, delay) / 1000
+
+
+def build_app(upstream: str, mode: str, cassette: Cassette, target: Optional[str] = None,
+              latency: Optional[LatencyDistribution] = None) -> Starlette:
+    client = httpx.AsyncClient(base_url=target, timeout=120) if mode == "record" else None
+    latency = latency or LatencyDistribution()
+
+    async def record(request: Request) -> Response:
+        body = await request.body()
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in {"host", "content-length"}}
+        start = time.perf_counter()
+        upstream_response = await client.request(
+            request.method, request.url.path, params=request.query_params, content=body, headers=headers
+        )
+        latency_ms = (time.perf_counter() - start) * 1000
+        cassette.record(request.method, request.url.path, body, upstream_response.status_code,
+                        dict(upstream_response.headers), upstream_response.content, latency_ms)
+        return Response(upstream_response.content, status_code=upstream_response.status_code,
+                        media_type=upstream_response.headers.get("content-type"))
+
+    async def replay(request: Request) -> Response:
+        body = await request.body()
+        entry = cassette.lookup(request.method, request.url.path, body)
+        if entry is None:
+            return JSONResponse({"error": f"no {upstream} recording for {request.method} {request.url.path}"},
+                                status_code=404)
+        await asyncio.sleep(latency.sample(entry["latency_ms"]))
+        return Response(entry["body"], status_code=entry["status"], headers=entry["headers"])
+
+    handler = record if mode == "record" else replay
+    routes = [Route("/{path:path}", handler, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])]
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        if client is not None:
+            await client.aclose()
+
+    return Starlette(routes=routes, lifespan=lifespan)
+
+
+async def serve(mode: str, cassette_dir: str, upstreams: Dict[str, Dict], latencies: Dict[str, str]) -> None:
+    servers = []
+    for upstream, settings in upstreams.items():
+        cassette = Cassette(f"{cassette_dir}/{upstream}.jsonl")
+        if mode == "replay":
+            print(f"{upstream}: replaying {len(cassette)} recordings on port {settings['port']}")
+        else:
+            print(f"{upstream}: recording {settings['target']} on port {settings['port']}")
+        app = build_app(upstream, mode, cassette, target=settings["target"],
+                        latency=LatencyDistribution(latencies.get(upstream, "recorded")))
+        servers.append(uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=settings["port"], log_level="warning")))
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--cassette-dir", default="loadtest/cassettes")
+    parser.add_argument("--upstreams", nargs="+", choices=list(UPSTREAMS), default=list(UPSTREAMS))
+    parser.add_argument("--qdrant-target", default=UPSTREAMS["qdrant"]["target"],
+                        help="real Qdrant to record from")
+    parser.add_argument("--latency", action="append", default=[], metavar="UPSTREAM=SPEC",
+                        help='replay latency per upstream, e.g. openai=lognormal:400,0.5 (default "recorded")')
+    args = parser.parse_args()
+
+    upstreams = {name: dict(UPSTREAMS[name]) for name in args.upstreams}
+    if "qdrant" in upstreams:
+        upstreams["qdrant"]["target"] = args.qdrant_target
+    latencies = dict(spec.split("=", 1) for spec in args.latency)
+    asyncio.run(serve(args.mode, args.cassette_dir, upstreams, latencies))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 from server.agents.tools import retrieve_embedding
 from server.agents.models import QueryRewriteResponse, QueryRelevanceResponse
-from server.agents.utils.prompt_management import get_prompt_from_config
+from server.agents.utils.prompt_management import get_prompt_from_config, render_messages
+from server.agents.utils.structured_output import structured_completion
+from server.agents.tool_results import compact_history
+from server.agents.working_set import fresh_tool_refs, update_working_set
+from server.core.config import config
 from langchain_core.messages import ToolMessage
 from server.agents.models import State
-import instructor
-from openai import OpenAI
 from langchain_openai import ChatOpenAI
 from langsmith import traceable
 from server.agents.utils.utils import format_ai_message
@@ -19,18 +21,16 @@ def query_rewriter_node(state: State) -> str:
     """
     This function rewrites the query to be more specific to include multiple statements
     """
-    template = get_prompt_from_config('/app/apps/api/src/server/agents/prompts/query_expand_agent.yml', 
-                                      'query_expand_agent')
+    messages = render_messages('/app/apps/api/src/server/agents/prompts/query_expand_agent.yml',
+                               'query_expand_agent', query=state.messages[-1].content)
     
-    prompt = template.render(query=state.messages[-1].content)
-    
-    client = instructor.from_openai(OpenAI())
-    
-    response, raw_response = client.chat.completions.create_with_completion(
+    response, _ = structured_completion(
+        QueryRewriteResponse,
+        messages,
         model="gpt-4o-mini",
-        response_model=QueryRewriteResponse,
-        messages=[{"role": "system", "content": prompt}],
-        temperature=0.4
+        node="query_rewriter_node",
+        temperature=0.4,
+        prompt_cache_key="query_expand_agent"
     )
     return {
         "expanded_queries": response.search_queries
@@ -42,17 +42,17 @@ def router_node(state: State) -> State:
     This function evaluates the user query and decides the next node to execute
     """
     
-    template = get_prompt_from_config('/app/apps/api/src/server/agents/prompts/router_agent.yml', 'router_agent')
-    
-    prompt = template.render(question=state.messages[-1].content)
+    messages = render_messages('/app/apps/api/src/server/agents/prompts/router_agent.yml', 'router_agent',
+                               question=state.messages[-1].content)
     
-    client = instructor.from_openai(OpenAI())
-    
-    response, raw_response = client.chat.completions.create_with_completion(
+    response, _ = structured_completion(
+        QueryRelevanceResponse,
+        messages,
         model="gpt-4o-mini",
-        response_model=QueryRelevanceResponse,
-        messages=[{"role": "system", "content": prompt}],
-        temperature=0.4
+        node="router_node",
+        report_run=False,
+        temperature=0.4,
+        prompt_cache_key="router_agent"
     )
     
     return {
@@ -116,23 +116,29 @@ def agent_node(state: State) -> State:
     
     prompt = template.render(available_tools=state.available_tools)
 
-    messages = sanitize_history(state.messages)
+    # tool results the agent already answered are re-sent as one line per product
+    messages = compact_history(sanitize_history(state.messages))
 
     conversation = []
 
     for message in messages:
         conversation.append(convert_to_openai_messages(message))
         
-    client = instructor.from_openai(OpenAI())
-
-    response, raw_response = client.chat.completions.create_with_completion(
+    response, _ = structured_completion(
+        AgentResponse,
+        [{"role": "system", "content": prompt}, *conversation],
         model="gpt-4.1-mini",
-        response_model=AgentResponse,
-        messages=[{"role": "system", "content": prompt}, *conversation],
+        node="agent_node",
         temperature=0.5,
+        # same static prompt and tools for every thread, the history only extends it
+        prompt_cache_key="search_agent",
     )
     
     ai_message = format_ai_message(response)
+    
+    # the products the agent just read become the most recent ones of the thread's working set
+    working_set = update_working_set(state.working_set, fresh_tool_refs(state.messages),
+                                     config.working_set_max_items)
 
     return {
         "messages": [ai_message],
@@ -140,6 +146,7 @@ def agent_node(state: State) -> State:
         "iteration": state.iteration + 1,
         "answer": response.answer,
         "final_answer": response.final_answer,
-        "references": response.references
+        "references": response.references,
+        "working_set": working_set
     }
 
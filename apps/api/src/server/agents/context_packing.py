@@ -0,0 +1,142 @@
+import re
+from typing import List, Optional
+from pydantic import BaseModel
+from server.agents.retrieval_result import RetrievalResult
+
+# Optional import so the packer still works (with an estimate) without tiktoken
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budget for the retrieved product context, per generation model
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-4.1-mini": 1500,
+    "gpt-4.1": 3000,
+    "gpt-4o-mini": 1200,
+    "gpt-5-nano": 1000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1200
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;])\s+|\n+|\s+-\s+|\s*•\s*")
+_WORD = re.compile(r"[a-z0-9]+")
+_encoders = {}
+
+
+class PackedContext(BaseModel):
+    entries: List[str]
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.entries)
+
+
+def get_context_budget(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def _get_encoder(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encoders:
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encoders[model] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # the BPE file could not be fetched, fall back to the estimate
+            _encoders[model] = None
+    return _encoders[model]
+
+
+def count_tokens(text: str, model: str = "gpt-4.1-mini") -> int:
+    encoder = _get_encoder(model)
+    if encoder is None:
+        # roughly 4 characters per token for English text
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def _split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text.strip()) if s and s.strip()]
+
+
+def _terms(text: str) -> set:
+    return {w for w in _WORD.findall(text.lower()) if len(w) > 2}
+
+
+def pack_context(
+    retrieved_context: RetrievalResult,
+    query: str,
+    model: str = "gpt-4.1-mini",
+    template: str = "Product ID: {id}, rating: {rating}, description: {description}",
+    token_budget: Optional[int] = None,
+) -> PackedContext:
+    """
+    Packs the reranked products into a token-bounded context.
+
+    Every description keeps its first sentence (the title) and then the sentences sharing the
+    most terms with the query, in their original order, until the product's share of the budget
+    is used. Sentences already emitted for an earlier variant are dropped. Budget not used by a
+    product rolls over to the ones after it.
+
+    Args:
+        retrieved_context: the reranked products, in rank order.
+        query: the user query used to rank sentences.
+        model: generation model, used to pick the budget and the tokenizer.
+        template: line format with {id}, {rating} and {description} placeholders.
+        token_budget: overrides the per-model budget.
+
+    Returns:
+        PackedContext with one formatted entry per product and the before/after token counts.
+    """
+    budget = token_budget if token_budget is not None else get_context_budget(model)
+    query_terms = _terms(query)
+    seen = set()
+    entries = []
+    tokens_before = 0
+    tokens_after = 0
+    remaining = budget
+
+    for position, (item_id, description, rating) in enumerate(retrieved_context.rows()):
+        overhead = count_tokens(template.format(id=item_id, rating=rating, description=""), model)
+        sentences = _split_sentences(description or "")
+        costs = [count_tokens(s, model) for s in sentences]
+        tokens_before += overhead + sum(costs)
+
+        allowance = remaining // (len(retrieved_context) - position) - overhead
+        selected = []
+        if sentences:
+            # the title is always kept so the product stays identifiable
+            selected.append(0)
+            allowance -= costs[0]
+            seen.add(sentences[0].lower())
+
+        candidates = {}
+        for index in range(1, len(sentences)):
+            key = sentences[index].lower()
+            if key in seen or key in candidates:
+                continue
+            overlap = len(query_terms & _terms(sentences[index]))
+            candidates[key] = (-overlap, index)
+
+        for key, (_, index) in sorted(candidates.items(), key=lambda candidate: candidate[1]):
+            if costs[index] <= allowance:
+                selected.append(index)
+                allowance -= costs[index]
+                seen.add(key)
+
+        selected.sort()
+        packed_description = " ".join(sentences[i] for i in selected)
+        used = overhead + sum(costs[i] for i in selected)
+        tokens_after += used
+        remaining -= used
+        entries.append(template.format(id=item_id, rating=rating, description=packed_description))
+
+    return PackedContext(entries=entries, tokens_before=tokens_before, tokens_after=tokens_after)
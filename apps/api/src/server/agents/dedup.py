@@ -0,0 +1,94 @@
+import re
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+from server.agents.retrieval_result import RetrievalResult
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(1)
+# fixed seed, so signatures are comparable across processes
+_HASH_A = _rng.integers(1, _MERSENNE_PRIME, size=64, dtype=np.int64)
+_HASH_B = _rng.integers(0, _MERSENNE_PRIME, size=64, dtype=np.int64)
+
+_VARIANT_WORDS = (
+    r"black|white|silver|gray|grey|red|blue|green|yellow|pink|purple|orange|gold|rose|navy|beige|brown|"
+    r"teal|clear|transparent|small|medium|large|x-large|xl|xxl|mini"
+)
+_VARIANT_TOKENS = re.compile(rf"\(.*?\)|\[.*?\]|\b(?:{_VARIANT_WORDS})\b|\b\d+\s*-?\s*(?:pack|pcs|count|pieces)\b|"
+                             rf"\bpack of \d+\b", re.IGNORECASE)
+
+
+def family_title(title: str) -> str:
+    """
+    The text shared by the variants of one product: lowercase words without colours, sizes,
+    pack counts and parenthesized details, e.g. "USB-C Cable (6ft) - Black, 2 Pack" -> "usb c cable".
+    """
+    normalized = _VARIANT_TOKENS.sub(" ", title or "").lower()
+    return " ".join(re.findall(r"[a-z0-9]+", normalized))
+
+
+def family_key(title: str) -> str:
+    """Key shared by the variants of one product: the crc32 of its family_title, as 8 hex digits."""
+    return format(zlib.crc32(family_title(title).encode("utf-8")), "08x")
+
+
+def minhash_signatures(texts: List[str], shingle_size: int = 2) -> np.ndarray:
+    """
+    (texts x 64) MinHash signatures over hashed word shingles of the family_title, so
+    variants that differ only in colour, size or pack count get the same signature.
+    """
+    signatures = np.full((len(texts), len(_HASH_A)), _MERSENNE_PRIME, dtype=np.int64)
+    for row, text in enumerate(texts):
+        words = family_title(text).split()
+        shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.int64, count=len(shingles))
+        # one row per hash function, min over the shingles
+        signatures[row] = ((np.outer(_HASH_A, hashes) + _HASH_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+    return signatures
+
+
+def minhash_similarity(texts: List[str]) -> np.ndarray:
+    """Estimated pairwise Jaccard similarity of the descriptions' shingle sets."""
+    signatures = minhash_signatures(texts)
+    return (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+
+
+def cosine_similarity(vectors: np.ndarray) -> np.ndarray:
+    normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return normalized @ normalized.T
+
+
+def greedy_keep(similarity: np.ndarray, threshold: float, limit: Optional[int] = None) -> List[int]:
+    """
+    Walks the items in rank order and keeps one unless it is at least `threshold` similar
+    to an item already kept, so each group of variants is represented by its best-ranked member.
+    """
+    kept: List[int] = []
+    for i in range(len(similarity)):
+        if not kept or similarity[i, kept].max() < threshold:
+            kept.append(i)
+            if limit is not None and len(kept) == limit:
+                break
+    return kept
+
+
+def collapse_near_duplicates(retrieved_context: RetrievalResult, method: str = "minhash",
+                             threshold: Optional[float] = None, limit: Optional[int] = None) -> RetrievalResult:
+    """
+    Drops near-identical variants from a retrieval, keeping the best-ranked one of each group.
+    `method` is "cosine" (on the dense vectors returned with the points) or "minhash"
+    (on the descriptions); without returned vectors cosine falls back to minhash.
+    """
+    if len(retrieved_context) < 2:
+        return retrieved_context.head(limit) if limit is not None else retrieved_context
+
+    vectors = retrieved_context.vectors
+    if method == "cosine" and vectors is not None:
+        similarity = cosine_similarity(vectors)
+        threshold = 0.97 if threshold is None else threshold
+    else:
+        similarity = minhash_similarity(retrieved_context.context)
+        threshold = 0.8 if threshold is None else threshold
+    return retrieved_context.take(greedy_keep(similarity, threshold, limit))
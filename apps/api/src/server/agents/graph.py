@@ -1,17 +1,24 @@
-from server.agents.models import State
+from server.agents.models import State, WorkingSet
 from langgraph.graph import StateGraph, START, END
 from langgraph.prebuilt import tools_condition
 from langgraph.prebuilt import ToolNode
-from server.agents.tools import retrieve_embedding
+from langchain_core.tools import tool
+from server.agents.tools import retrieve_embedding, search_working_set
+from server.agents.tool_results import get_product_metadata
 from server.agents.agents import router_node, query_rewriter_node, agent_node
-from langchain_core.messages import AIMessage
-from typing import Literal
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from typing import Callable, List, Literal, Optional
+import threading
 from qdrant_client import QdrantClient
-from qdrant_client.models import Filter, FieldCondition, MatchValue
-import numpy as np
 from server.core.config import config
 from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 from server.agents.utils.utils import get_tool_descriptions
+from server.agents.utils.single_flight import SingleFlight
+from server.agents.utils.deadline import Deadline, current_deadline, deadline_scope
+from server.agents.utils.profiling import graph_callbacks, profile_scope
+from server.core.metrics import metrics
+from server.core.thumbnails import thumbnail_url
 
 
 # edges and graph definitions
@@ -47,7 +54,8 @@ def custome_route_edge(state: State) -> Literal["ageaggregation_nodent", "tools"
 def build_graph():
     graphbuilder2 = StateGraph(State)
 
-    tools_node = ToolNode(tools=[retrieve_embedding])
+    # the tool returns (text for the model, product references), the references become the ToolMessage artifact
+    tools_node = ToolNode(tools=[tool(function, response_format="content_and_artifact") for function in tools])
     graphbuilder2.add_node("router", router_node)
     graphbuilder2.add_node("query_rewriter", query_rewriter_node)
     graphbuilder2.add_node("agent_node", agent_node)
@@ -62,10 +70,123 @@ def build_graph():
     return graphbuilder2
 
 
-tools=[retrieve_embedding]
+class RequestSaver(PostgresSaver):
+    """
+    Postgres checkpointer that stops writing once its request is cancelled. The graph runs
+    with durability="exit" (see invoke_graph), so a turn's checkpoint is only written when the
+    run ends: a turn the client abandoned is not persisted at all and the thread resumes from
+    its last full turn.
+    """
+    deadline: Optional[Deadline] = None
+
+    def __init__(self, *args, **kwargs):
+        # the state's own models, so they load from a checkpoint without the unregistered-type warning
+        kwargs.setdefault("serde", JsonPlusSerializer(allowed_msgpack_modules=[
+            ("server.agents.models", name) for name in ("Toolcall", "RAGUsedContext", "WorkingSet")
+        ]))
+        super().__init__(*args, **kwargs)
+
+    def _abandoned(self) -> bool:
+        if self.deadline is not None and self.deadline.cancelled:
+            metrics.increment("checkpoint_writes_skipped_total")
+            return True
+        return False
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        if self._abandoned():
+            return {"configurable": {**config["configurable"], "checkpoint_id": checkpoint["id"]}}
+        return super().put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        if self._abandoned():
+            return
+        return super().put_writes(config, writes, task_id, task_path)
+
+
+tools=[retrieve_embedding, search_working_set]
 tool_descriptions = get_tool_descriptions(tools)
 
-def run_agent(question, thread_id):
+agent_flight = SingleFlight("agent_pipeline", timeout=config.pipeline_single_flight_timeout)
+
+def invoke_graph(graph, state, thread_config, on_step: Optional[Callable[[str], None]] = None):
+    """
+    graph.invoke, calling `on_step` with the name of each node as it finishes. The turn is
+    checkpointed once, when the run exits, instead of after every node.
+    """
+    callbacks = graph_callbacks()
+    if callbacks:
+        thread_config = {**thread_config, "callbacks": callbacks}
+    if on_step is None:
+        return graph.invoke(state, config=thread_config, durability="exit")
+    result = None
+    for mode, chunk in graph.stream(state, config=thread_config, stream_mode=["updates", "values"],
+                                    durability="exit"):
+        if mode == "updates":
+            for node in chunk:
+                on_step(node)
+        else:
+            result = chunk
+    return result
+
+class StepRelay:
+    """
+    The node steps of a coalesced first turn. The leader emits them; a follower's on_step is
+    subscribed when it joins the flight and first receives the steps emitted so far.
+    """
+
+    def __init__(self, on_step: Optional[Callable[[str], None]] = None):
+        self._lock = threading.Lock()
+        self._steps: List[str] = []
+        self._listeners = [on_step] if on_step is not None else []
+
+    def emit(self, node: str) -> None:
+        # listeners only queue the step, calling them under the lock keeps every one in order
+        with self._lock:
+            self._steps.append(node)
+            for listener in self._listeners:
+                listener(node)
+
+    def subscribe(self, on_step: Optional[Callable[[str], None]]) -> None:
+        if on_step is None:
+            return
+        with self._lock:
+            for node in self._steps:
+                on_step(node)
+            self._listeners.append(on_step)
+
+def shared_turn(question, result):
+    """
+    The turn a follower of a coalesced first question records in its own thread: its question,
+    then copies of the leader's tool calls, tool results and answer. Tool calls the leader left
+    unanswered (it stopped at the iteration cap) are stripped and its final answer appended, so
+    the follower's thread always ends the turn with nothing pending.
+    """
+    answer = result.get("answer", "")
+    messages = [HumanMessage(content=question)]
+    # the leader's messages after its own question
+    leader_turn = result.get("messages", [])[1:]
+    for i, message in enumerate(leader_turn):
+        answered = i + 1 < len(leader_turn) and isinstance(leader_turn[i + 1], ToolMessage)
+        if isinstance(message, AIMessage) and message.tool_calls and not answered:
+            message = message.model_copy(update={"tool_calls": []})
+        # without the leader's ids, the copies are new messages of this thread
+        messages.append(message.model_copy(update={"id": None}))
+    last = leader_turn[-1] if leader_turn else None
+    if not (isinstance(last, AIMessage) and not last.tool_calls):
+        messages.append(AIMessage(content=answer))
+    return {
+        "messages": messages,
+        "available_tools": tool_descriptions,
+        "iteration": 0,
+        "final_answer": True,
+        "answer": answer,
+        "query_relevant": result.get("query_relevant", False),
+        "tool_calls": [],
+        "references": result.get("references", []),
+        "working_set": result.get("working_set") or WorkingSet(),
+    }
+
+def run_agent(question, thread_id, on_step: Optional[Callable[[str], None]] = None):
     
     graph_builder = build_graph()
     
@@ -82,55 +203,59 @@ def run_agent(question, thread_id):
         }
     }
 
-    with PostgresSaver.from_conn_string(config.postgres_url) as saver:
+    with RequestSaver.from_conn_string(config.postgres_url) as saver:
+        # checkpoint writes run on LangGraph's background threads, so hand them the deadline directly
+        saver.deadline = current_deadline()
         
         graph = graph_builder.compile(checkpointer=saver)
-        result = graph.invoke(initial_state, config=thread_config)
+        
+        if saver.get_tuple(thread_config) is not None:
+            return invoke_graph(graph, initial_state, thread_config, on_step)
+        
+        # first turn has no history, so identical questions can share one execution; the leader
+        # always streams its steps, a follower may be a /stream call waiting on them
+        relay = StepRelay(on_step)
+        result, leader_thread_id = agent_flight.do(
+            question.strip().lower(),
+            lambda: (invoke_graph(graph, initial_state, thread_config, relay.emit), thread_id),
+            shared=relay,
+            on_follow=lambda leader_relay: leader_relay.subscribe(on_step),
+        )
+        
+        if leader_thread_id != thread_id:
+            # record the shared turn in this thread too so follow-ups keep their history
+            graph.update_state(thread_config, shared_turn(question, result),
+                               as_node="agent_node" if result.get("query_relevant") else "router")
     
     return result
     
-def rag_pipeline_wrapper(question, thread_id=None):
+def rag_pipeline_wrapper(question, thread_id=None, deadline: Optional[Deadline] = None,
+                         on_step: Optional[Callable[[str], None]] = None):
     
     qdrant_client = QdrantClient(   
         url=config.qdrant_url,
     )
     
-    result = run_agent(question, thread_id)
-    
-    used_context = []
-    
-    dummy_vector = np.zeros(1536).tolist()
+    # every node and upstream call below reads the deadline from the context
+    with deadline_scope(deadline), profile_scope():
+        result = run_agent(question, thread_id, on_step)
         
-    for item in result.get("references"):
-        payload = qdrant_client.query_points(
-            collection_name="amazon_items-collection-hybrid-02",
-            query=dummy_vector,
-            limit=1,
-            with_payload=True,
-            using="text-embedding-3-small",
-            with_vectors=False,
-            query_filter=Filter(
-                must=[
-                    FieldCondition(
-                        key="parent_asin",
-                        match=MatchValue(value=item.id)
-                    )
-                ]
-            )
-        )
-        if payload.points[0].payload["parent_asin"]:
-            image_url = payload.points[0].payload.get("image", None)
-            price = payload.points[0].payload.get("price", None)
-            if image_url:
-                used_context.append({
-                    "id": item.id,
-                    "description": item.description,
-                    "image_url": image_url,
-                    "price": price
-                })
+        used_context = []
+        
+        for item in result.get("references"):
+            payload = get_product_metadata(qdrant_client, item.id)
+            if payload and payload.get("parent_asin"):
+                image_url = payload.get("image", None)
+                price = payload.get("price", None)
+                if image_url:
+                    used_context.append({
+                        "id": item.id,
+                        "description": item.description,
+                        "image_url": thumbnail_url(item.id, image_url),
+                        "price": price
+                    })
             
     return {
         "answer": result.get("answer", ""),
         "used_context": used_context,
     }
-    
\ No newline at end of file
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from server.agents.utils.profiling import profiled
+from server.core.config import config
+
+# Optional import, only needed when the local embedding backend is enabled
+try:
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
+
+
+def local_vector_name(model_name: str) -> str:
+    """Named vector of the local model in the collection, e.g. "BAAI/bge-small-en-v1.5" -> "bge-small-en-v1.5"."""
+    return model_name.split("/")[-1]
+
+
+class LocalEmbedder:
+    """
+    Dense embeddings from an ONNX model run in-process by fastembed.
+
+    Texts are embedded in batches of `batch_size`; the batches of one call run in parallel on
+    a small thread pool (onnxruntime releases the GIL), which also bounds how many requests
+    compete for the CPU at once.
+    """
+
+    def __init__(self, model_name: str, threads: Optional[int] = None, workers: int = 2, batch_size: int = 64):
+        if TextEmbedding is None:
+            raise ImportError("fastembed library not found. Run: pip install fastembed")
+
+        # downloads the ONNX weights on first use, then loads from the local cache
+        self.model = TextEmbedding(model_name=model_name, threads=threads)
+        self.model_name = model_name
+        self.vector_name = local_vector_name(model_name)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="local-embedding")
+        self.size = len(self._embed_batch(["probe"])[0])
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self.model.embed(texts, batch_size=self.batch_size)]
+
+    def _query_embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self.model.query_embed(texts, batch_size=self.batch_size)]
+
+    def _map(self, embed_batch, texts: List[str]) -> List[List[float]]:
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        embeddings = []
+        for batch in self.executor.map(profiled(embed_batch), batches):
+            embeddings.extend(batch)
+        return embeddings
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Document embeddings, what ingestion stores in the collection."""
+        return self._map(self._embed_batch, texts)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Query embeddings: the model's query form (e.g. BGE's retrieval instruction prefix)."""
+        return self._map(self._query_embed_batch, texts)
+
+
+_local_embedder: Optional[LocalEmbedder] = None
+_local_embedder_lock = threading.Lock()
+
+
+def get_local_embedder() -> LocalEmbedder:
+    """The process-wide local embedder, loaded on first use."""
+    global _local_embedder
+    with _local_embedder_lock:
+        if _local_embedder is None:
+            _local_embedder = LocalEmbedder(
+                config.local_embedding_model,
+                threads=config.local_embedding_threads,
+                workers=config.local_embedding_workers,
+                batch_size=config.local_embedding_batch_size,
+            )
+        return _local_embedder
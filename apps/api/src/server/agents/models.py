@@ -1,16 +1,41 @@
-from pydantic import BaseModel, Field
-from typing import Annotated, Any, List, Dict
+import json
+from pydantic import BaseModel, Field, field_validator
+from typing import Annotated, Any, List, Dict, Optional
 from langgraph.graph.message import add_messages
 from operator import add
 
 class Toolcall(BaseModel):
     name: str
     arguments: dict
+
+    @field_validator("arguments", mode="before")
+    @classmethod
+    def _decode_arguments(cls, value):
+        # strict structured outputs have no free-form objects, the model sends the arguments as JSON text
+        return json.loads(value) if isinstance(value, str) else value
     
 class RAGUsedContext(BaseModel):
     id: str = Field(description="The ID of the item used to answer the question")
     description: str = Field(description="Short description of the item used to answer the question")
 
+class ProductRef(BaseModel):
+    """A product returned by a tool, kept as the ToolMessage artifact; the full payload is in the product store."""
+    id: str
+    title: str
+    rating: Optional[float] = None
+    price: Optional[float] = None
+
+class WorkingSet(BaseModel):
+    """
+    Products retrieved earlier in the thread, most recently used first, as parallel columns so
+    the checkpoint stores one small object instead of one model per product.
+    """
+    ids: List[str] = []
+    descriptions: List[str] = []
+    prices: List[Optional[float]] = []
+    ratings: List[Optional[float]] = []
+    images: List[Optional[str]] = []
+
 class AgentResponse(BaseModel):
     answer: str = Field(description="Answer to the question.")
     references: list[RAGUsedContext] = Field(description="List of items used to answer the question.")
@@ -42,3 +67,4 @@ class State(BaseModel):
     query_relevant: bool = False
     tool_calls: List[Toolcall] = []
     references: Annotated[List[RAGUsedContext], add] = []
+    working_set: WorkingSet = WorkingSet()
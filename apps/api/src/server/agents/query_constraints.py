@@ -0,0 +1,107 @@
+import re
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+from qdrant_client.models import FieldCondition, Filter, Range
+
+_NUMBER = r"(\d+(?:[.,]\d+)?)"
+_CURRENCY_AFTER = r"\s?(?:\$|(?:usd|dollars?|bucks)\b)"
+# a number with a currency marker: "$50", "50 dollars", "50$"
+_MARKED = rf"(?:\$\s?{_NUMBER}|{_NUMBER}{_CURRENCY_AFTER})"
+# a bare number that no unit follows ("under 50" but not "under 50 hours", "4-star" or "5 years")
+_NO_UNIT = r"(?!\d|[.,]\d)(?!\s*[-+]?\s*(?!(?:with|and|for|that|which|or|please)\b)[a-z%\"'])"
+_BARE = rf"{_NUMBER}{_NO_UNIT}"
+# a bare number is only a price right after one of these ("priced under 50", "budget up to 100"),
+# otherwise "kids over 5" or "phone up to 2" would become price filters
+_PRICE_WORD = r"\b(?:pric(?:e|es|ed|ing)|costs?|costing|budget|spend(?:ing)?|pay(?:ing)?)"
+_MAX = r"\b(?:under|below|less than|cheaper than|at most|no more than|up to|max(?:imum)?(?: of)?|within)"
+_MIN = r"\b(?:over|above|more than|at least|starting at|min(?:imum)?(?: of)?)"
+_TO = r"\s*(?:-|–|to)\s*"
+
+_PRICE_RANGE = re.compile(
+    rf"(?:\bbetween\s+{_MARKED}\s+and\s+(?:{_MARKED}|{_BARE})"
+    rf"|\bbetween\s+{_NUMBER}\s+and\s+{_MARKED}"
+    rf"|{_PRICE_WORD}\s+between\s+{_NUMBER}\s+and\s+{_BARE}"
+    rf"|\$\s?{_NUMBER}{_TO}\$?\s?{_NUMBER}"
+    rf"|\b{_NUMBER}{_TO}{_NUMBER}{_CURRENCY_AFTER}"
+    rf"|{_PRICE_WORD}\s+(?:from\s+)?{_NUMBER}{_TO}{_BARE})",
+    re.IGNORECASE,
+)
+_MAX_PRICE = re.compile(rf"(?:{_MAX}\s+{_MARKED}|{_PRICE_WORD}\s+{_MAX}\s+{_BARE})", re.IGNORECASE)
+_MIN_PRICE = re.compile(rf"(?:{_MIN}\s+{_MARKED}|{_PRICE_WORD}\s+{_MIN}\s+{_BARE})", re.IGNORECASE)
+_STARS = re.compile(
+    r"(under|below|less than)?\s*(?:at least|min(?:imum)?|over|above|more than)?\s*"
+    r"(\d(?:\.\d+)?)\s*(?:\+|or (?:more|higher|above|better))?\s*-?\s*stars?",
+    re.IGNORECASE,
+)
+_RATED = re.compile(r"rated\s+(?:at least|above|over|min(?:imum)?)?\s*(\d(?:\.\d+)?)", re.IGNORECASE)
+_RATING_COUNT = re.compile(r"(\d[\d,]*(?:\.\d+)?)\s*(k)?\s*\+?\s*(?:reviews|ratings)", re.IGNORECASE)
+
+
+def _amounts(match: re.Match) -> List[float]:
+    """The numbers of a price match in order, the comparators and price words have none."""
+    return [float(group.replace(",", "")) for group in match.groups() if group]
+
+
+class QueryConstraints(BaseModel):
+    min_price: Optional[float] = Field(default=None, description="Lowest acceptable price in dollars")
+    max_price: Optional[float] = Field(default=None, description="Highest acceptable price in dollars")
+    min_rating: Optional[float] = Field(default=None, description="Lowest acceptable average rating (1-5)")
+    min_rating_count: Optional[int] = Field(default=None, description="Lowest acceptable number of ratings")
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.model_dump().values())
+
+    def key(self) -> Tuple:
+        return tuple(self.model_dump().values())
+
+    def merge(self, other: "QueryConstraints") -> "QueryConstraints":
+        """Constraints of `other` take precedence over the ones in self."""
+        return QueryConstraints(**{**self.model_dump(), **other.model_dump(exclude_none=True)})
+
+    def to_filter(self) -> Optional[Filter]:
+        """Qdrant filter applied to both prefetch branches, None when there is nothing to filter on."""
+        conditions = []
+        if self.min_price is not None or self.max_price is not None:
+            conditions.append(FieldCondition(key="price", range=Range(gte=self.min_price, lte=self.max_price)))
+        if self.min_rating is not None:
+            conditions.append(FieldCondition(key="average_rating", range=Range(gte=self.min_rating)))
+        if self.min_rating_count is not None:
+            conditions.append(FieldCondition(key="rating_number", range=Range(gte=self.min_rating_count)))
+        return Filter(must=conditions) if conditions else None
+
+
+def extract_constraints(query: str) -> QueryConstraints:
+    """
+    Rule-based extraction of price and rating constraints from a shopping question,
+    e.g. "headphones under $50 with at least 4 stars" -> max_price=50, min_rating=4.
+    A number is only read as a price with a currency marker or after a price word, as the
+    constraints become hard filters: a wrong one leaves the search with the wrong products.
+    """
+    constraints = {}
+
+    price_range = _PRICE_RANGE.search(query)
+    if price_range:
+        constraints["min_price"], constraints["max_price"] = sorted(_amounts(price_range))
+    else:
+        max_price = _MAX_PRICE.search(query)
+        if max_price:
+            constraints["max_price"] = _amounts(max_price)[0]
+        min_price = _MIN_PRICE.search(query)
+        if min_price:
+            constraints["min_price"] = _amounts(min_price)[0]
+
+    for match in _STARS.finditer(query):
+        comparator, rating = match.groups()
+        if not comparator and float(rating) <= 5:
+            constraints["min_rating"] = float(rating)
+    rated = _RATED.search(query)
+    if rated and "min_rating" not in constraints and float(rated.group(1)) <= 5:
+        constraints["min_rating"] = float(rated.group(1))
+
+    rating_count = _RATING_COUNT.search(query)
+    if rating_count:
+        count = float(rating_count.group(1).replace(",", ""))
+        constraints["min_rating_count"] = int(count * 1000 if rating_count.group(2) else count)
+
+    return QueryConstraints(**constraints)
@@ -1,6 +1,7 @@
 import os
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Union
+from server.agents.utils.rate_limiting import get_limiter
 
 # Optional imports to prevent crashes if libraries aren't installed
 try:
@@ -29,7 +30,8 @@ class CohereReranker(BaseReranker):
         if not documents:
             return []
             
-        response = self.client.rerank(
+        response = get_limiter("cohere").call(
+            self.client.rerank,
             model=self.model,
             query=query,
             documents=documents,
@@ -1,14 +1,43 @@
+from typing import Optional
 from qdrant_client import QdrantClient
 import openai
 from server.core.config import config
 from langsmith import traceable, get_current_run_tree
 from server.agents.models import RAGResponse
-import instructor
-import numpy as np
-from qdrant_client.models import Filter, FieldCondition, MatchValue
-from qdrant_client.models import Document, Prefetch, FusionQuery
-from server.agents.utils.prompt_management import get_prompt_from_config
+from qdrant_client.models import (Document, Filter, FusionQuery, IsEmptyCondition, PayloadField, Prefetch,
+                                  QueryRequest)
+from concurrent.futures import as_completed
+from langsmith.utils import ContextThreadPoolExecutor
+from server.agents.utils.prompt_management import render_messages
+from server.agents.utils.structured_output import structured_completion
 from server.agents.reranker import get_reranker
+from server.agents.context_packing import pack_context
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.sharding import FAMILY_KEY, lookup_collections, registry_collection, search_shards
+from server.agents.query_constraints import QueryConstraints, extract_constraints
+from server.agents.local_embeddings import get_local_embedder, local_vector_name
+from server.agents.dedup import collapse_near_duplicates
+from server.agents.tool_results import get_product_metadata
+from server.core.metrics import metrics
+from server.agents.utils.single_flight import SingleFlight
+from server.agents.utils.rate_limiting import get_limiter
+from server.agents.utils.deadline import Deadline, RequestCancelledError, deadline_scope
+from server.core.cache import get_cache
+from server.core.thumbnails import thumbnail_url
+
+embedding_flight = SingleFlight("embedding", timeout=config.single_flight_timeout)
+hybrid_search_flight = SingleFlight("hybrid_search", timeout=config.single_flight_timeout)
+rerank_flight = SingleFlight("rerank", timeout=config.single_flight_timeout)
+pipeline_flight = SingleFlight("rag_pipeline", timeout=config.pipeline_single_flight_timeout)
+
+embedding_cache = get_cache("embeddings")
+rerank_cache = get_cache("rerank")
+collection_vectors_cache = get_cache("collection_vectors", ttl=300, shared=False)
+# re-checked every few minutes, so a backfill is picked up without a restart
+snippet_coverage_cache = get_cache("snippet_coverage", ttl=300, shared=False)
+
+PREFETCH_LIMIT = 20
+REMOTE_VECTOR = "text-embedding-3-small"
 
 @traceable(
     name="generate_embeddings",
@@ -17,7 +46,14 @@ from server.agents.reranker import get_reranker
     metadata={"ls_provider": "openai", "ls_model": "text-embedding-3-small"}
 )
 def create_embeddings(text, model="text-embedding-3-small"):
-    response = openai.embeddings.create(
+    embedding = embedding_cache.get((model, text))
+    if embedding is not None:
+        return embedding
+    
+    response = embedding_flight.do(
+        (model, text),
+        get_limiter("openai").call,
+        openai.embeddings.create,
         model=model,
         input=text
     )
@@ -29,95 +65,319 @@ def create_embeddings(text, model="text-embedding-3-small"):
             "total_tokens": response.usage.total_tokens,
             "input_tokens": response.usage.prompt_tokens,
         }
-        
+    
+    embedding_cache.set((model, text), response.data[0].embedding)
     return response.data[0].embedding
 
+def hybrid_prefetch(query_embeddings, query, query_filter=None, using=REMOTE_VECTOR):
+    # the filter goes on both branches so each returns PREFETCH_LIMIT matching candidates
+    return [Prefetch(
+        query=query_embeddings,
+        using=using,
+        filter=query_filter,
+        limit=PREFETCH_LIMIT),
+        Prefetch(
+            query=Document(text=query, model="qdrant/bm25"),
+            using="bm25",
+            filter=query_filter,
+            limit=PREFETCH_LIMIT)
+        ]
+
+@traceable(
+    name="generate_embeddings_batch",
+    description="Generate embeddings for a list of texts in grouped OpenAI calls",
+    run_type="embedding",
+    metadata={"ls_provider": "openai", "ls_model": "text-embedding-3-small"}
+)
+def create_embeddings_batch(texts, model="text-embedding-3-small", batch_size=100):
+    embeddings = []
+    total_tokens = 0
+    for i in range(0, len(texts), batch_size):
+        response = get_limiter("openai").call(
+            openai.embeddings.create,
+            model=model,
+            input=texts[i:i + batch_size]
+        )
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        total_tokens += response.usage.total_tokens
+    
+    current_run = get_current_run_tree()
+    
+    if current_run:
+        current_run.metadata["usage_metadata"] = {
+            "total_tokens": total_tokens,
+            "input_tokens": total_tokens,
+        }
+    
+    return embeddings
+
+@traceable(
+    name="generate_local_embeddings",
+    description="Generate embeddings in-process with the local ONNX model",
+    run_type="embedding",
+    metadata={"ls_provider": "fastembed"}
+)
+def create_local_embeddings(texts):
+    embedder = get_local_embedder()
+    embeddings = [embedding_cache.get((embedder.model_name, "query", text)) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        for i, embedding in zip(missing, embedder.embed_queries([texts[i] for i in missing])):
+            embeddings[i] = embedding
+            embedding_cache.set((embedder.model_name, "query", texts[i]), embedding)
+    return embeddings
+
+def snippets_backfilled(qd_client: QdrantClient, collection_name) -> bool:
+    """Whether every point searched for `collection_name` has its llm_snippet (see --backfill-snippets)."""
+    def _check():
+        without_snippet = Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="llm_snippet"))])
+        backfilled = True
+        for collection in lookup_collections(qd_client, collection_name):
+            missing = get_limiter("qdrant").call(qd_client.count, collection_name=collection,
+                                                 count_filter=without_snippet, exact=True).count
+            metrics.set("llm_snippets_missing_points", missing, collection=collection)
+            backfilled = backfilled and missing == 0
+        return backfilled
+    
+    return snippet_coverage_cache.get_or_compute(collection_name, _check)
+
+def payload_fields(qd_client: QdrantClient, collection_name):
+    """
+    Payload read back with every hit. The full description stays in Qdrant for BM25 and the
+    embeddings, the prompt and the reranker only need the compact snippet. Until the
+    collection's snippets are backfilled the description is read too, as their fallback.
+    """
+    if not config.llm_snippets_enabled:
+        text_fields = ["description"]
+    elif snippets_backfilled(qd_client, collection_name):
+        text_fields = ["llm_snippet"]
+    else:
+        text_fields = ["llm_snippet", "description"]
+    fields = ["parent_asin", *text_fields, "average_rating", "price", "image"]
+    if config.dedup_method == "group":
+        fields.append(FAMILY_KEY)
+    return fields
+
+def collection_has_vector(qd_client: QdrantClient, collection_name, vector_name) -> bool:
+    """Whether every collection searched for `collection_name` (each shard and the shard registry) has the named vector."""
+    def _check():
+        collections = lookup_collections(qd_client, collection_name)
+        if config.sharding_enabled:
+            collections = [*collections, registry_collection(collection_name)]
+        for collection in collections:
+            # not through the limiter: get_collection takes no timeout argument (it rejects any
+            # keyword it does not know), and this runs once per collection every few minutes
+            info = qd_client.get_collection(collection_name=collection)
+            vectors = info.config.params.vectors
+            if not isinstance(vectors, dict) or vector_name not in vectors:
+                return False
+        return True
+    
+    return collection_vectors_cache.get_or_compute((collection_name, vector_name), _check)
+
+def embed_queries(texts, qd_client: QdrantClient = None, collection_name=None):
+    """
+    Dense query embeddings from the configured backend, returned with the name of the
+    collection vector they must be searched against. With `local_first`, collections that
+    were ingested without the local vector are searched with the remote embeddings.
+    """
+    backend = config.embedding_backend
+    if backend == "local_first" and qd_client is not None and collection_name is not None:
+        try:
+            has_local = collection_has_vector(qd_client, collection_name,
+                                              local_vector_name(config.local_embedding_model))
+            reason = "no_local_vector"
+        except Exception:
+            # not cached, the next request checks again; the remote vector is always there
+            has_local, reason = False, "error"
+        if not has_local:
+            backend = "remote"
+            metrics.increment("embedding_fallbacks_total", backend="local", reason=reason)
+    if backend in ("local", "local_first"):
+        try:
+            return get_local_embedder().vector_name, create_local_embeddings(texts)
+        except Exception:
+            if backend == "local":
+                raise
+            metrics.increment("embedding_fallbacks_total", backend="local", reason="error")
+    if len(texts) == 1:
+        return REMOTE_VECTOR, [create_embeddings(texts[0])]
+    return REMOTE_VECTOR, create_embeddings_batch(texts, batch_size=config.embedding_batch_size)
+
 @traceable(name="retrieve_embedding_data", 
 description="Retrieve embedding data from Qdrant for a given query and collection name",
 run_type="retriever"
 )
-def retrieve_embedding_data(qd_client: QdrantClient, query, collection_name, k=10):
+def retrieve_embedding_data(qd_client: QdrantClient, query, collection_name, k=10,
+                            constraints: QueryConstraints = None):
+    
+    using, (querry_embeddings,) = embed_queries([query], qd_client, collection_name)
+    constraints = constraints or QueryConstraints()
+    report_constraints(constraints)
+    # cosine dedup needs the dense vectors of the candidates
+    with_vectors = [using] if config.dedup_method == "cosine" else False
     
-    querry_embeddings = create_embeddings(query)
+    if config.sharding_enabled:
+        points = hybrid_search_flight.do(
+            ("sharded", collection_name, using, query, k, constraints.key()),
+            search_shards,
+            qd_client,
+            collection_name,
+            [query],
+            [querry_embeddings],
+            k=k,
+            prefetch_limit=PREFETCH_LIMIT,
+            query_filters=[constraints.to_filter()],
+            vector_name=using,
+            with_vectors=with_vectors,
+            with_payload=payload_fields(qd_client, collection_name),
+            group_by=FAMILY_KEY if config.dedup_method == "group" else None,
+        )[0]
+        return RetrievalResult.from_points(points)
+    
+    if config.dedup_method == "group":
+        # one hit per product family, so the k results are k different products
+        response = hybrid_search_flight.do(
+            (collection_name, using, query, k, constraints.key(), FAMILY_KEY),
+            get_limiter("qdrant").call,
+            qd_client.query_points_groups,
+            collection_name=collection_name,
+            group_by=FAMILY_KEY,
+            prefetch=hybrid_prefetch(querry_embeddings, query, constraints.to_filter(), using),
+            query=FusionQuery(fusion="rrf"),
+            limit=k,
+            group_size=1,
+            with_payload=payload_fields(qd_client, collection_name),
+        )
+        return RetrievalResult.from_points(group.hits[0] for group in response.groups)
     
-    response = qd_client.query_points(
+    response = hybrid_search_flight.do(
+        (collection_name, using, query, k, constraints.key(), bool(with_vectors)),
+        get_limiter("qdrant").call,
+        qd_client.query_points,
         collection_name=collection_name,
-        prefetch=[Prefetch(
-            query=querry_embeddings,
-            using="text-embedding-3-small",
-            limit=20),
-            Prefetch(
-                query=Document(text=query, model="qdrant/bm25"),
-                using="bm25",
-                limit=20)
-            ],
+        prefetch=hybrid_prefetch(querry_embeddings, query, constraints.to_filter(), using),
         query=FusionQuery(fusion="rrf"),
         limit=k,
+        with_vectors=with_vectors,
+        with_payload=payload_fields(qd_client, collection_name),
     )
 
-    retrieved_context_ids = []
-    retrieved_context = []
-    retrieved_scores = []
-    retrieved_context_ratings = []
+    return RetrievalResult.from_points(response.points)
+
+@traceable(name="retrieve_embedding_data_batch", 
+description="Retrieve embedding data from Qdrant for many queries with grouped embeddings and query_batch_points",
+run_type="retriever"
+)
+def retrieve_embedding_data_batch(qd_client: QdrantClient, queries, collection_name, k=10, constraints=None):
+    
+    using, querry_embeddings = embed_queries(queries, qd_client, collection_name)
+    query_filters = [c.to_filter() for c in constraints] if constraints else [None] * len(queries)
+    with_vectors = [using] if config.dedup_method == "cosine" else False
     
-    for point in response.points:
-        retrieved_context_ids.append(point.payload["parent_asin"])
-        retrieved_context.append(point.payload["description"])
-        retrieved_scores.append(point.score)
-        retrieved_context_ratings.append(point.payload["average_rating"])
+    if config.sharding_enabled:
+        results = search_shards(qd_client, collection_name, queries, querry_embeddings, k=k,
+                                prefetch_limit=PREFETCH_LIMIT, query_filters=query_filters, vector_name=using,
+                                with_vectors=with_vectors, with_payload=payload_fields(qd_client, collection_name),
+                                group_by=FAMILY_KEY if config.dedup_method == "group" else None)
+        return [RetrievalResult.from_points(points) for points in results]
+    
+    responses = []
+    for i in range(0, len(queries), config.search_batch_size):
+        requests = [
+            QueryRequest(
+                prefetch=hybrid_prefetch(embedding, query, query_filter, using),
+                query=FusionQuery(fusion="rrf"),
+                limit=k,
+                with_payload=payload_fields(qd_client, collection_name),
+                with_vector=with_vectors,
+            )
+            for query, embedding, query_filter in zip(queries[i:i + config.search_batch_size],
+                                                      querry_embeddings[i:i + config.search_batch_size],
+                                                      query_filters[i:i + config.search_batch_size])
+        ]
+        responses.extend(get_limiter("qdrant").call(
+            qd_client.query_batch_points,
+            collection_name=collection_name,
+            requests=requests,
+        ))
 
-    # return dictionary of retrieved data
-    return {
-        "context_ids": retrieved_context_ids,
-        "context": retrieved_context,
-        "scores": retrieved_scores,
-        "context_ratings": retrieved_context_ratings
-    }
+    return [RetrievalResult.from_points(response.points) for response in responses]
+
+def candidate_count(k):
+    """How many candidates to retrieve so that k remain after near-duplicate collapsing."""
+    return k if config.dedup_method == "off" else k * config.dedup_overfetch
+
+@traceable(name="dedup_retrieved_context",
+           description="Collapse near-duplicate product variants before reranking",
+           run_type="retriever")
+def dedup_retrieved_context(retrieved_context: RetrievalResult, k=None) -> RetrievalResult:
+    if config.dedup_method == "off":
+        return retrieved_context.head(k) if k is not None else retrieved_context
+    
+    method = "cosine" if config.dedup_method == "cosine" else "minhash"
+    threshold = config.dedup_cosine_threshold if method == "cosine" else config.dedup_minhash_threshold
+    deduped = collapse_near_duplicates(retrieved_context, method=method, threshold=threshold, limit=k)
+    
+    current_run = get_current_run_tree()
+    
+    if current_run:
+        current_run.metadata["dedup"] = {
+            "method": config.dedup_method,
+            "candidates": len(retrieved_context),
+            "kept": len(deduped),
+        }
+    
+    return deduped
+
+def report_constraints(constraints: QueryConstraints):
+    current_run = get_current_run_tree()
+    
+    if current_run and not constraints.is_empty():
+        current_run.metadata["constraints"] = constraints.model_dump(exclude_none=True)
 
 @traceable(name="rerank_retrieved_context", 
            description="Rerank the retrieved context using the Cohere reranker", 
            run_type="embedding")
-def rerank_retrieved_context(query,retrieved_context):
-    reranker = get_reranker(provider="cohere")
-    context_list = retrieved_context["context"]
-    reranked_context = reranker.rerank(query=query, documents=context_list, top_n=5)
-    
-    reranked_retrieved_context_ids = []
-    reranked_retrieved_context = []
-    reranked_retrieved_scores = []
-    reranked_retrieved_context_ratings = []
-    
-    for new_context in reranked_context:
-        index = new_context.get("index")
-        reranked_retrieved_context_ids.append(retrieved_context["context_ids"][index])
-        reranked_retrieved_context.append(retrieved_context["context"][index])
-        reranked_retrieved_scores.append(retrieved_context["scores"][index])
-        reranked_retrieved_context_ratings.append(retrieved_context["context_ratings"][index])
-    
-    #return only top 5 results    
-    return {
-        "context_ids": reranked_retrieved_context_ids,
-        "context": reranked_retrieved_context,
-        "scores": reranked_retrieved_scores,
-        "context_ratings": reranked_retrieved_context_ratings
-    }
+def rerank_retrieved_context(query, retrieved_context: RetrievalResult, top_n=5) -> RetrievalResult:
+    if len(retrieved_context) == 0:
+        # a filter can leave nothing to rerank
+        return retrieved_context
+    
+    def _rerank_indices():
+        reranker = get_reranker(provider="cohere")
+        reranked_context = reranker.rerank(query=query, documents=retrieved_context.context, top_n=top_n)
+        return [new_context["index"] for new_context in reranked_context]
+    
+    rerank_key = ("cohere", query, tuple(retrieved_context.context_ids), top_n)
+    indices = rerank_cache.get_or_compute(rerank_key, lambda: rerank_flight.do(rerank_key, _rerank_indices))
+    
+    #return only top n results, reordered through the index array
+    return retrieved_context.take(indices)
 
 @traceable(
     name="format_context",
     description="Format the retrieved context into a string",
     run_type="retriever"
 )
-def format_context(retrived_context):
-    formatted_context = ""
-    for id, chunk, rating in zip(retrived_context["context_ids"], retrived_context["context"], retrived_context["context_ratings"]):
-        formatted_context += f"Product ID: {id}, rating: {rating}, description: {chunk.strip()}\n"
-    return formatted_context
+def format_context(retrived_context: RetrievalResult, question="", model="gpt-4.1-mini"):
+    packed_context = pack_context(retrived_context, query=question, model=model)
+    
+    current_run = get_current_run_tree()
+    
+    if current_run:
+        current_run.metadata["context_packing"] = {
+            "tokens_before": packed_context.tokens_before,
+            "tokens_after": packed_context.tokens_after,
+            "tokens_saved": packed_context.tokens_saved,
+        }
+    
+    return packed_context.text
 
 @traceable(name="construct_prompt", run_type="prompt")
 def build_prompt(preprocessed_context, question):
-    template = get_prompt_from_config('/app/apps/api/src/server/agents/prompts/rag_system.yml', 'retrieval_generation')
-    prompt = template.render(preprocessed_context=preprocessed_context, question=question)
-    return prompt
+    return render_messages('/app/apps/api/src/server/agents/prompts/rag_system.yml', 'retrieval_generation',
+                           preprocessed_context=preprocessed_context, question=question)
 
 @traceable(name="generate_llm_response",
 description="Generate a response from the LLM using the prompt",
@@ -126,28 +386,45 @@ metadata={"ls_provider": "openai", "ls_model_name": "gpt-5-nano"}
 )
 def generate_llm_response(prompt, model="gpt-4.1-mini"):
     
-    client = instructor.from_openai(openai.OpenAI())
+    messages = [{"role": "system", "content": prompt}] if isinstance(prompt, str) else prompt
     
-    response, raw_response = client.chat.completions.create_with_completion(
+    response, _ = structured_completion(
+        RAGResponse,
+        messages,
         model=model,
-        messages=[
-            {"role": "system", "content": prompt},
-        ],
-        response_model=RAGResponse
+        node="generate_llm_response",
+        prompt_cache_key="retrieval_generation"
     )
-    
-    current_run = get_current_run_tree()
-    
-    if current_run:
-        current_run.metadata["usage_metadata"] = {
-            "input_tokens": raw_response.usage.prompt_tokens,
-            "output_tokens": raw_response.usage.completion_tokens,
-            "total_tokens": raw_response.usage.total_tokens,
-            "model": model
-        }
         
     return response
 
+# The pipeline's stages, shared by the API and the evals (which cache around them), so a change
+# to a stage is what both run: retrieve_context -> generate_answer, or select_context ->
+# generate_answer on candidates retrieved in a batch.
+
+def retrieve_context(qdrant_client: QdrantClient, question, top_k=10, rerank_top_n=5):
+    """Hybrid search with the question's constraints, then select_context. Returns (candidates, reranked)."""
+    retrieved_context = retrieve_embedding_data(
+        qdrant_client,
+        question,
+        collection_name=config.collection_name,
+        k=candidate_count(top_k),
+        constraints=extract_constraints(question)
+    )
+    return select_context(question, retrieved_context, top_k, rerank_top_n)
+
+def select_context(question, retrieved_context: RetrievalResult, top_k=None, rerank_top_n=5):
+    """Near-duplicate collapsing and rerank of retrieved candidates. Returns (candidates, reranked)."""
+    # collapse near-duplicate variants so they don't take rerank and prompt slots
+    retrieved_context = dedup_retrieved_context(retrieved_context, top_k)
+    return retrieved_context, rerank_retrieved_context(question, retrieved_context, top_n=rerank_top_n)
+
+def generate_answer(question, reranked_context: RetrievalResult, model="gpt-4.1-mini") -> RAGResponse:
+    """Packs the reranked context into the prompt and generates the answer."""
+    formatted_context = format_context(reranked_context, question, model)
+    prompt = build_prompt(formatted_context, question)
+    return generate_llm_response(prompt, model)
+
 @traceable(
     name="integrated_rag_pipeline",
     description="Integrate the RAG pipeline for a given question",
@@ -157,77 +434,133 @@ def integrated_rag_pipeline(question, model="gpt-4.1-mini", top_k=10):
     qdrant_client = QdrantClient(   
         url=config.qdrant_url,
     )
-    # Step 1: Retrieve relevant context
-    retrieved_context = retrieve_embedding_data(
-        qdrant_client,
-        question,
-        collection_name="amazon_items-collection-hybrid-02",
-        k=top_k
-    )
-    # step 1.1: Rerank the retrieved context
-    reranked_context = rerank_retrieved_context(question, retrieved_context)
-    
-    # Step 2: Format context
-    formatted_context = format_context(reranked_context)   
-    # Step 3: Build prompt
-    prompt = build_prompt(formatted_context, question)
-    # Step 4: Generate response
-    response = generate_llm_response(prompt, model)
-    
-    final_response = {
+    retrieved_context, reranked_context = retrieve_context(qdrant_client, question, top_k)
+    return pipeline_result(question, retrieved_context, reranked_context, generate_answer(question, reranked_context, model))
+
+def answer_from_retrieved_context(question, retrieved_context: RetrievalResult, model="gpt-4.1-mini", top_k=None):
+    retrieved_context, reranked_context = select_context(question, retrieved_context, top_k)
+    return pipeline_result(question, retrieved_context, reranked_context, generate_answer(question, reranked_context, model))
+
+def pipeline_result(question, retrieved_context: RetrievalResult, reranked_context: RetrievalResult,
+                    response: RAGResponse):
+    # plain JSON data, the result is traced and read by the evals
+    return {
         "question": question,
         "answer": response.answer,
-        "references": response.references,
-        "retrieved_context_ids": retrieved_context["context_ids"],
-        "retrieved_context": retrieved_context["context"],
-        "similarity_scores": retrieved_context["scores"],
+        "references": [reference.model_dump() for reference in response.references],
+        "retrieved_context_ids": retrieved_context.context_ids,
+        "retrieved_context": retrieved_context.context,
+        "similarity_scores": retrieved_context.scores,
+        "reranked_context": reranked_context.to_records(),
     }
-        
-    return final_response
 
 def rag_pipeline_wrapper(question, top_k=10):
     
-    qdrant_client = QdrantClient(   
-        url=config.qdrant_url,
+    result = pipeline_flight.do(
+        (question.strip().lower(), top_k),
+        integrated_rag_pipeline,
+        question,
+        model="gpt-4.1-mini",
+        top_k=top_k
     )
     
-    result = integrated_rag_pipeline(question, model="gpt-4.1-mini", top_k=top_k)
-    
+    return {
+        "answer": result.get("answer", ""),
+        "used_context": get_used_context(result),
+    }
+
+def get_used_context(result, qdrant_client=None):
     used_context = []
+    reranked = {record["id"]: record for record in result["reranked_context"]}
     
-    dummy_vector = np.zeros(1536).tolist()
-        
+    # the reranked products already carry image and price, only the others are looked up
     for item in result.get("references"):
-        payload = qdrant_client.query_points(
-            collection_name="amazon_items-collection-hybrid-02",
-            query=dummy_vector,
-            limit=1,
-            with_payload=True,
-            using="text-embedding-3-small",
-            with_vectors=False,
-            query_filter=Filter(
-                must=[
-                    FieldCondition(
-                        key="parent_asin",
-                        match=MatchValue(value=item.id)
+        payload = reranked.get(item["id"])
+        if payload is None:
+            qdrant_client = qdrant_client or QdrantClient(url=config.qdrant_url)
+            payload = get_product_metadata(qdrant_client, item["id"])
+        if payload and payload.get("image"):
+            used_context.append({
+                "id": item["id"],
+                "description": item["description"],
+                "image_url": thumbnail_url(item["id"], payload["image"]),
+                "price": payload.get("price")
+            })
+    
+    return used_context
+
+def _batch_outcome(future):
+    if future.cancelled():
+        return RequestCancelledError("The client disconnected")
+    return future.exception() or future.result()
+
+@traceable(
+    name="integrated_rag_pipeline_batch",
+    description="Run the RAG pipeline for many questions, yielding each result as it finishes",
+)
+def integrated_rag_pipeline_batch(questions, model="gpt-4.1-mini", top_k=10, max_concurrency=8,
+                                  deadline: Optional[Deadline] = None):
+    """
+    Embeds and searches the questions in groups, then reranks and generates with at most
+    `max_concurrency` questions in flight. Yields (index, result_or_exception) in completion order.
+    Every question runs within `deadline`; once it is cancelled the questions not started yet
+    are dropped and the running ones stop at their next upstream call.
+    """
+    qdrant_client = QdrantClient(   
+        url=config.qdrant_url,
+    )
+    chunk_size = config.embedding_batch_size
+    
+    with ContextThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = {}
+        if deadline is not None:
+            deadline.on_cancel(lambda: [future.cancel() for future in list(pending)])
+        for start in range(0, len(questions), chunk_size):
+            if deadline is not None and deadline.cancelled:
+                break
+            chunk = questions[start:start + chunk_size]
+            # set and reset between two yields, the generator may resume on another thread
+            with deadline_scope(deadline):
+                failure = None
+                try:
+                    retrieved_contexts = retrieve_embedding_data_batch(
+                        qdrant_client,
+                        chunk,
+                        collection_name=config.collection_name,
+                        k=candidate_count(top_k),
+                        constraints=[extract_constraints(question) for question in chunk]
                     )
-                ]
-            )
-        )
-        if payload.points[0].payload["parent_asin"]:
-            image_url = payload.points[0].payload.get("image", None)
-            price = payload.points[0].payload.get("price", None)
-            if image_url:
-                used_context.append({
-                    "id": item.id,
-                    "description": item.description,
-                    "image_url": image_url,
-                    "price": price
-                })
+                except Exception as e:
+                    failure = e
+                else:
+                    # the workers copy this context, deadline included
+                    for offset, (question, retrieved_context) in enumerate(zip(chunk, retrieved_contexts)):
+                        future = executor.submit(answer_from_retrieved_context, question, retrieved_context,
+                                                 model, top_k)
+                        pending[future] = start + offset
+            if failure is not None:
+                for offset in range(len(chunk)):
+                    yield start + offset, failure
+                continue
             
-    return {
-        "answer": result.get("answer", ""),
-        "used_context": used_context,
-    }
+            # stream whatever already finished while the next chunk is retrieved
+            for future in [f for f in pending if f.done()]:
+                yield pending.pop(future), _batch_outcome(future)
+        
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), _batch_outcome(future)
+
+def rag_pipeline_batch_wrapper(questions, top_k=10, deadline: Optional[Deadline] = None):
     
-    
\ No newline at end of file
+    for index, result in integrated_rag_pipeline_batch(questions, model="gpt-4.1-mini", top_k=top_k,
+                                                      max_concurrency=config.batch_max_concurrency,
+                                                      deadline=deadline):
+        if isinstance(result, Exception):
+            yield {"index": index, "question": questions[index], "error": str(result)}
+            continue
+        yield {
+            "index": index,
+            "question": questions[index],
+            "answer": result.get("answer", ""),
+            "used_context": get_used_context(result),
+        }
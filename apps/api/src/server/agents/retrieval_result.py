@@ -0,0 +1,135 @@
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class RetrievalResult:
+    """
+    Columnar container for the products returned by a retrieval.
+
+    The payload columns are filled once from the Qdrant points and never copied again.
+    Reranking and truncation only produce a new index array (`order`) over the same columns,
+    so every stage of the pipeline shares a single copy of the descriptions and payloads.
+    """
+
+    __slots__ = ("_ids", "_descriptions", "_ratings", "_prices", "_images", "_scores", "_order", "_vectors")
+
+    def __init__(
+        self,
+        ids: List[str],
+        descriptions: List[str],
+        ratings: List[Optional[float]],
+        prices: List[Optional[float]],
+        images: List[Optional[str]],
+        scores: array,
+        order: Optional[array] = None,
+        vectors: Optional[np.ndarray] = None,
+    ):
+        self._ids = ids
+        self._descriptions = descriptions
+        self._ratings = ratings
+        self._prices = prices
+        self._images = images
+        self._scores = scores
+        self._order = order if order is not None else array("i", range(len(ids)))
+        # dense vectors (numpy rows aligned with the columns), only when the search returned them
+        self._vectors = vectors
+
+    @classmethod
+    def from_points(cls, points: Iterable[Any]) -> "RetrievalResult":
+        ids, descriptions, ratings, prices, images, vectors = [], [], [], [], [], []
+        scores = array("d")
+        for point in points:
+            if point.vector is not None:
+                # named vectors come back as {name: vector} with only the requested one
+                vectors.append(next(iter(point.vector.values())) if isinstance(point.vector, dict) else point.vector)
+            payload = point.payload
+            ids.append(payload["parent_asin"])
+            # the compact snippet when the search selected it, the full text otherwise
+            descriptions.append(payload.get("llm_snippet") or payload.get("description", ""))
+            ratings.append(payload.get("average_rating"))
+            prices.append(payload.get("price"))
+            images.append(payload.get("image"))
+            scores.append(point.score)
+        matrix = np.asarray(vectors, dtype=np.float32) if vectors and len(vectors) == len(ids) else None
+        return cls(ids, descriptions, ratings, prices, images, scores, vectors=matrix)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def take(self, indices: Sequence[int]) -> "RetrievalResult":
+        """Returns a view ordered by `indices`, which are positions in this result."""
+        order = array("i", (self._order[i] for i in indices))
+        return RetrievalResult(self._ids, self._descriptions, self._ratings, self._prices,
+                               self._images, self._scores, order, self._vectors)
+
+    def head(self, n: int) -> "RetrievalResult":
+        return RetrievalResult(self._ids, self._descriptions, self._ratings, self._prices,
+                               self._images, self._scores, self._order[:n], self._vectors)
+
+    @property
+    def context_ids(self) -> List[str]:
+        return [self._ids[i] for i in self._order]
+
+    @property
+    def context(self) -> List[str]:
+        return [self._descriptions[i] for i in self._order]
+
+    @property
+    def scores(self) -> List[float]:
+        return [self._scores[i] for i in self._order]
+
+    @property
+    def vectors(self) -> Optional[np.ndarray]:
+        """Dense vectors in the current order, None when the search did not return them."""
+        if self._vectors is None:
+            return None
+        return self._vectors[list(self._order)]
+
+    @property
+    def context_ratings(self) -> List[Optional[float]]:
+        return [self._ratings[i] for i in self._order]
+
+    def rows(self) -> Iterator[Tuple[str, str, Optional[float]]]:
+        """Yields (id, description, rating) in the current order."""
+        for i in self._order:
+            yield self._ids[i], self._descriptions[i], self._ratings[i]
+
+    def get_payload(self, product_id: str) -> Optional[Dict[str, Any]]:
+        """Looks up the image and price of a product held by this result."""
+        for i in self._order:
+            if self._ids[i] == product_id:
+                return {"image": self._images[i], "price": self._prices[i]}
+        return None
+
+    def to_dict(self) -> Dict[str, list]:
+        return {
+            "context_ids": self.context_ids,
+            "context": self.context,
+            "scores": self.scores,
+            "context_ratings": self.context_ratings,
+            "prices": [self._prices[i] for i in self._order],
+            "images": [self._images[i] for i in self._order],
+        }
+
+    def to_records(self) -> List[Dict[str, Any]]:
+        """One plain dict per product in the current order, for outputs that leave the pipeline."""
+        return [
+            {"id": self._ids[i], "description": self._descriptions[i], "rating": self._ratings[i],
+             "price": self._prices[i], "image": self._images[i], "score": self._scores[i]}
+            for i in self._order
+        ]
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, list]) -> "RetrievalResult":
+        """Rebuilds a result serialized with to_dict (e.g. from a cache)."""
+        n = len(data["context_ids"])
+        return cls(
+            list(data["context_ids"]),
+            list(data["context"]),
+            list(data["context_ratings"]),
+            list(data.get("prices") or [None] * n),
+            list(data.get("images") or [None] * n),
+            array("d", data["scores"]),
+        )
@@ -0,0 +1,200 @@
+import re
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langsmith import traceable, get_current_run_tree
+from langsmith.utils import ContextThreadPoolExecutor
+from qdrant_client import QdrantClient
+from qdrant_client.models import Document, Filter, QueryRequest
+
+from server.agents.utils.profiling import profiled
+from server.agents.utils.rate_limiting import get_limiter
+from server.core.cache import get_cache
+from server.core.config import config
+from server.core.metrics import metrics
+
+RRF_K = 2  # Qdrant's server-side RRF constant, so a single shard ranks exactly like before
+OTHER_SHARD = "other"
+FAMILY_KEY = "family_key"  # payload key shared by the variants of one product, see dedup.family_key
+
+registry_cache = get_cache("shard_registry", ttl=300, shared=False)
+
+
+def shard_key(category: Optional[str]) -> str:
+    """Collection-safe key of a main_category, e.g. "Cell Phones & Accessories" -> "cell-phones-accessories"."""
+    key = re.sub(r"[^a-z0-9]+", "-", (category or "").lower()).strip("-")
+    return key or OTHER_SHARD
+
+
+def shard_collection(base_collection: str, shard: str) -> str:
+    return f"{base_collection}-{shard}"
+
+
+def registry_collection(base_collection: str) -> str:
+    return f"{base_collection}-shards"
+
+
+class ShardRegistry:
+    """
+    Shard collections of a sharded catalogue with the normalized centroid of each shard's
+    dense embeddings. The centroids are the query-to-category predictor: the query embedding
+    is already computed for the dense search, so routing costs one small matrix product.
+    """
+
+    def __init__(self, collections: List[str], centroids: np.ndarray, counts: List[int]):
+        self.collections = collections
+        self.centroids = centroids
+        self.counts = counts
+
+    @classmethod
+    def load(cls, qd_client: QdrantClient, base_collection: str, vector_name: str) -> "ShardRegistry":
+        """Centroids are stored per embedding model, `vector_name` picks the space queries are embedded in."""
+        points, _ = get_limiter("qdrant").call(
+            qd_client.scroll,
+            collection_name=registry_collection(base_collection),
+            limit=10000,
+            with_payload=True,
+            with_vectors=[vector_name],
+        )
+        if not points:
+            raise ValueError(f"No shards registered for {base_collection}, run the sharded ingestion first")
+        points = sorted(points, key=lambda point: point.payload["collection"])
+        return cls(
+            collections=[point.payload["collection"] for point in points],
+            centroids=np.asarray([point.vector[vector_name] for point in points], dtype=np.float32),
+            counts=[point.payload.get("count", 0) for point in points],
+        )
+
+    def predict(self, embedding: Sequence[float], max_fanout: int, min_coverage: float,
+                temperature: float) -> Optional[List[str]]:
+        """
+        Smallest set of most likely shards whose probability mass reaches `min_coverage`,
+        or None when that would take more than `max_fanout` shards.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        logits = self.centroids @ query / temperature
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        order = np.argsort(-probabilities)
+        needed = int(np.searchsorted(np.cumsum(probabilities[order]), min_coverage)) + 1
+        if needed > max_fanout:
+            return None
+        return [self.collections[i] for i in order[:needed]]
+
+
+def get_shard_registry(qd_client: QdrantClient, base_collection: str,
+                       vector_name: str = "text-embedding-3-small") -> ShardRegistry:
+    return registry_cache.get_or_compute(
+        (base_collection, vector_name), lambda: ShardRegistry.load(qd_client, base_collection, vector_name)
+    )
+
+
+def lookup_collections(qd_client: QdrantClient, base_collection: str) -> List[str]:
+    """Collections that may hold a given product: every shard, or the single collection."""
+    if not config.sharding_enabled:
+        return [base_collection]
+    return get_shard_registry(qd_client, base_collection).collections
+
+
+def rrf_merge(branches: Dict[str, List[Any]], k: int, prefetch_limit: int,
+              group_by: Optional[str] = None) -> List[Any]:
+    """
+    Global reciprocal rank fusion of the dense and BM25 candidates gathered from every shard.
+    Each branch is cut to the same `prefetch_limit` a single collection would use, so the
+    merged ranking does not depend on how many shards were searched. With `group_by` only the
+    best-ranked point of each payload value is kept, like Qdrant's grouped search.
+    """
+    fused: Dict[str, float] = {}
+    points: Dict[str, Any] = {}
+    for candidates in branches.values():
+        ranked = sorted(candidates, key=lambda point: point.score, reverse=True)[:prefetch_limit]
+        for rank, point in enumerate(ranked):
+            product_id = point.payload["parent_asin"]
+            fused[product_id] = fused.get(product_id, 0.0) + 1.0 / (rank + RRF_K)
+            points[product_id] = point
+    top, seen = [], set()
+    for product_id in sorted(fused, key=fused.get, reverse=True):
+        group = points[product_id].payload.get(group_by, product_id) if group_by else product_id
+        if group in seen:
+            continue
+        seen.add(group)
+        top.append(product_id)
+        if len(top) == k:
+            break
+    return [points[product_id].model_copy(update={"score": fused[product_id]}) for product_id in top]
+
+
+def _search_shard(qd_client: QdrantClient, collection: str, queries: List[str], embeddings: List[Any],
+                  query_filters: List[Optional[Filter]], prefetch_limit: int, vector_name: str,
+                  with_vectors: Any = False, with_payload: Any = True) -> List[Any]:
+    requests = []
+    for query, embedding, query_filter in zip(queries, embeddings, query_filters):
+        requests.append(QueryRequest(query=embedding, using=vector_name, filter=query_filter,
+                                     limit=prefetch_limit, with_payload=with_payload, with_vector=with_vectors))
+        requests.append(QueryRequest(query=Document(text=query, model="qdrant/bm25"), using="bm25",
+                                     filter=query_filter, limit=prefetch_limit, with_payload=with_payload,
+                                     with_vector=with_vectors))
+    return get_limiter("qdrant").call(qd_client.query_batch_points, collection_name=collection, requests=requests)
+
+
+@traceable(name="search_shards",
+description="Route queries to their most likely category shards, search them in parallel and merge with RRF",
+run_type="retriever"
+)
+def search_shards(qd_client: QdrantClient, base_collection: str, queries: List[str], embeddings: List[Any],
+                  k: int = 10, prefetch_limit: int = 20,
+                  query_filters: Optional[List[Optional[Filter]]] = None,
+                  vector_name: str = "text-embedding-3-small", with_vectors: Any = False, with_payload: Any = True,
+                  group_by: Optional[str] = None) -> List[List[Any]]:
+    """Returns the merged top-k points of every query, in the order of `queries`."""
+    query_filters = query_filters or [None] * len(queries)
+    registry = get_shard_registry(qd_client, base_collection, vector_name)
+    routes = [
+        registry.predict(embedding, config.shard_max_fanout, config.shard_min_coverage, config.shard_temperature)
+        for embedding in embeddings
+    ]
+    # no confident prediction: fall back to searching all shards
+    fallbacks = sum(route is None for route in routes)
+    routes = [registry.collections if route is None else route for route in routes]
+
+    # group queries by shard so each shard gets one batched request per chunk of queries
+    by_shard: Dict[str, List[int]] = defaultdict(list)
+    for i, route in enumerate(routes):
+        for collection in route:
+            by_shard[collection].append(i)
+
+    candidates = [{"dense": [], "bm25": []} for _ in queries]
+    chunk_size = config.search_batch_size
+    with ContextThreadPoolExecutor(max_workers=max(1, min(len(registry.collections),
+                                                          config.qdrant_max_concurrency))) as executor:
+        futures = {}
+        search_shard = profiled(_search_shard)
+        for collection, indices in by_shard.items():
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                future = executor.submit(search_shard, qd_client, collection, [queries[i] for i in chunk],
+                                         [embeddings[i] for i in chunk], [query_filters[i] for i in chunk],
+                                         prefetch_limit, vector_name, with_vectors, with_payload)
+                futures[future] = chunk
+        for future, chunk in futures.items():
+            responses = future.result()
+            for offset, i in enumerate(chunk):
+                candidates[i]["dense"].extend(responses[2 * offset].points)
+                candidates[i]["bm25"].extend(responses[2 * offset + 1].points)
+
+    for collection, indices in by_shard.items():
+        metrics.increment("shard_queries_total", len(indices), collection=collection)
+    metrics.increment("shard_fallbacks_total", fallbacks)
+
+    current_run = get_current_run_tree()
+
+    if current_run:
+        current_run.metadata["sharding"] = {
+            "shards_total": len(registry.collections),
+            "shards_searched": [len(route) for route in routes],
+            "fallbacks": fallbacks,
+        }
+
+    return [rrf_merge(branches, k, prefetch_limit, group_by) for branches in candidates]
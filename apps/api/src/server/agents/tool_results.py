@@ -0,0 +1,112 @@
+from typing import Any, Dict, List
+
+import numpy as np
+from langchain_core.messages import ToolMessage
+from qdrant_client.models import FieldCondition, Filter, MatchValue
+
+from server.agents.context_packing import count_tokens
+from server.agents.models import ProductRef
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.sharding import lookup_collections
+from server.agents.utils.rate_limiting import get_limiter
+from server.core.cache import get_cache
+from server.core.config import config
+
+PRODUCT_LINE = "Product ID: {id} - Description: {description} - Rating: {rating}"
+
+# full payloads of the products the tools returned, keyed by parent_asin
+product_store = get_cache("tool_products")
+product_metadata_cache = get_cache("product_metadata")
+
+
+def get_product_metadata(qdrant_client, product_id, refresh=False):
+    """
+    Looks up the payload of a product by parent_asin, through the shared product metadata cache.
+    With refresh=True it is read from Qdrant again and the cached entry replaced (after re-ingestion).
+    """
+    def _fetch():
+        stored = None if refresh else product_store.get(product_id)
+        if stored:
+            # the agent's tool call already fetched it
+            return stored
+        dummy_vector = np.zeros(1536).tolist()
+        # with sharding the product's category is unknown here, so look through every shard
+        for collection_name in lookup_collections(qdrant_client, config.collection_name):
+            payload = get_limiter("qdrant").call(
+                qdrant_client.query_points,
+                collection_name=collection_name,
+                query=dummy_vector,
+                limit=1,
+                with_payload=["parent_asin", "image", "price"],
+                using="text-embedding-3-small",
+                with_vectors=False,
+                query_filter=Filter(
+                    must=[
+                        FieldCondition(
+                            key="parent_asin",
+                            match=MatchValue(value=product_id)
+                        )
+                    ]
+                )
+            )
+            if payload.points:
+                return payload.points[0].payload
+        return None
+
+    if refresh:
+        payload = _fetch()
+        if payload is not None:
+            product_metadata_cache.set(product_id, payload)
+        return payload
+    return product_metadata_cache.get_or_compute(product_id, _fetch)
+
+
+def short_title(description: str, max_tokens: int, model: str = "gpt-4.1-mini") -> str:
+    """First sentence of a description, cut on a word boundary to `max_tokens`."""
+    title = (description or "").split(". ", 1)[0]
+    while count_tokens(title, model) > max_tokens and " " in title:
+        title = title.rsplit(" ", 1)[0]
+    return title
+
+
+def store_products(retrieved_context: RetrievalResult) -> List[Dict[str, Any]]:
+    """
+    Writes the payload of every product to the product store and returns the compact
+    references kept in graph state (plain dicts, so the checkpointer stores them as JSON).
+    """
+    refs = []
+    for item_id, description, rating in retrieved_context.rows():
+        payload = retrieved_context.get_payload(item_id)
+        product_store.set(item_id, {"parent_asin": item_id, "description": description,
+                                    "average_rating": rating, **payload})
+        refs.append(ProductRef(
+            id=item_id,
+            title=short_title(description, config.tool_result_title_tokens),
+            rating=rating,
+            price=payload["price"],
+        ).model_dump())
+    return refs
+
+
+def render_refs(refs: List[Dict[str, Any]]) -> str:
+    return "\n".join(PRODUCT_LINE.format(id=ref["id"], description=ref["title"], rating=ref["rating"])
+                     for ref in refs)
+
+
+def compact_history(messages: List[Any]) -> List[Any]:
+    """
+    Returns the history with every tool result the agent has already seen reduced to one
+    short line per product, rebuilt from the ToolMessage artifact. Only the trailing tool
+    results (the ones this iteration answers) are sent in full. Results written before
+    the tools returned artifacts are left as they are.
+    """
+    fresh = len(messages)
+    while fresh > 0 and isinstance(messages[fresh - 1], ToolMessage):
+        fresh -= 1
+
+    compacted = []
+    for message in messages[:fresh]:
+        if isinstance(message, ToolMessage) and message.artifact:
+            message = message.model_copy(update={"content": render_refs(message.artifact)})
+        compacted.append(message)
+    return compacted + list(messages[fresh:])
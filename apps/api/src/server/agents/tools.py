@@ -1,120 +1,142 @@
 from langchain_core.tools import tool
 from qdrant_client import QdrantClient
-from qdrant_client.models import Document, Prefetch, FusionQuery
-import openai
 from langsmith import traceable, get_current_run_tree
-import json
-from typing import List
-from server.agents.reranker import get_reranker
+from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple
+from langgraph.prebuilt import InjectedState
+from server.agents.retrieval_generation import (
+    candidate_count,
+    dedup_retrieved_context,
+    retrieve_embedding_data,
+    rerank_retrieved_context,
+)
+from server.agents.context_packing import pack_context
+from server.agents.tool_results import PRODUCT_LINE, short_title, store_products
+from server.agents.query_constraints import QueryConstraints, extract_constraints
 from server.core.config import config
+from server.core.query_log import query_log
+from server.agents.utils.priority import current_priority
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.models import ProductRef
+from server.agents.working_set import search_working_set as find_in_working_set
 
-@traceable(
-    name="generate_embeddings",
-    description="Generate embeddings for a given query or text using OpenAI's text-embedding-3-small model",   
-    run_type="embedding",
-    metadata={"ls_provider": "openai", "ls_model": "text-embedding-3-small"}
-)
-def create_embeddings(text, model="text-embedding-3-small"):
-    response = openai.embeddings.create(
-        model=model,
-        input=text
+def search_products(qd_client: QdrantClient, query: str, constraints: QueryConstraints, k: int = 5) -> RetrievalResult:
+    """The agent's product search: hybrid retrieval, near-duplicate collapsing and rerank (also run by the cache warmup)."""
+    retrieved_context = retrieve_embedding_data(
+        qd_client,
+        query,
+        collection_name=config.collection_name,
+        k=candidate_count(k),
+        constraints=constraints
+    )
+
+    retrieved_context = dedup_retrieved_context(retrieved_context, k=k)
+
+    return rerank_retrieved_context(query, retrieved_context, top_n=k)
+
+def retrieve_embedding(query: str, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                       min_rating: Optional[float] = None, min_rating_count: Optional[int] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Retrieves a list of relevant product context strings from a Qdrant database using hybrid search (embedding and BM25 fusion) based on the given user query.
+
+    Args:
+        query (str): The user's search query for desired product(s).
+        min_price (Optional[float]): Lowest price in dollars the user accepts, if they gave one.
+        max_price (Optional[float]): Highest price in dollars the user accepts, e.g. 50 for "under $50".
+        min_rating (Optional[float]): Lowest average star rating (1-5) the user accepts, e.g. 4 for "at least 4 stars".
+        min_rating_count (Optional[int]): Lowest number of customer ratings the user accepts.
+
+    Returns:
+        Tuple[str, List[Dict[str, Any]]]: The text shown to the assistant, one line per product formatted as
+            'Product ID: <ASIN> - Description: <description> - Rating: <rating>', and the product references
+            kept in the conversation state.
+    """
+
+    # constraints passed by the agent win over the ones parsed from the query text
+    constraints = extract_constraints(query).merge(QueryConstraints(
+        min_price=min_price,
+        max_price=max_price,
+        min_rating=min_rating,
+        min_rating_count=min_rating_count,
+    ))
+    query_log.record("search", query, priority=current_priority(), **constraints.model_dump(exclude_none=True))
+
+    return _retrieve_embedding(query, constraints)
+
+# traced here rather than on the tool itself: @traceable adds a `config` argument to the
+# signature, which the tool schema would then show the model
+@traceable(name="retrieve_embedding",
+           description="Search the products and pack them into the agent's tool result",
+           run_type="retriever")
+def _retrieve_embedding(query: str, constraints: QueryConstraints) -> Tuple[str, List[Dict[str, Any]]]:
+    qd_client = QdrantClient(url=config.qdrant_url)
+    reranked_context = search_products(qd_client, query, constraints)
+
+    packed_context = pack_context(
+        reranked_context,
+        query=query,
+        model="gpt-4.1-mini",
+        template=PRODUCT_LINE,
+        token_budget=config.tool_result_token_budget,
     )
     
     current_run = get_current_run_tree()
     
     if current_run:
-        current_run.metadata["usage_metadata"] = {
-            "total_tokens": response.usage.total_tokens,
-            "input_tokens": response.usage.prompt_tokens,
+        current_run.metadata["context_packing"] = {
+            "tokens_before": packed_context.tokens_before,
+            "tokens_after": packed_context.tokens_after,
+            "tokens_saved": packed_context.tokens_saved,
         }
-        
-    return response.data[0].embedding
 
-@traceable(name="rerank_retrieved_context", 
-           description="Rerank the retrieved context using the Cohere reranker", 
-           run_type="embedding")
-def rerank_retrieved_context(query,retrieved_context):
-    reranker = get_reranker(provider="cohere")
-    context_list = retrieved_context["context"]
-    reranked_context = reranker.rerank(query=query, documents=context_list, top_n=5)
-    
-    reranked_retrieved_context_ids = []
-    reranked_retrieved_context = []
-    reranked_retrieved_scores = []
-    reranked_retrieved_context_ratings = []
-    
-    for new_context in reranked_context:
-        index = new_context.get("index")
-        reranked_retrieved_context_ids.append(retrieved_context["context_ids"][index])
-        reranked_retrieved_context.append(retrieved_context["context"][index])
-        reranked_retrieved_scores.append(retrieved_context["scores"][index])
-        reranked_retrieved_context_ratings.append(retrieved_context["context_ratings"][index])
-    
-    #return only top 5 results    
-    return {
-        "context_ids": reranked_retrieved_context_ids,
-        "context": reranked_retrieved_context,
-        "scores": reranked_retrieved_scores,
-        "context_ratings": reranked_retrieved_context_ratings
-    }
+    return "\n".join(packed_context.entries), store_products(reranked_context)
 
-def retrieve_embedding(query: str) -> List[str]:
+def search_working_set(state: Annotated[Any, InjectedState], query: Optional[str] = None,
+                       product_ids: Optional[List[str]] = None, min_price: Optional[float] = None,
+                       max_price: Optional[float] = None, min_rating: Optional[float] = None,
+                       sort_by: Optional[Literal["relevance", "price", "rating"]] = None, descending: bool = False,
+                       limit: int = 5) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    Retrieves a list of relevant product context strings from a Qdrant database using hybrid search (embedding and BM25 fusion) based on the given user query.
+    Looks up the products already retrieved earlier in this conversation, without a new search. Use it first for follow-ups about those products (e.g. "which of those is cheapest?", "does the second one have Bluetooth?").
 
     Args:
-        query (str): The user's search query for desired product(s).
+        query (Optional[str]): Feature words the products must mention, e.g. "bluetooth". Leave empty to consider all of them.
+        product_ids (Optional[List[str]]): Only these product IDs, e.g. the ones the user is referring to.
+        min_price (Optional[float]): Lowest price in dollars.
+        max_price (Optional[float]): Highest price in dollars.
+        min_rating (Optional[float]): Lowest average star rating (1-5).
+        sort_by (Optional[str]): "price", "rating" or "relevance" (the default when a query is given).
+        descending (bool): Sort from the highest value, e.g. true for the best rated.
+        limit (int): Maximum number of products returned.
 
     Returns:
-        List[str]: Each string contains the product ID, description, and average rating, formatted as:
-            'Product ID: <ASIN> - Description: <description> - Rating: <rating>'
+        Tuple[str, List[Dict[str, Any]]]: The text shown to the assistant, one line per product formatted as
+            'Product ID: <ASIN> - Description: <description> - Rating: <rating> - Price: <price>', and the product
+            references kept in the conversation state.
     """
+    working_set = state.working_set if hasattr(state, "working_set") else state["working_set"]
+    return _search_working_set(working_set, query=query, product_ids=product_ids, min_price=min_price,
+                               max_price=max_price, min_rating=min_rating, sort_by=sort_by,
+                               descending=descending, limit=limit)
+
+@traceable(name="search_working_set",
+           description="Look up the products already retrieved in this thread",
+           run_type="retriever")
+def _search_working_set(working_set: Any, **filters) -> Tuple[str, List[Dict[str, Any]]]:
+    positions = find_in_working_set(working_set, **filters)
     
-    qd_client = QdrantClient(url=config.qdrant_url)
-    
-    collection_name = "amazon_items-collection-hybrid-02"
-    k=5
+    current_run = get_current_run_tree()
     
-    querry_embeddings = create_embeddings(query)
+    if current_run:
+        current_run.metadata["working_set"] = {"size": len(working_set.ids), "matches": len(positions)}
     
-    response = qd_client.query_points(
-        collection_name=collection_name,
-        prefetch=[Prefetch(
-            query=querry_embeddings,
-            using="text-embedding-3-small",
-            limit=20),
-            Prefetch(
-                query=Document(text=query, model="qdrant/bm25"),
-                using="bm25",
-                limit=20)
-            ],
-        query=FusionQuery(fusion="rrf"),
-        limit=k,
-    )
-    retrieved_context_ids = []
-    retrieved_context = []
-    retrieved_scores = []
-    retrieved_context_ratings = []
+    if not positions:
+        return "No product retrieved earlier in this conversation matches, search with retrieve_embedding.", []
     
-    for point in response.points:
-        retrieved_context_ids.append(point.payload["parent_asin"])
-        retrieved_context.append(point.payload["description"])
-        retrieved_scores.append(point.score)
-        retrieved_context_ratings.append(point.payload["average_rating"])
-        
-    retrieved_context_data = {
-        "context_ids": retrieved_context_ids,
-        "context": retrieved_context,
-        "scores": retrieved_scores,
-        "context_ratings": retrieved_context_ratings
-    }
-
-    reranked_context = rerank_retrieved_context(query, retrieved_context_data)
-
-    reranked_retrieved_contextdata = []
-    for item, context, rating in zip(reranked_context["context_ids"], 
-                                     reranked_context["context"], reranked_context["context_ratings"]):
-        product_context = f"Product ID: {item} - Description: {context} - Rating: {rating}"
-        reranked_retrieved_contextdata.append(product_context)
-
-    return reranked_retrieved_contextdata
\ No newline at end of file
+    lines, refs = [], []
+    for i in positions:
+        description = working_set.descriptions[i]
+        lines.append(f"{PRODUCT_LINE.format(id=working_set.ids[i], description=description, rating=working_set.ratings[i])}"
+                     f" - Price: {working_set.prices[i]}")
+        refs.append(ProductRef(id=working_set.ids[i], title=short_title(description, config.tool_result_title_tokens),
+                               rating=working_set.ratings[i], price=working_set.prices[i]).model_dump())
+    return "\n".join(lines), refs
@@ -0,0 +1,98 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a request's time budget runs out before its work is done."""
+
+
+class RequestCancelledError(RuntimeError):
+    """Raised in the worker threads of a request whose client has gone away."""
+
+
+class Deadline:
+    """
+    Time budget of one request, shared by every thread working on it.
+
+    The endpoint creates it and cancels it when the client disconnects. Upstream calls read
+    the remaining budget as their timeout and stop admitting new work once it is spent or
+    cancelled; an HTTP call already in flight ends at its own timeout.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._on_cancel: List[Callable[[], None]] = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """Calls `callback` when the deadline is cancelled, right away if it already is."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise RequestCancelledError("The client disconnected")
+        if self.expired:
+            raise DeadlineExceededError(f"Request deadline of {self.timeout:.1f}s exceeded")
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """
+    Makes `deadline` the current one for this thread and everything that copies its context
+    (ContextThreadPoolExecutor, LangGraph node executors).
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def check_deadline() -> None:
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def remaining_time(default: Optional[float] = None) -> Optional[float]:
+    """The smaller of `default` and the current deadline's remaining budget (None when neither is set)."""
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    return deadline.remaining() if default is None else min(default, deadline.remaining())
@@ -0,0 +1,31 @@
+from langsmith import get_current_run_tree
+from server.core.metrics import metrics
+
+
+def record_llm_usage(raw_response, model, node, report_run=True):
+    """
+    Reports the token usage of a chat completion to the current LangSmith run and to metrics,
+    including the prompt tokens OpenAI served from its prefix cache. Callers that are not
+    their own traced run pass report_run=False, so a parent run's usage is not overwritten.
+    """
+    usage = getattr(raw_response, "usage", None)
+    if usage is None:
+        return
+    
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    
+    metrics.increment("llm_prompt_tokens_total", usage.prompt_tokens, node=node, model=model)
+    metrics.increment("llm_cached_prompt_tokens_total", cached_tokens, node=node, model=model)
+    metrics.increment("llm_completion_tokens_total", usage.completion_tokens, node=node, model=model)
+    
+    current_run = get_current_run_tree() if report_run else None
+    
+    if current_run:
+        current_run.metadata["usage_metadata"] = {
+            "input_tokens": usage.prompt_tokens,
+            "output_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+            "input_token_details": {"cache_read": cached_tokens},
+            "model": model
+        }
@@ -0,0 +1,160 @@
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Mapping, Optional
+
+from server.core.config import config
+from server.core.metrics import metrics
+
+# highest priority first
+PRIORITY_CLASSES = ("interactive", "background", "eval")
+DEFAULT_PRIORITY = "interactive"
+
+_current_priority: contextvars.ContextVar[str] = contextvars.ContextVar("priority", default=DEFAULT_PRIORITY)
+
+
+def current_priority() -> str:
+    return _current_priority.get()
+
+
+@contextmanager
+def priority_scope(priority: str) -> Iterator[str]:
+    """Runs the calls made in this context (and the threads that copy it) in `priority`'s class."""
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class {priority!r}, expected one of {PRIORITY_CLASSES}")
+    token = _current_priority.set(priority)
+    try:
+        yield priority
+    finally:
+        _current_priority.reset(token)
+
+
+def resolve_priority(headers: Mapping[str, str], default: str = DEFAULT_PRIORITY) -> str:
+    """
+    Class of a request. A known X-API-Key sets the highest class the caller may use, without
+    one it is the route's `default`; the X-Priority header can ask for that class or a lower
+    one, never a higher one.
+    """
+    api_key = headers.get("X-API-Key")
+    known_key = api_key in config.priority_api_keys
+    ceiling = config.priority_api_keys[api_key] if known_key else default
+    requested = headers.get("X-Priority", "").strip().lower()
+    if requested not in PRIORITY_CLASSES:
+        # a known key without the header runs in its own class
+        requested = ceiling if known_key else default
+    return max(requested, ceiling, key=PRIORITY_CLASSES.index)
+
+
+class PrioritySlots:
+    """
+    Concurrency slots of one upstream, shared by the priority classes.
+
+    A class may hold at most its share of the slots and queue at most its queue limit; beyond
+    that the call is rejected right away. A freed slot goes to the highest class with a call
+    waiting. Lower classes never take the slots reserved for interactive traffic, and while the
+    recent interactive queue wait is above the SLO that reserve grows to half of the slots,
+    so background and eval calls are held back until interactive latency recovers.
+    """
+
+    def __init__(self, name: str, capacity: int, shares: Mapping[str, float], max_queued: Mapping[str, int],
+                 reserved_fraction: float = 0.25, wait_slo: float = 0.2, decay_seconds: float = 5.0):
+        self.name = name
+        self.capacity = capacity
+        self.limits = {cls: max(1, math.floor(capacity * shares.get(cls, 1.0))) for cls in PRIORITY_CLASSES}
+        self.max_queued = {cls: max_queued.get(cls, capacity) for cls in PRIORITY_CLASSES}
+        self.reserved = min(capacity - 1, math.ceil(capacity * reserved_fraction))
+        self.wait_slo = wait_slo
+        self.decay_seconds = decay_seconds
+        self.in_use: Dict[str, int] = {cls: 0 for cls in PRIORITY_CLASSES}
+        self.waiting: Dict[str, int] = {cls: 0 for cls in PRIORITY_CLASSES}
+        self._interactive_wait = 0.0
+        self._interactive_wait_at = time.monotonic()
+        self._lock = threading.Lock()
+        # one condition per class, so a freed slot wakes one waiter of the class it goes to
+        self._conditions = {cls: threading.Condition(self._lock) for cls in PRIORITY_CLASSES}
+
+    def interactive_wait(self) -> float:
+        """Moving average of the interactive queue wait, decaying when no interactive call arrives."""
+        age = time.monotonic() - self._interactive_wait_at
+        return self._interactive_wait * math.exp(-age / self.decay_seconds)
+
+    def slo_at_risk(self) -> bool:
+        return self.interactive_wait() > self.wait_slo
+
+    def _hold_back_remaining(self) -> float:
+        """Seconds until the interactive wait has decayed to the SLO, which ends the hold-back."""
+        wait = self.interactive_wait()
+        if wait <= self.wait_slo:
+            return 0.0
+        if self.wait_slo <= 0:
+            return math.inf
+        return self.decay_seconds * math.log(wait / self.wait_slo)
+
+    def _admissible(self, priority: str) -> bool:
+        rank = PRIORITY_CLASSES.index(priority)
+        if any(self.waiting[cls] for cls in PRIORITY_CLASSES[:rank]):
+            return False
+        if self.in_use[priority] >= self.limits[priority]:
+            return False
+        free = self.capacity - sum(self.in_use.values())
+        if rank == 0:
+            return free > 0
+        reserved = max(self.reserved, self.capacity // 2) if self.slo_at_risk() else self.reserved
+        return free > reserved
+
+    def _wake(self) -> None:
+        """Wakes one waiter of the highest class with calls waiting, if it can take a slot now."""
+        for cls in PRIORITY_CLASSES:
+            if self.waiting[cls]:
+                # the classes below it are not admitted while it waits
+                if self._admissible(cls):
+                    self._conditions[cls].notify()
+                return
+
+    def acquire(self, priority: str, timeout: float) -> Optional[bool]:
+        """
+        Takes a slot for `priority` within `timeout` seconds. Returns False on timeout and
+        None when the class's queue is full.
+        """
+        start = time.monotonic()
+        with self._lock:
+            if not self._admissible(priority):
+                if self.waiting[priority] >= self.max_queued[priority]:
+                    return None
+                self.waiting[priority] += 1
+                metrics.set("upstream_queue_depth", self.waiting[priority], upstream=self.name, priority=priority)
+                try:
+                    deadline = start + timeout
+                    admitted = True
+                    while not self._admissible(priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            admitted = False
+                            break
+                        if priority != PRIORITY_CLASSES[0] and self.slo_at_risk():
+                            # no release marks the end of the hold-back, it ends as the interactive wait decays
+                            remaining = min(remaining, self._hold_back_remaining() + 0.001)
+                        self._conditions[priority].wait(remaining)
+                finally:
+                    self.waiting[priority] -= 1
+                    metrics.set("upstream_queue_depth", self.waiting[priority], upstream=self.name,
+                                priority=priority)
+                if not admitted:
+                    # a lower class may have been held back by this waiter
+                    self._wake()
+                    return False
+            self.in_use[priority] += 1
+            if priority == PRIORITY_CLASSES[0]:
+                wait = time.monotonic() - start
+                self._interactive_wait = 0.8 * self.interactive_wait() + 0.2 * wait
+                self._interactive_wait_at = time.monotonic()
+            # slots left over go to the next waiter
+            self._wake()
+            return True
+
+    def release(self, priority: str) -> None:
+        with self._lock:
+            self.in_use[priority] -= 1
+            self._wake()
@@ -0,0 +1,316 @@
+"""On-demand sampling profiles of single requests.
+
+A request is profiled when it carries a valid X-Profile-Token header, or arrives while an
+admin has opened a profiling window on this worker. Its pipeline then runs with a sampler
+thread that records the stacks of the threads working on it, labelled with the LangGraph
+node or tool they are running, and a callback that measures each node's and tool's wall and
+CPU time. Pool threads a request hands work to are sampled when the work is wrapped with
+`profiled`. The
+result is written to PROFILING_DIR as <request_id>.collapsed (collapsed stacks, for
+flamegraph.pl or speedscope) and <request_id>.json (per-node wall vs CPU, hottest frames).
+
+Requests that are not profiled only pay for one header lookup. Mint a token with:
+
+    python -m server.agents.utils.profiling --ttl 600
+"""
+
+import argparse
+import contextvars
+import functools
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, TypeVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from server.core.config import config
+from server.core.metrics import metrics
+
+_requested_profile: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("requested_profile", default=None)
+_current_profile: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("profile", default=None)
+
+# end of the profiling window opened on this worker (time.monotonic())
+_window_until = 0.0
+_active = threading.BoundedSemaphore(config.profiling_max_concurrent)
+
+
+def _sign(expires: int) -> str:
+    return hmac.new(config.profiling_secret.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+
+
+def make_token(ttl: float) -> str:
+    expires = int(time.time() + ttl)
+    return f"{expires}.{_sign(expires)}"
+
+
+def verify_token(token: Optional[str]) -> bool:
+    """A token is "<expires>.<hmac of expires>", signed with PROFILING_SECRET (unset disables profiling)."""
+    if not config.profiling_secret or not token:
+        return False
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _sign(int(expires)))
+
+
+def open_window(seconds: float) -> float:
+    """Profiles every request this worker receives for the next `seconds`. Returns the seconds granted."""
+    global _window_until
+    seconds = min(seconds, config.profiling_max_window_seconds)
+    _window_until = time.monotonic() + seconds
+    return seconds
+
+
+def wants_profile(headers: Mapping[str, str]) -> bool:
+    return time.monotonic() < _window_until or verify_token(headers.get("X-Profile-Token"))
+
+
+@contextmanager
+def request_profiling(profile_id: Optional[str]) -> Iterator[None]:
+    """Asks for the pipeline run in this context (see `profile_scope`) to be profiled as `profile_id`."""
+    token = _requested_profile.set(profile_id)
+    try:
+        yield
+    finally:
+        _requested_profile.reset(token)
+
+
+def current_profile() -> Optional["RequestProfile"]:
+    return _current_profile.get()
+
+
+def _collapse(frame: Any) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    """Stack samples and per-node timings of one request."""
+
+    def __init__(self, profile_id: str, interval: float):
+        self.profile_id = profile_id
+        self.interval = interval
+        # thread ident -> label of what it is running for the request ("request" or a node name)
+        self.threads: Dict[int, str] = {}
+        self.stacks: Counter = Counter()
+        self.nodes: Dict[str, Dict[str, float]] = defaultdict(lambda: {"calls": 0, "wall_seconds": 0.0,
+                                                                        "cpu_seconds": 0.0})
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{profile_id}", daemon=True)
+
+    def attach(self, label: str) -> Optional[str]:
+        """Samples the calling thread under `label`, returns its previous label to restore."""
+        ident = threading.get_ident()
+        with self._lock:
+            previous = self.threads.get(ident)
+            self.threads[ident] = label
+        return previous
+
+    def label(self) -> Optional[str]:
+        """Label the calling thread is sampled under, None if it is not attached."""
+        with self._lock:
+            return self.threads.get(threading.get_ident())
+
+    def detach(self, previous: Optional[str]) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            if previous is None:
+                self.threads.pop(ident, None)
+            else:
+                self.threads[ident] = previous
+
+    def record(self, label: str, wall: float, cpu: float) -> None:
+        with self._lock:
+            node = self.nodes[label]
+            node["calls"] += 1
+            node["wall_seconds"] += wall
+            node["cpu_seconds"] += cpu
+
+    def start(self) -> None:
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self.threads.items())
+            for ident, label in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[f"{label};{_collapse(frame)}"] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> Dict[str, Any]:
+        leaves: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(self.stacks.values())
+        return {
+            "profile_id": self.profile_id,
+            "interval_seconds": self.interval,
+            "samples": total,
+            # wall much larger than cpu: the node was waiting (upstream calls, locks, pool threads)
+            "nodes": {label: {**timing, "wait_seconds": max(0.0, timing["wall_seconds"] - timing["cpu_seconds"])}
+                      for label, timing in self.nodes.items()},
+            "top_frames": [{"frame": frame, "share": round(count / total, 4)}
+                           for frame, count in leaves.most_common(20)] if total else [],
+        }
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.profile_id}.collapsed"), "w") as file:
+            file.write(self.collapsed())
+        with open(os.path.join(directory, f"{self.profile_id}.json"), "w") as file:
+            json.dump(self.summary(), file, indent=2)
+        _prune(directory)
+
+
+def _prune(directory: str) -> None:
+    profiles = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(directory)
+                      if entry.name.endswith(".json"))
+    for _, path in profiles[:max(0, len(profiles) - config.profiling_max_files)]:
+        for stale in (path, path[:-len(".json")] + ".collapsed"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory: str = config.profiling_dir) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    profiles = sorted(((entry.stat().st_mtime, entry.name[:-len(".json")]) for entry in os.scandir(directory)
+                       if entry.name.endswith(".json")), reverse=True)
+    return [profile_id for _, profile_id in profiles]
+
+
+class NodeTimingHandler(BaseCallbackHandler):
+    """
+    Times each LangGraph node and each tool call on the thread that runs it and labels that
+    thread's samples. ToolNode runs every tool call on a pool thread of its own, which only the
+    tool callbacks see.
+    """
+
+    def __init__(self, profile: RequestProfile):
+        self.profile = profile
+        self._runs: Dict[Any, tuple] = {}
+
+    def _start(self, run_id, label: str) -> None:
+        self._runs[run_id] = (label, time.perf_counter(), time.thread_time(), self.profile.attach(label))
+
+    def _finish(self, run_id) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        label, wall_start, cpu_start, previous = run
+        self.profile.record(label, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+        self.profile.detach(previous)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # the node's own run, not the runnables nested in it
+        if node and kwargs.get("name") == node:
+            self._start(run_id, node)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, tags=None, metadata=None,
+                      **kwargs):
+        tool = kwargs.get("name") or (serialized or {}).get("name", "tool")
+        node = (metadata or {}).get("langgraph_node")
+        self._start(run_id, f"{node}/{tool}" if node else tool)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def profiled(fn: F) -> F:
+    """
+    `fn` sampled under the calling thread's label wherever it runs, for work handed to a thread
+    pool. Wrap it on the submitting thread; returns `fn` itself when no profile is running.
+    """
+    profile = current_profile()
+    if profile is None:
+        return fn
+    label = profile.label() or "request"
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        previous = profile.attach(label)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.detach(previous)
+
+    return run
+
+
+def graph_callbacks() -> List[BaseCallbackHandler]:
+    """Callbacks to run the graph with: the node timer while a profile is running, none otherwise."""
+    profile = current_profile()
+    return [NodeTimingHandler(profile)] if profile is not None else []
+
+
+@contextmanager
+def profile_scope(label: str = "request") -> Iterator[Optional[RequestProfile]]:
+    """Profiles the work done in this block if the request asked for it (see `request_profiling`)."""
+    profile_id = _requested_profile.get()
+    if profile_id is None or current_profile() is not None or not _active.acquire(blocking=False):
+        yield None
+        return
+    profile = RequestProfile(profile_id, config.profiling_interval_seconds)
+    token = _current_profile.set(profile)
+    previous = profile.attach(label)
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        profile.record(label, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+        profile.detach(previous)
+        _current_profile.reset(token)
+        _active.release()
+        profile.save(config.profiling_dir)
+        metrics.increment("requests_profiled_total")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ttl", type=float, default=600, help="seconds the token stays valid")
+    args = parser.parse_args()
+    if not config.profiling_secret:
+        parser.error("PROFILING_SECRET is not set, profiling is disabled")
+    print(make_token(args.ttl))
+
+
+if __name__ == "__main__":
+    main()
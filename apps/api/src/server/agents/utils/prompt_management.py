@@ -1,13 +1,38 @@
+import os
 import yaml
 from jinja2 import Template
 from langsmith import Client
+from server.core.cache import get_cache
 
 ls_client = Client()
 
+# compiled templates are not picklable, keep them in the in-process tier only
+prompt_cache = get_cache("prompt_templates", ttl=300, shared=False)
+
+def load_prompts(yaml_file_path):
+    """Every prompt of the file compiled once, re-read only when the file's mtime changes."""
+    def _load_templates():
+        with open(yaml_file_path, 'r') as file:
+            config = yaml.safe_load(file)
+        return {key: Template(template) for key, template in config['prompts'].items()}
+    
+    mtime = os.path.getmtime(yaml_file_path)
+    return prompt_cache.get_or_compute((yaml_file_path, mtime), _load_templates)
+
 def get_prompt_from_config(yaml_file_path, prompt_key):
-    with open(yaml_file_path, 'r') as file:
-        config = yaml.safe_load(file)
-    return Template(config['prompts'][prompt_key])
+    return load_prompts(yaml_file_path)[prompt_key]
+
+def render_messages(yaml_file_path, prompt_key, **variables):
+    """
+    Renders `prompt_key` as the system message and `<prompt_key>_input` as the user message.
+    Only the user message carries per-request content, so the system message is a stable
+    prefix that OpenAI can serve from its prompt cache.
+    """
+    prompts = load_prompts(yaml_file_path)
+    messages = [{"role": "system", "content": prompts[prompt_key].render(**variables)}]
+    if f"{prompt_key}_input" in prompts:
+        messages.append({"role": "user", "content": prompts[f"{prompt_key}_input"].render(**variables)})
+    return messages
 
 def read_from_langsmith_registry(prompt_key):
     prompt_obj = ls_client.pull_prompt(prompt_key)
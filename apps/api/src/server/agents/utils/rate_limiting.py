@@ -0,0 +1,216 @@
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+import openai
+
+from server.core.config import config
+from server.core.metrics import metrics
+from server.agents.utils.deadline import current_deadline
+from server.agents.utils.priority import PrioritySlots, current_priority
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# how each upstream client takes a per-call timeout, filled from the request's remaining deadline
+TIMEOUT_ARGUMENTS: Dict[str, Callable[[float], Dict[str, Any]]] = {
+    "openai": lambda seconds: {"timeout": seconds},
+    "qdrant": lambda seconds: {"timeout": max(1, math.ceil(seconds))},
+    "cohere": lambda seconds: {"request_options": {"timeout_in_seconds": max(1, math.ceil(seconds))}},
+}
+
+
+class UpstreamRejectedError(RuntimeError):
+    """Raised when a call could not be admitted to an upstream within the allowed queue wait."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is saturated, retry in {retry_after:.1f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """Reserves one token and returns how long to wait for it, or None if that exceeds max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+def _upstream_error(error: BaseException) -> BaseException:
+    """Unwraps errors re-raised by client wrappers (e.g. instructor) down to the upstream error."""
+    while error.__cause__ is not None and _status_code(error) is None:
+        error = error.__cause__
+    return error
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    error = _upstream_error(error)
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError,
+                          openai.APIConnectionError)):
+        return True
+    return _status_code(error) in RETRYABLE_STATUS_CODES
+
+
+class UpstreamLimiter:
+    """
+    Admission control for one upstream (OpenAI, Cohere, Qdrant).
+
+    Each attempt must get a concurrency slot and a rate token within `max_queue_wait` seconds,
+    otherwise UpstreamRejectedError is raised. The slots are shared by the priority classes
+    (see PrioritySlots), the rate tokens are first come, first served. Retryable failures (429, 5xx, timeouts) are retried
+    with full-jitter exponential backoff, or after the server's Retry-After when it sends one.
+    Within a request deadline the queue wait, the call timeout and the retries are all bounded
+    by the remaining budget, and nothing new is started once the request is cancelled.
+    """
+
+    def __init__(self, name: str, rate: float, max_concurrency: int, max_queue_wait: float = 10.0,
+                 max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 20.0,
+                 timeout_arguments: Optional[Callable[[float], Dict[str, Any]]] = None):
+        self.name = name
+        self.bucket = TokenBucket(rate=rate, capacity=max(1.0, rate))
+        self.slots = PrioritySlots(
+            name,
+            max_concurrency,
+            shares=config.priority_slot_shares,
+            max_queued=config.priority_max_queued,
+            reserved_fraction=config.priority_reserved_fraction,
+            wait_slo=config.interactive_queue_wait_slo,
+        )
+        self.max_queue_wait = max_queue_wait
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout_arguments = timeout_arguments
+
+    def _check_deadline(self, deadline) -> None:
+        if deadline is None:
+            return
+        try:
+            deadline.check()
+        except Exception:
+            metrics.increment("upstream_calls_abandoned_total", upstream=self.name,
+                              reason="cancelled" if deadline.cancelled else "deadline")
+            raise
+
+    @contextmanager
+    def _admit(self, deadline=None):
+        start = time.monotonic()
+        priority = current_priority()
+        max_wait = self.max_queue_wait if deadline is None else min(self.max_queue_wait, deadline.remaining())
+        admitted = self.slots.acquire(priority, timeout=max_wait)
+        if admitted is None:
+            metrics.increment("upstream_rejections_total", upstream=self.name, reason="queue_depth",
+                              priority=priority)
+            raise UpstreamRejectedError(self.name, self.base_delay)
+        if not admitted:
+            self._check_deadline(deadline)
+            metrics.increment("upstream_rejections_total", upstream=self.name, reason="concurrency",
+                              priority=priority)
+            raise UpstreamRejectedError(self.name, self.base_delay)
+        try:
+            wait = self.bucket.reserve(max_wait - (time.monotonic() - start))
+            if wait is None:
+                self._check_deadline(deadline)
+                metrics.increment("upstream_rejections_total", upstream=self.name, reason="rate",
+                                  priority=priority)
+                raise UpstreamRejectedError(self.name, 1 / self.bucket.rate)
+            if wait > 0:
+                time.sleep(wait)
+            metrics.observe("upstream_queue_wait_seconds", time.monotonic() - start, upstream=self.name,
+                            priority=priority)
+            yield
+        finally:
+            self.slots.release(priority)
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        deadline = current_deadline()
+        attempt = 0
+        while True:
+            self._check_deadline(deadline)
+            with self._admit(deadline):
+                if deadline is not None and self.timeout_arguments is not None:
+                    kwargs.update(self.timeout_arguments(deadline.remaining()))
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if attempt >= self.max_retries or not is_retryable(e):
+                        metrics.increment("upstream_errors_total", upstream=self.name)
+                        raise
+                    delay = _retry_after(_upstream_error(e))
+                    if delay is None:
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    delay = min(delay, self.max_delay)
+                    if deadline is not None and delay >= deadline.remaining():
+                        # the retry could not finish in time, fail now with the upstream's error
+                        metrics.increment("upstream_errors_total", upstream=self.name)
+                        raise
+            # back off outside the slot so waiting retries do not hold concurrency
+            metrics.increment("upstream_retries_total", upstream=self.name)
+            attempt += 1
+            time.sleep(delay)
+
+
+_limiters: Dict[str, UpstreamLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(upstream: str) -> UpstreamLimiter:
+    """Returns the process-wide limiter for "openai", "cohere" or "qdrant"."""
+    with _limiters_lock:
+        if upstream not in _limiters:
+            _limiters[upstream] = UpstreamLimiter(
+                name=upstream,
+                rate=getattr(config, f"{upstream}_requests_per_second"),
+                max_concurrency=getattr(config, f"{upstream}_max_concurrency"),
+                max_queue_wait=config.upstream_max_queue_wait,
+                max_retries=config.upstream_max_retries,
+                timeout_arguments=TIMEOUT_ARGUMENTS.get(upstream),
+            )
+        return _limiters[upstream]
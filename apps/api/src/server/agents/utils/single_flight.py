@@ -0,0 +1,75 @@
+import threading
+from typing import Any, Callable, Hashable, Optional
+from server.core.metrics import metrics
+from server.agents.utils.deadline import (
+    DeadlineExceededError,
+    RequestCancelledError,
+    check_deadline,
+    remaining_time,
+)
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "shared")
+
+    def __init__(self, shared: Any = None):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = shared
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls.
+
+    The first caller for a key runs the function; callers arriving while it is in flight wait
+    for it (up to `timeout` seconds, or their own request deadline) and share its result or
+    re-raise its error. If the leader's request was cancelled or ran out of time, the waiting
+    callers run the call again instead of inheriting that failure. Nothing is cached once the
+    call completes.
+
+    The leader may attach a `shared` object to its call; each caller that joins it is handed
+    that object through `on_follow` before it starts waiting (e.g. to follow its progress).
+    """
+
+    def __init__(self, name: str, timeout: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, timeout: Optional[float] = None,
+           shared: Any = None, on_follow: Optional[Callable[[Any], None]] = None, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call(shared)
+                self._calls[key] = call
+
+        if not is_leader:
+            metrics.increment("single_flight_coalesced_total", operation=self.name)
+            if on_follow is not None:
+                on_follow(call.shared)
+            if not call.event.wait(remaining_time(timeout if timeout is not None else self.timeout)):
+                check_deadline()
+                metrics.increment("single_flight_timeouts_total", operation=self.name)
+                raise TimeoutError(f"Timed out waiting for the in-flight {self.name} call")
+            if isinstance(call.error, (RequestCancelledError, DeadlineExceededError)):
+                check_deadline()
+                return self.do(key, fn, *args, timeout=timeout, shared=shared, on_follow=on_follow, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
@@ -0,0 +1,165 @@
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar
+
+import instructor
+from instructor.core.hooks import Hooks
+from langsmith import get_current_run_tree
+from openai import OpenAI
+from pydantic import BaseModel, ValidationError
+
+from server.agents.utils.llm_usage import record_llm_usage
+from server.agents.utils.rate_limiting import get_limiter
+from server.core.config import config
+from server.core.metrics import metrics
+
+T = TypeVar("T", bound=BaseModel)
+
+# keywords strict mode rejects or ignores, dropped from the compiled schemas
+_DROPPED_KEYWORDS = {"title", "default"}
+
+
+class StructuredOutputError(RuntimeError):
+    """Raised when the model refuses, or still returns invalid output after the allowed retries."""
+
+
+def _strict(node: Any) -> Any:
+    if isinstance(node, list):
+        return [_strict(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    compiled = {}
+    for key, value in node.items():
+        if key in _DROPPED_KEYWORDS:
+            continue
+        if key in ("properties", "$defs"):
+            # names of fields and models, not keywords
+            compiled[key] = {name: _strict(child) for name, child in value.items()}
+        else:
+            compiled[key] = _strict(value)
+    if compiled.get("type") == "object":
+        if "properties" not in compiled or compiled.get("additionalProperties") not in (None, False):
+            # strict mode has no free-form objects, the model writes them as a JSON string instead
+            # (the pydantic model decodes it, see Toolcall.arguments)
+            description = f"{compiled.get('description', '')} A JSON-encoded object.".strip()
+            return {"type": "string", "description": description}
+        compiled["additionalProperties"] = False
+        compiled["required"] = list(compiled["properties"])
+    return compiled
+
+
+@lru_cache(maxsize=None)
+def response_format(response_model: Type[BaseModel]) -> Dict[str, Any]:
+    """The strict JSON-schema response format of `response_model`, compiled once per model."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_model.__name__,
+            "schema": _strict(response_model.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+_client: Optional[OpenAI] = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    """One client, and so one connection pool, for every structured call (the limiter does the retrying)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(max_retries=0)
+        return _client
+
+
+def _record_attempt(raw_response: Any, model: str, node: str, attempt: int, report_run: bool) -> None:
+    record_llm_usage(raw_response, model, node=node, report_run=report_run)
+    usage = getattr(raw_response, "usage", None)
+    if attempt > 0 and usage is not None:
+        metrics.increment("llm_structured_retry_tokens_total", usage.total_tokens, node=node, model=model)
+
+
+def _native_completion(response_model: Type[T], messages: List[Dict[str, Any]], model: str, node: str,
+                       max_retries: int, report_run: bool, **kwargs) -> Tuple[T, Any, int]:
+    messages = list(messages)
+    for attempt in range(max_retries + 1):
+        raw_response = get_limiter("openai").call(
+            get_openai_client().chat.completions.create,
+            model=model,
+            messages=messages,
+            response_format=response_format(response_model),
+            **kwargs,
+        )
+        _record_attempt(raw_response, model, node, attempt, report_run)
+        message = raw_response.choices[0].message
+        if message.refusal:
+            raise StructuredOutputError(f"{model} refused to answer: {message.refusal}")
+
+        start = time.perf_counter()
+        try:
+            response = response_model.model_validate_json(message.content or "")
+            return response, raw_response, attempt
+        except ValidationError as e:
+            # a strict schema only fails on truncated output or on checks beyond the schema
+            error = e
+            truncated = raw_response.choices[0].finish_reason == "length"
+            metrics.increment("llm_structured_retries_total", node=node, model=model,
+                              reason="truncated" if truncated else "validation")
+            messages += [
+                {"role": "assistant", "content": message.content or ""},
+                {"role": "user", "content": f"The response did not validate: {e}. Answer again with valid JSON."},
+            ]
+        finally:
+            metrics.observe("llm_structured_parse_seconds", time.perf_counter() - start, node=node)
+    raise StructuredOutputError(f"No valid {response_model.__name__} after {max_retries + 1} attempts: {error}")
+
+
+def _instructor_completion(response_model: Type[T], messages: List[Dict[str, Any]], model: str, node: str,
+                           max_retries: int, report_run: bool, **kwargs) -> Tuple[T, Any, int]:
+    # instructor re-asks on validation errors inside one call, the hooks make those retries visible.
+    # It adds up the usage of all attempts on the last response, so each one is copied as it arrives
+    attempts = []
+    hooks = Hooks()
+    hooks.on("completion:response", lambda raw_response: attempts.append(raw_response.model_copy(deep=True)))
+    hooks.on("parse:error", lambda error: metrics.increment("llm_structured_retries_total", node=node, model=model,
+                                                            reason="validation"))
+    client = instructor.from_openai(get_openai_client())
+    response, raw_response = get_limiter("openai").call(
+        client.chat.completions.create_with_completion,
+        model=model,
+        response_model=response_model,
+        messages=messages,
+        max_retries=max_retries + 1,
+        hooks=hooks,
+        **kwargs,
+    )
+    for attempt, attempt_response in enumerate(attempts):
+        _record_attempt(attempt_response, model, node, attempt, report_run and attempt == len(attempts) - 1)
+    return response, raw_response, max(0, len(attempts) - 1)
+
+
+def structured_completion(response_model: Type[T], messages: List[Dict[str, Any]], model: str, node: str,
+                          provider: str = "openai", max_retries: Optional[int] = None, report_run: bool = True,
+                          **kwargs) -> Tuple[T, Any]:
+    """
+    Chat completion parsed into `response_model`. Providers with strict structured outputs get
+    the precompiled JSON schema and the reply is validated here; the others go through
+    instructor. Both count retries (llm_structured_retries_total) and the tokens spent on them
+    (llm_structured_retry_tokens_total) per node, and record every attempt's token usage.
+    Returns the parsed response and the last raw completion.
+    """
+    max_retries = config.structured_output_max_retries if max_retries is None else max_retries
+    complete = _native_completion if provider in config.structured_output_native_providers else _instructor_completion
+    start = time.perf_counter()
+    response, raw_response, retries = complete(response_model, messages, model, node, max_retries, report_run,
+                                               **kwargs)
+    metrics.observe("llm_structured_call_seconds", time.perf_counter() - start, node=node,
+                    mode="native" if complete is _native_completion else "instructor")
+
+    current_run = get_current_run_tree() if report_run else None
+    if current_run:
+        current_run.metadata["structured_output_retries"] = retries
+    return response, raw_response
@@ -0,0 +1,125 @@
+import random
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import langsmith
+from langsmith import Client
+from langsmith.utils import tracing_is_enabled
+from pydantic import BaseModel
+
+from server.agents.retrieval_result import RetrievalResult
+from server.core.config import config
+from server.core.metrics import metrics
+
+# inputs and outputs carrying the retrieved product context, sent as their size only
+CONTEXT_KEYS = {"preprocessed_context", "retrieved_context", "reranked_context", "documents", "context", "prompt"}
+_MAX_DEPTH = 6
+
+
+def _size(value: Any) -> int:
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, RetrievalResult):
+        return sum(len(description) for description in value.context)
+    if isinstance(value, BaseModel):
+        return _size(value.model_dump())
+    return 0
+
+
+def cap_payload(value: Any, depth: int = 0) -> Any:
+    """
+    Copy of a span's inputs or outputs small enough to export cheaply: long strings are cut
+    at trace_max_string_chars, long lists at trace_max_list_items, retrieval results become
+    their product ids, and context keys above trace_redact_min_chars are replaced by their size.
+    """
+    if isinstance(value, str):
+        if len(value) <= config.trace_max_string_chars:
+            return value
+        return value[:config.trace_max_string_chars] + f"... <{len(value) - config.trace_max_string_chars} more chars>"
+    if isinstance(value, RetrievalResult):
+        return {"products": len(value), "ids": value.context_ids[:config.trace_max_list_items]}
+    if depth >= _MAX_DEPTH:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, BaseModel):
+        value = value.model_dump()
+    if isinstance(value, dict):
+        capped = {}
+        for key, item in value.items():
+            size = _size(item) if key in CONTEXT_KEYS else 0
+            capped[key] = f"<redacted: {size} chars>" if size > config.trace_redact_min_chars else cap_payload(item, depth + 1)
+        return capped
+    if isinstance(value, (list, tuple)):
+        capped = [cap_payload(item, depth + 1) for item in value[:config.trace_max_list_items]]
+        if len(value) > config.trace_max_list_items:
+            capped.append(f"<{len(value) - config.trace_max_list_items} more items>")
+        return capped
+    return value
+
+
+def _export_failed(error: Exception) -> None:
+    metrics.increment("trace_export_errors_total")
+
+
+def make_tracing_client(**client_kwargs: Any) -> Client:
+    """
+    LangSmith client that caps the spans on the request thread and queues them; the client's
+    background thread serializes and sends them in batches.
+    """
+    return Client(
+        hide_inputs=cap_payload,
+        hide_outputs=cap_payload,
+        auto_batch_tracing=True,
+        omit_traced_runtime_info=True,
+        max_batch_size_bytes=config.trace_max_batch_bytes,
+        tracing_error_callback=_export_failed,
+        **client_kwargs,
+    )
+
+
+_client: Optional[Client] = None
+_client_lock = threading.Lock()
+
+
+def get_tracing_client() -> Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = make_tracing_client()
+        return _client
+
+
+def flush_traces() -> None:
+    """Sends the spans still queued, at shutdown."""
+    if _client is not None:
+        _client.flush()
+
+
+def sample_rate(route: str, priority: str) -> float:
+    rate = config.trace_route_sample_rates.get(route.rstrip("/"))
+    return rate if rate is not None else config.trace_sample_rates.get(priority, 1.0)
+
+
+@contextmanager
+def request_tracing(route: str, priority: str, client: Optional[Client] = None) -> Iterator[bool]:
+    """
+    Head-based sampling: the decision is taken once when the request arrives, so every span
+    of a sampled request is exported and an unsampled one creates no run trees at all.
+    """
+    if not tracing_is_enabled():
+        # LANGSMITH_TRACING is off, nothing to sample
+        yield False
+        return
+    sampled = random.random() < sample_rate(route, priority)
+    metrics.increment("requests_traced_total", sampled=str(sampled).lower(), priority=priority)
+    if not sampled:
+        with langsmith.tracing_context(enabled=False):
+            yield False
+    else:
+        # keeps the LANGSMITH_TRACING setting, only sends the spans through the capped client
+        with langsmith.tracing_context(client=client or get_tracing_client()):
+            yield True
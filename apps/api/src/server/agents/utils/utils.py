@@ -1,8 +1,9 @@
 import inspect
 import json
-from typing import Any, Callable, Dict, List
+from typing import Annotated, Any, Callable, Dict, List, get_args, get_origin
 from pydantic import TypeAdapter, create_model, Field
 from langchain_core.messages import AIMessage
+from langchain_core.tools import InjectedToolArg
 from docstring_parser import parse
 
 # #### FORMAT AI MESSAGE (Cleaner approach) ####
@@ -47,6 +48,13 @@ def format_ai_message(response) -> AIMessage:
         tool_calls=tool_calls,
     )
 
+def _is_injected(annotation: Any) -> bool:
+    """Arguments the graph fills in (e.g. InjectedState), which the model must not see."""
+    if get_origin(annotation) is not Annotated:
+        return False
+    return any(isinstance(meta, InjectedToolArg) or (isinstance(meta, type) and issubclass(meta, InjectedToolArg))
+               for meta in get_args(annotation)[1:])
+
 # --- CORE LOGIC (The New Engine) ---
 def _generate_openai_schema(func: Callable) -> Dict[str, Any]:
     """Internal robust generator using Pydantic + Inspect."""
@@ -56,7 +64,7 @@ def _generate_openai_schema(func: Callable) -> Dict[str, Any]:
     
     fields = {}
     for name, param in inspect.signature(func).parameters.items():
-        if name in ('self', 'cls'): 
+        if name in ('self', 'cls') or _is_injected(param.annotation):
             continue
         fields[name] = (
             param.annotation if param.annotation != inspect.Parameter.empty else Any,
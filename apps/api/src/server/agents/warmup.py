@@ -0,0 +1,102 @@
+"""Warm the caches with the most frequent recent searches from the query log.
+
+Every search the agent made in the window (interactive traffic only) is counted, and the top
+ones are run again through the agent's search path, which fills the query embedding, rerank
+and product metadata caches. The searches run in the background priority class, with bounded
+concurrency, inside one overall deadline.
+
+The API runs it at startup when WARMUP_ON_STARTUP is set and only reports ready on /ready
+once it is done. After re-ingesting the catalogue, run it with --refresh so the cached
+product metadata is read from Qdrant again:
+
+    python -m server.agents.warmup --top 200 --window-hours 24 --refresh
+"""
+
+import argparse
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import as_completed
+from typing import Any, Dict, Tuple
+
+from langsmith.utils import ContextThreadPoolExecutor
+from qdrant_client import QdrantClient
+
+from server.agents.graph import get_product_metadata
+from server.agents.query_constraints import QueryConstraints, extract_constraints
+from server.agents.tools import search_products
+from server.agents.utils.deadline import Deadline, DeadlineExceededError, RequestCancelledError, deadline_scope
+from server.agents.utils.priority import priority_scope
+from server.core.config import config
+from server.core.metrics import metrics
+from server.core.query_log import query_log, top_queries
+
+logger = logging.getLogger(__name__)
+
+# set once the startup warmup has finished (or was skipped), read by /ready
+warmup_done = threading.Event()
+
+
+def warm_query(qd_client: QdrantClient, entry: Dict[str, Any], refresh: bool = False) -> int:
+    if entry["kind"] == "search":
+        # the constraints the agent searched with, as logged by the tool
+        constraints = QueryConstraints(**{k: v for k, v in entry.items() if k not in ("kind", "query")})
+    else:
+        constraints = extract_constraints(entry["query"])
+    reranked_context = search_products(qd_client, entry["query"], constraints)
+    for product_id in reranked_context.context_ids:
+        get_product_metadata(qd_client, product_id, refresh=refresh)
+    return len(reranked_context)
+
+
+def warm_caches(top: int = config.warmup_top_queries, window_hours: float = config.warmup_window_hours,
+                concurrency: int = config.warmup_concurrency, timeout: float = config.warmup_timeout_seconds,
+                kinds: Tuple[str, ...] = ("search",), refresh: bool = False) -> Counter:
+    entries = top_queries(query_log.read(since_seconds=window_hours * 3600), kinds=kinds, limit=top,
+                          priorities=("interactive",))
+    qd_client = QdrantClient(url=config.qdrant_url)
+    stats: Counter = Counter()
+    logger.info(f"Warming the caches with {len(entries)} queries")
+
+    with priority_scope("background"), deadline_scope(Deadline(timeout)):
+        with ContextThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(warm_query, qd_client, entry, refresh) for entry, _ in entries]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    stats["warmed"] += 1
+                except (DeadlineExceededError, RequestCancelledError):
+                    stats["timed_out"] += 1
+                except Exception as e:
+                    logger.warning(f"Warmup query failed: {e}")
+                    stats["failed"] += 1
+
+    for outcome in ("warmed", "timed_out", "failed"):
+        metrics.increment("cache_warmup_queries_total", stats[outcome], outcome=outcome)
+    logger.info(f"Cache warmup finished: {dict(stats)}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=config.warmup_top_queries)
+    parser.add_argument("--window-hours", type=float, default=config.warmup_window_hours)
+    parser.add_argument("--concurrency", type=int, default=config.warmup_concurrency)
+    parser.add_argument("--timeout", type=float, default=config.warmup_timeout_seconds,
+                        help="seconds for the whole warmup, unfinished queries are skipped")
+    parser.add_argument("--include-questions", action="store_true",
+                        help="also search the customers' questions verbatim, not only the agent's searches")
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-read cached product metadata from Qdrant, e.g. after re-ingestion")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if not query_log.path:
+        logger.warning("QUERY_LOG_PATH is not set, there are no logged queries to warm the caches with")
+    kinds = ("search", "question") if args.include_questions else ("search",)
+    stats = warm_caches(args.top, args.window_hours, args.concurrency, args.timeout, kinds, args.refresh)
+    print(", ".join(f"{outcome}: {stats[outcome]}" for outcome in ("warmed", "timed_out", "failed")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import re
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import ToolMessage
+
+from server.agents.models import WorkingSet
+from server.agents.tool_results import product_store
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _terms(text: str) -> set:
+    return {w for w in _WORD.findall(text.lower()) if len(w) > 2}
+
+
+def fresh_tool_refs(messages: List[Any]) -> List[Dict[str, Any]]:
+    """Product references of the trailing tool results, the ones the agent is about to read."""
+    start = len(messages)
+    while start > 0 and isinstance(messages[start - 1], ToolMessage):
+        start -= 1
+    return [ref for message in messages[start:] for ref in (message.artifact or [])]
+
+
+def update_working_set(working_set: WorkingSet, refs: List[Dict[str, Any]], max_items: int) -> WorkingSet:
+    """
+    Moves the products of `refs` to the front of the working set, with their payloads from the
+    product store (or the reference itself once the store has evicted them), and drops the
+    least recently used products beyond `max_items`.
+    """
+    columns = (working_set.ids, working_set.descriptions, working_set.prices, working_set.ratings,
+               working_set.images)
+    existing = {item_id: i for i, item_id in enumerate(working_set.ids)}
+    rows, seen = [], set()
+    for ref in refs:
+        if ref["id"] in seen:
+            continue
+        seen.add(ref["id"])
+        if ref["id"] in existing:
+            rows.append(tuple(column[existing[ref["id"]]] for column in columns))
+            continue
+        payload = product_store.get(ref["id"]) or {}
+        rows.append((ref["id"], payload.get("description") or ref["title"], payload.get("price", ref.get("price")),
+                     payload.get("average_rating", ref.get("rating")), payload.get("image")))
+    rows.extend(tuple(column[i] for column in columns) for i, item_id in enumerate(working_set.ids)
+                if item_id not in seen)
+    rows = rows[:max_items]
+    ids, descriptions, prices, ratings, images = (list(column) for column in zip(*rows)) if rows else ([],) * 5
+    return WorkingSet(ids=ids, descriptions=descriptions, prices=prices, ratings=ratings, images=images)
+
+
+def search_working_set(working_set: WorkingSet, query: Optional[str] = None, product_ids: Optional[List[str]] = None,
+                       min_price: Optional[float] = None, max_price: Optional[float] = None,
+                       min_rating: Optional[float] = None, sort_by: Optional[str] = None,
+                       descending: bool = False, limit: int = 5) -> List[int]:
+    """
+    Positions of the working-set products that pass the filters and share a term with `query`,
+    ordered by `sort_by`: "price", "rating" or "relevance" (number of shared terms, the default
+    when a query is given). Without a query or sort key the most recently retrieved come first.
+    Products without a price or rating never pass a filter on it and sort last.
+    """
+    positions = range(len(working_set.ids))
+    if product_ids:
+        wanted = set(product_ids)
+        positions = [i for i in positions if working_set.ids[i] in wanted]
+    if min_price is not None or max_price is not None:
+        positions = [i for i in positions if working_set.prices[i] is not None
+                     and (min_price is None or working_set.prices[i] >= min_price)
+                     and (max_price is None or working_set.prices[i] <= max_price)]
+    if min_rating is not None:
+        positions = [i for i in positions if working_set.ratings[i] is not None
+                     and working_set.ratings[i] >= min_rating]
+
+    if query:
+        query_terms = _terms(query)
+        overlap = {i: len(query_terms & _terms(working_set.descriptions[i])) for i in positions}
+        # products sharing no term with the query are not relevant to it
+        positions = [i for i in positions if overlap[i]]
+
+    sort_by = sort_by or ("relevance" if query else None)
+    if sort_by == "relevance" and query:
+        positions = sorted(positions, key=lambda i: -overlap[i])
+    elif sort_by in ("price", "rating"):
+        column = working_set.prices if sort_by == "price" else working_set.ratings
+        known = sorted((i for i in positions if column[i] is not None), key=lambda i: column[i], reverse=descending)
+        positions = known + [i for i in positions if column[i] is None]
+    return list(positions)[:limit]
@@ -1,8 +1,27 @@
-from fastapi import APIRouter, Request, HTTPException
-from server.api.models import RAGRequest, RAGResponse
+import asyncio
+import httpx
+import json
+import os
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, Request, HTTPException, Response
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from qdrant_client import QdrantClient
+from server.api.models import RAGRequest, RAGResponse, RAGBatchRequest, RAGBatchItem
 import logging
-from server.agents.graph import rag_pipeline_wrapper
+from server.agents.graph import get_product_metadata, rag_pipeline_wrapper
 from server.api.models import RAGUsedContext
+from server.core.metrics import metrics
+from server.agents.utils.rate_limiting import UpstreamRejectedError
+from server.agents.utils.deadline import Deadline, DeadlineExceededError, RequestCancelledError
+from server.agents.retrieval_generation import rag_pipeline_batch_wrapper
+from server.core.config import config
+from server.core.query_log import query_log
+from server.agents.warmup import warmup_done
+from server.agents.utils.priority import current_priority
+from server.agents.utils.single_flight import SingleFlight
+from server.agents.utils.profiling import list_profiles, open_window, verify_token
+from server.core.thumbnails import PRODUCT_ID, content_type, make_thumbnail, thumbnail_headers, thumbnail_store
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -10,12 +29,228 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+def request_deadline(request: Request, default: Optional[float] = None, maximum: Optional[float] = None) -> Deadline:
+    default = config.request_timeout_seconds if default is None else default
+    maximum = config.request_timeout_max_seconds if maximum is None else maximum
+    timeout = request.headers.get("X-Request-Timeout")
+    if timeout is None:
+        return Deadline(default)
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Request-Timeout must be a number of seconds")
+    if timeout <= 0:
+        raise HTTPException(status_code=400, detail="X-Request-Timeout must be positive")
+    return Deadline(min(timeout, maximum))
+
+async def run_until_deadline(request: Request, deadline: Deadline, fn, *args, **kwargs):
+    """
+    Runs the blocking pipeline in the threadpool while watching the client connection.
+
+    A disconnect cancels the deadline and an expired deadline answers 504 right away; in both
+    cases the worker thread stops at its next upstream call instead of finishing the turn.
+    """
+    route = request.url.path
+    task = asyncio.ensure_future(run_in_threadpool(fn, *args, deadline=deadline, **kwargs))
+    # the result of an abandoned run is never awaited, retrieve it so its error is not logged as unhandled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(config.disconnect_poll_interval, deadline.remaining()))
+            if done:
+                return task.result()
+            if deadline.expired:
+                raise DeadlineExceededError(f"Request deadline of {deadline.timeout:.1f}s exceeded")
+            if await request.is_disconnected():
+                deadline.cancel()
+                raise RequestCancelledError("The client disconnected")
+    except DeadlineExceededError as e:
+        metrics.increment("requests_deadline_exceeded_total", route=route)
+        logger.warning(f"Request {request.state.request_id} exceeded its deadline")
+        raise HTTPException(status_code=504, detail=str(e))
+    except RequestCancelledError:
+        metrics.increment("requests_cancelled_total", route=route)
+        logger.info(f"Request {request.state.request_id} cancelled, the client disconnected")
+        # nobody is listening, the status only shows up in the access log
+        raise HTTPException(status_code=499, detail="Client closed request")
+
 @router.post("/")
 async def amazon_product_assistant(request: Request, payload: RAGRequest) -> RAGResponse:
     logger.info(f"Received request: {payload.query} with thread_id: {payload.thread_id}")
-    response = rag_pipeline_wrapper(payload.query, thread_id=payload.thread_id)
+    query_log.record("question", payload.query, priority=current_priority())
+    deadline = request_deadline(request)
+    # the pipeline is blocking, run it off the event loop so concurrent requests can coalesce
+    try:
+        response = await run_until_deadline(request, deadline, rag_pipeline_wrapper, payload.query,
+                                            thread_id=payload.thread_id)
+    except UpstreamRejectedError as e:
+        logger.warning(f"Rejecting request {request.state.request_id}: {e}")
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(max(1, round(e.retry_after)))})
     return RAGResponse(request_id=request.state.request_id, answer=response["answer"], 
                        used_context=[RAGUsedContext(**item) for item in response["used_context"]])
 
+@router.post("/stream")
+async def amazon_product_assistant_stream(request: Request, payload: RAGRequest) -> StreamingResponse:
+    """
+    Same turn as POST /, as NDJSON events: {"event": "step", "node": ...} as each graph node
+    finishes, then {"event": "answer", ...RAGResponse fields} or {"event": "error", "status", "detail"}.
+    """
+    logger.info(f"Received streaming request: {payload.query} with thread_id: {payload.thread_id}")
+    query_log.record("question", payload.query, priority=current_priority())
+    deadline = request_deadline(request)
+    loop = asyncio.get_running_loop()
+    steps: asyncio.Queue = asyncio.Queue()
+
+    def _on_step(node: str) -> None:
+        # called on the pipeline's worker threads
+        loop.call_soon_threadsafe(steps.put_nowait, node)
+
+    def _event(**fields) -> str:
+        return json.dumps(fields) + "\n"
+
+    async def _events():
+        pipeline = asyncio.ensure_future(run_until_deadline(request, deadline, rag_pipeline_wrapper, payload.query,
+                                                            thread_id=payload.thread_id, on_step=_on_step))
+        try:
+            while not pipeline.done():
+                next_step = asyncio.ensure_future(steps.get())
+                await asyncio.wait({pipeline, next_step}, return_when=asyncio.FIRST_COMPLETED)
+                if next_step.done():
+                    yield _event(event="step", node=next_step.result())
+                else:
+                    next_step.cancel()
+            while not steps.empty():
+                yield _event(event="step", node=steps.get_nowait())
+            try:
+                response = pipeline.result()
+            except UpstreamRejectedError as e:
+                yield _event(event="error", status=503, detail=str(e))
+                return
+            except HTTPException as e:
+                yield _event(event="error", status=e.status_code, detail=e.detail)
+                return
+            answer = RAGResponse(request_id=request.state.request_id, answer=response["answer"],
+                                 used_context=[RAGUsedContext(**item) for item in response["used_context"]])
+            yield _event(event="answer", **answer.model_dump())
+        finally:
+            if not pipeline.done():
+                # the response was abandoned (client gone), stop the worker thread too
+                deadline.cancel()
+                pipeline.cancel()
+                metrics.increment("requests_cancelled_total", route=request.url.path)
+
+    return StreamingResponse(_events(), media_type="application/x-ndjson")
+
+@router.post("/batch")
+async def amazon_product_assistant_batch(request: Request, payload: RAGBatchRequest) -> StreamingResponse:
+    if len(payload.queries) > config.batch_max_questions:
+        raise HTTPException(status_code=413, detail=f"At most {config.batch_max_questions} queries per batch")
+    logger.info(f"Received batch request {request.state.request_id} with {len(payload.queries)} queries")
+    priority = current_priority()
+    for query in payload.queries:
+        query_log.record("question", query, priority=priority)
+    deadline = request_deadline(request, default=config.batch_timeout_seconds, maximum=config.batch_timeout_seconds)
+
+    async def _ndjson_lines():
+        finished = False
+        try:
+            # the sync generator is stepped in the threadpool, one line is sent as each answer finishes
+            async for item in iterate_in_threadpool(rag_pipeline_batch_wrapper(payload.queries, deadline=deadline)):
+                yield RAGBatchItem(**item).model_dump_json() + "\n"
+            finished = True
+        finally:
+            if not finished:
+                # the response was abandoned (client gone): drop the questions not started yet
+                deadline.cancel()
+                metrics.increment("requests_cancelled_total", route=request.url.path)
+                logger.info(f"Batch request {request.state.request_id} cancelled, the client disconnected")
+
+    return StreamingResponse(_ndjson_lines(), media_type="application/x-ndjson")
+
+thumbnail_flight = SingleFlight("thumbnail", timeout=2 * config.thumbnail_fetch_timeout)
+
+def load_thumbnail(product_id: str) -> Optional[bytes]:
+    """The product's cached thumbnail, made from its source image on the first request (None if it has none)."""
+    data = thumbnail_store.get(product_id)
+    if data is not None:
+        metrics.increment("thumbnail_requests_total", outcome="hit")
+        return data
+
+    def _make():
+        payload = get_product_metadata(QdrantClient(url=config.qdrant_url), product_id)
+        if not payload or not payload.get("image"):
+            return None
+        thumbnail = make_thumbnail(payload["image"])
+        thumbnail_store.put(product_id, thumbnail)
+        return thumbnail
+
+    metrics.increment("thumbnail_requests_total", outcome="miss")
+    # concurrent requests for the same product share one download
+    return thumbnail_flight.do(product_id, _make)
+
+@router.get("/thumbnails/{product_id}")
+async def product_thumbnail(request: Request, product_id: str) -> Response:
+    if not PRODUCT_ID.fullmatch(product_id):
+        raise HTTPException(status_code=404, detail="Unknown product")
+    try:
+        data = await run_in_threadpool(load_thumbnail, product_id)
+    except (httpx.HTTPError, OSError, ValueError) as e:
+        # OSError covers images Pillow cannot decode
+        logger.warning(f"Thumbnail of {product_id} failed: {e}")
+        metrics.increment("thumbnail_requests_total", outcome="error")
+        raise HTTPException(status_code=502, detail="Could not fetch the product image")
+    if data is None:
+        raise HTTPException(status_code=404, detail="Product has no image")
+
+    headers = thumbnail_headers(data)
+    if_none_match = request.headers.get("If-None-Match", "")
+    if headers["ETag"] in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        metrics.increment("thumbnail_requests_total", outcome="not_modified")
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=content_type(data), headers=headers)
+
+metrics_router = APIRouter()
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    return metrics.render()
+
+health_router = APIRouter()
+
+@health_router.get("/ready")
+async def ready() -> PlainTextResponse:
+    # not ready until the startup cache warmup is done, so the load balancer holds traffic back
+    if not warmup_done.is_set():
+        return PlainTextResponse("warming up", status_code=503)
+    return PlainTextResponse("ready")
+
+def require_profile_token(request: Request) -> None:
+    if not verify_token(request.headers.get("X-Profile-Token")):
+        raise HTTPException(status_code=403, detail="A valid X-Profile-Token is required")
+
+admin_router = APIRouter(dependencies=[Depends(require_profile_token)])
+
+@admin_router.post("/profiling/window")
+async def open_profiling_window(seconds: float = 60.0) -> dict:
+    # per worker: with several workers, only the one that took this request profiles
+    return {"profiling_seconds": open_window(seconds), "pid": os.getpid()}
+
+@admin_router.get("/profiles")
+async def get_profiles() -> dict:
+    return {"profiles": list_profiles()}
+
+@admin_router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: Literal["json", "collapsed"] = "json") -> Response:
+    path = os.path.join(config.profiling_dir, f"{os.path.basename(profile_id)}.{format}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    with open(path) as file:
+        content = file.read()
+    return Response(content=content, media_type="application/json" if format == "json" else "text/plain")
+
 api_router = APIRouter()
 api_router.include_router(router, prefix="/product_assistant", tags=["rag"])
+api_router.include_router(metrics_router, tags=["metrics"])
+api_router.include_router(health_router, tags=["health"])
+api_router.include_router(admin_router, prefix="/admin", tags=["admin"])
@@ -3,11 +3,17 @@ from starlette.middleware.base import BaseHTTPMiddleware
 import uuid
 import logging
 from datetime import datetime
+from server.agents.utils.priority import priority_scope, resolve_priority
+from server.agents.utils.tracing import request_tracing
+from server.agents.utils.profiling import request_profiling, wants_profile
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# bulk endpoints default to the background class, everything else is interactive
+ROUTE_DEFAULT_PRIORITY = {"/product_assistant/batch": "background"}
+
 class RequestIDMiddleware(BaseHTTPMiddleware):
     """ Middleware that adds a unique request ID to each request """
     async def dispatch(self, request: Request, call_next):
@@ -18,3 +24,33 @@ class RequestIDMiddleware(BaseHTTPMiddleware):
         logger.info(f"Request ID: {request.state.request_id} , {request.url.path} completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         return response
     
+
+class PriorityMiddleware(BaseHTTPMiddleware):
+    """ Middleware that runs each request in its priority class (X-API-Key / X-Priority headers) """
+    async def dispatch(self, request: Request, call_next):
+        default = ROUTE_DEFAULT_PRIORITY.get(request.url.path.rstrip("/"), "interactive")
+        request.state.priority = resolve_priority(request.headers, default=default)
+        # the endpoint and the threads it starts copy this context, so their upstream calls queue in the class
+        with priority_scope(request.state.priority):
+            response = await call_next(request)
+        response.headers["X-Priority"] = request.state.priority
+        return response
+
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    """ Middleware that decides once per request whether its spans are traced (added first, runs inside PriorityMiddleware) """
+    async def dispatch(self, request: Request, call_next):
+        priority = getattr(request.state, "priority", "interactive")
+        with request_tracing(request.url.path, priority):
+            return await call_next(request)
+
+
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    """ Middleware that profiles requests with a valid X-Profile-Token, or all of them during a profiling window """
+    async def dispatch(self, request: Request, call_next):
+        if not wants_profile(request.headers):
+            return await call_next(request)
+        with request_profiling(request.state.request_id):
+            response = await call_next(request)
+        response.headers["X-Profile-Id"] = request.state.request_id
+        return response
@@ -24,4 +24,14 @@ class RAGResponse(BaseModel):
     used_context: list[RAGUsedContext] = Field(..., description="used context to answer the question")
     answer: str = Field(..., description="The answer to the question")
     
-    
\ No newline at end of file
+    
+
+class RAGBatchRequest(BaseModel):
+    queries: list[str] = Field(..., min_length=1, description="The questions to answer about amazon products")
+
+class RAGBatchItem(BaseModel):
+    index: int = Field(..., description="Position of the question in the request")
+    question: str = Field(..., description="The question that was answered")
+    answer: Optional[str] = Field(default=None, description="The answer to the question")
+    used_context: list[RAGUsedContext] = Field(default=[], description="used context to answer the question")
+    error: Optional[str] = Field(default=None, description="The error if the question could not be answered")
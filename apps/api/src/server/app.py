@@ -1,8 +1,16 @@
 from fastapi import FastAPI
+import asyncio
 import logging
-from server.api.middleware import RequestIDMiddleware
+import time
+from contextlib import asynccontextmanager
+from server.api.middleware import PriorityMiddleware, ProfilingMiddleware, RequestIDMiddleware, TracingMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from server.api.endpoints import api_router
+from server.core.metrics import metrics
+from server.core.config import config
+from server.agents.warmup import warm_caches, warmup_done
+from server.agents.utils.tracing import flush_traces
+from fastapi.concurrency import run_in_threadpool
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,9 +18,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+async def monitor_event_loop_lag(interval: float = 0.25):
+    """Measures how late the event loop wakes up a sleeping task (blocking work shows up here)."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        metrics.observe("event_loop_lag_seconds", lag)
+        metrics.set("event_loop_lag_last_seconds", lag)
 
+async def warm_up():
+    """Fills the caches from the query log, then lets /ready report the replica ready."""
+    try:
+        if config.warmup_on_startup:
+            await run_in_threadpool(warm_caches)
+    except Exception:
+        logger.exception("Cache warmup failed, serving with cold caches")
+    finally:
+        warmup_done.set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor = asyncio.create_task(monitor_event_loop_lag())
+    warmup = asyncio.create_task(warm_up())
+    yield
+    warmup.cancel()
+    monitor.cancel()
+    # send the spans still queued for export before the worker exits
+    await run_in_threadpool(flush_traces)
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(middleware_class=TracingMiddleware)
+app.add_middleware(middleware_class=ProfilingMiddleware)
 app.add_middleware(middleware_class=RequestIDMiddleware)
+app.add_middleware(middleware_class=PriorityMiddleware)
 
 app.add_middleware(middleware_class=CORSMiddleware,
                    allow_origins=["*"],
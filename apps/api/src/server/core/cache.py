@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from server.core.config import config
+from server.core.metrics import metrics
+
+# Optional import, the network tier is only enabled when a redis url is configured
+try:
+    import redis
+except ImportError:
+    redis = None
+
+_MISSING = object()
+
+
+def _dumps(value: Any) -> bytes:
+    # JSON, not pickle: whoever can write to the shared file or redis must not be able to run
+    # code in the API. The cached values are lists, dicts, strings and numbers.
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(blob: bytes, tier: str) -> Any:
+    try:
+        return json.loads(blob)
+    except ValueError:
+        # an entry this version did not write (e.g. a pickle of an older one), treated as a miss
+        metrics.increment("cache_errors_total", tier=tier)
+        return _MISSING
+
+
+class LocalLRU:
+    """In-process tier: a size-bounded LRU of live Python objects."""
+
+    name = "local"
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is _MISSING:
+                return _MISSING
+            value, expires = item
+            if expires < time.time():
+                del self._items[key]
+                return _MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+class SQLiteTier:
+    """
+    Cross-process tier for workers on the same host: one SQLite file in WAL mode.
+    Entries are evicted least-recently-accessed first once the file holds more than `max_bytes`.
+    A hit only writes its access time when the stored one is more than `touch_after` seconds
+    old, so reads stay reads and the eviction order is exact to that resolution.
+    """
+
+    name = "shared"
+
+    def __init__(self, path: str, max_bytes: int, evict_every: int = 100, touch_after: float = 60.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.touch_after = touch_after
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, "
+            "expires REAL, accessed REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Any:
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _MISSING
+        blob, expires, accessed = row
+        now = time.time()
+        if expires < now:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return _MISSING
+        if now - accessed > self.touch_after:
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return _loads(blob, self.name)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        blob = _dumps(value)
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, blob, len(blob), now + ttl, now),
+        )
+        with self._writes_lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently accessed rows until ~90% of the budget is used
+        excess = total - int(self.max_bytes * 0.9)
+        rows = conn.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall()
+        victims = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            victims.append((key,))
+            excess -= size
+        conn.executemany("DELETE FROM cache WHERE key = ?", victims)
+        metrics.increment("cache_evictions_total", len(victims), tier=self.name)
+
+
+class RedisTier:
+    """Network tier shared across hosts; size bounds come from the server's maxmemory LRU policy."""
+
+    name = "network"
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise ImportError("redis library not found. Run: pip install redis")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def get(self, key: str) -> Any:
+        try:
+            blob = self.client.get(key)
+        except redis.RedisError:
+            metrics.increment("cache_errors_total", tier=self.name)
+            return _MISSING
+        return _MISSING if blob is None else _loads(blob, self.name)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        try:
+            self.client.set(key, _dumps(value), ex=max(1, int(ttl)))
+        except redis.RedisError:
+            metrics.increment("cache_errors_total", tier=self.name)
+
+
+class TieredCache:
+    """
+    Read-through cache over ordered tiers (local -> shared -> network).
+
+    A hit in a slower tier is copied into the faster ones, so a value computed by one worker
+    is served from memory by its siblings after their first lookup.
+    """
+
+    def __init__(self, name: str, tiers: List[Any], ttl: float):
+        self.name = name
+        self.tiers = tiers
+        self.ttl = ttl
+
+    def _key(self, key: Hashable) -> str:
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:40]
+        return f"{self.name}:{digest}"
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        cache_key = self._key(key)
+        for position, tier in enumerate(self.tiers):
+            value = tier.get(cache_key)
+            if value is not _MISSING:
+                metrics.increment("cache_hits_total", cache=self.name, tier=tier.name)
+                for faster in self.tiers[:position]:
+                    faster.set(cache_key, value, self.ttl)
+                return value
+            metrics.increment("cache_misses_total", cache=self.name, tier=tier.name)
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        cache_key = self._key(key)
+        for tier in self.tiers:
+            tier.set(cache_key, value, self.ttl)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Cached value of `key`, computed and stored on a miss. None (e.g. "not found") is not stored."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+
+_shared_tiers: Dict[str, Any] = {}
+_caches: Dict[str, TieredCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name: str, ttl: Optional[float] = None, shared: bool = True) -> TieredCache:
+    """
+    Returns the process-wide cache `name`. With shared=False only the in-process tier is used,
+    for values that are not plain JSON data or are cheaper to rebuild than to fetch.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            tiers = [LocalLRU(config.cache_local_max_items)]
+            if shared and config.cache_shared_path:
+                if "shared" not in _shared_tiers:
+                    _shared_tiers["shared"] = SQLiteTier(config.cache_shared_path, config.cache_shared_max_bytes)
+                tiers.append(_shared_tiers["shared"])
+            if shared and config.cache_redis_url:
+                if "network" not in _shared_tiers:
+                    _shared_tiers["network"] = RedisTier(config.cache_redis_url)
+                tiers.append(_shared_tiers["network"])
+            _caches[name] = TieredCache(name, tiers, ttl if ttl is not None else config.cache_ttl_seconds)
+        return _caches[name]
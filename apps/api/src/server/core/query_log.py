@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from server.core.config import config
+
+
+class QueryLog:
+    """
+    Append-only JSONL log of the queries the API served, one {"ts", "kind", "query", ...} object
+    per line. Every worker appends to the same file (single O_APPEND writes, so lines do not
+    interleave); once it passes `max_bytes` or its first entry is older than `max_age` seconds it
+    is moved to "<path>.1" (replacing the previous one) and a new one is started.
+
+    The entries are the customers' own words, so the files are only readable by their owner.
+    """
+
+    def __init__(self, path: Optional[str], max_bytes: int, max_age: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # (inode, ts of its first entry) of the current file, so it is read once per file
+        self._started: Optional[Tuple[int, float]] = None
+
+    def _first_ts(self, stat: os.stat_result) -> float:
+        if self._started is None or self._started[0] != stat.st_ino:
+            with open(self.path) as file:
+                try:
+                    ts = float(json.loads(file.readline()).get("ts", 0))
+                except (json.JSONDecodeError, ValueError, AttributeError):
+                    ts = 0.0
+            self._started = (stat.st_ino, ts)
+        return self._started[1]
+
+    def _should_rotate(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size > self.max_bytes:
+            return True
+        return stat.st_size > 0 and self._first_ts(stat) < time.time() - self.max_age
+
+    def record(self, kind: str, query: str, **fields: Any) -> None:
+        if not self.path or not query:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), "kind": kind, "query": query, **fields}) + "\n"
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                if self._should_rotate():
+                    os.replace(self.path, self.path + ".1")
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    os.write(fd, line.encode("utf-8"))
+                finally:
+                    os.close(fd)
+            except OSError:
+                # the log only feeds the cache warmup, never fail a request over it
+                pass
+
+    def read(self, since_seconds: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """Entries of the rotated and the current file, oldest first, newer than `since_seconds` ago."""
+        if not self.path:
+            return
+        cutoff = time.time() - since_seconds if since_seconds is not None else 0
+        for path in (self.path + ".1", self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by a crash or a rotation
+                        continue
+                    if entry.get("ts", 0) >= cutoff:
+                        yield entry
+
+
+def top_queries(entries: Iterator[Dict[str, Any]], kinds: Tuple[str, ...], limit: int,
+                priorities: Optional[Tuple[str, ...]] = None) -> List[Tuple[Dict[str, Any], int]]:
+    """The `limit` most frequent entries of `kinds`, counted on the normalized query and its other fields."""
+    counts: Counter = Counter()
+    examples: Dict[str, Dict[str, Any]] = {}
+    for entry in entries:
+        if entry.get("kind") not in kinds or (priorities and entry.get("priority") not in priorities):
+            continue
+        fields = {k: v for k, v in entry.items() if k not in ("ts", "priority")}
+        fields["query"] = " ".join(str(fields["query"]).split())
+        key = json.dumps({**fields, "query": fields["query"].lower()}, sort_keys=True)
+        counts[key] += 1
+        examples.setdefault(key, fields)
+    return [(examples[key], count) for key, count in counts.most_common(limit)]
+
+
+query_log = QueryLog(config.query_log_path, config.query_log_max_bytes, config.query_log_max_age_hours * 3600)
@@ -0,0 +1,136 @@
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+from PIL import Image
+
+from server.core.config import config
+from server.core.metrics import metrics
+
+PRODUCT_ID = re.compile(r"[A-Za-z0-9]{1,20}")
+
+_SIGNATURES = ((b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG", "image/png"), (b"GIF8", "image/gif"))
+
+
+def content_type(data: bytes) -> str:
+    for signature, media_type in _SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def etag(data: bytes) -> str:
+    return '"' + hashlib.sha1(data).hexdigest()[:20] + '"'
+
+
+class ThumbnailStore:
+    """
+    On-disk LRU of product thumbnails, one file per product id, shared by the workers on this
+    host. A hit bumps the file's mtime; every `evict_every` writes the oldest files are removed
+    until the directory is back under 90% of `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, evict_every: int = 50):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, product_id: str) -> str:
+        return os.path.join(self.directory, f"{product_id}.img")
+
+    def get(self, product_id: str) -> Optional[bytes]:
+        path = self._path(product_id)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, product_id: str, data: bytes) -> None:
+        path = self._path(product_id)
+        # written aside and renamed, so a concurrent reader never sees half a file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.evict_every:
+                return
+        self.evict()
+
+    def evict(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                metrics.increment("thumbnail_evictions_total")
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_http_client = httpx.Client(timeout=config.thumbnail_fetch_timeout, follow_redirects=True,
+                            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8))
+
+
+def make_thumbnail(source_url: str, size: int = config.thumbnail_size) -> bytes:
+    """Downloads the source image and shrinks it to fit a `size` x `size` box, as JPEG."""
+    start = time.perf_counter()
+    data = bytearray()
+    with _http_client.stream("GET", source_url) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            data.extend(chunk)
+            if len(data) > config.thumbnail_max_source_bytes:
+                raise ValueError(f"Source image larger than {config.thumbnail_max_source_bytes} bytes")
+    metrics.observe("thumbnail_fetch_seconds", time.perf_counter() - start)
+
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size))
+    if image.mode != "RGB":
+        # JPEG has no alpha, flatten transparent images on white like the card background
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=config.thumbnail_quality, optimize=True)
+    return output.getvalue()
+
+
+def thumbnail_url(product_id: str, source_url: Optional[str]) -> Optional[str]:
+    """URL of the product's thumbnail on this API, or the source image when the proxy is disabled."""
+    if not config.thumbnail_base_url or not source_url:
+        return source_url
+    return f"{config.thumbnail_base_url.rstrip('/')}/product_assistant/thumbnails/{product_id}"
+
+
+def thumbnail_headers(data: bytes) -> Dict[str, str]:
+    return {"ETag": etag(data), "Cache-Control": f"public, max-age={config.thumbnail_max_age_seconds}"}
+
+
+thumbnail_store = ThumbnailStore(config.thumbnail_cache_dir, config.thumbnail_cache_max_bytes)
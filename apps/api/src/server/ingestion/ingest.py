@@ -0,0 +1,274 @@
+"""Ingest the Amazon product metadata JSONL into Qdrant for hybrid search.
+
+With --layout single every product goes to config.collection_name, as in the hybrid search
+notebook. With --layout sharded every main_category gets its own collection, categories
+smaller than --min-shard-size share an "other" shard, and the normalized centroid of each
+shard's embeddings is written to the shard registry that the query router reads.
+--local-vector also stores a second named vector from the local fastembed model, which the
+"local" and "local_first" query embedding backends search against.
+
+The file is streamed in chunks, so memory use does not grow with the catalogue:
+
+    python -m server.ingestion.ingest --input data/meta_Electronics.jsonl --layout sharded
+"""
+
+import argparse
+import json
+import uuid
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import models
+from qdrant_client.models import (
+    Distance,
+    Document,
+    PayloadSchemaType,
+    PointStruct,
+    SetPayload,
+    SetPayloadOperation,
+    SparseVectorParams,
+    VectorParams,
+)
+
+from server.agents.local_embeddings import LocalEmbedder, get_local_embedder
+from server.agents.retrieval_generation import create_embeddings_batch
+from server.agents.dedup import family_key
+from server.ingestion.snippets import build_llm_snippet
+from server.agents.sharding import (
+    FAMILY_KEY,
+    OTHER_SHARD,
+    lookup_collections,
+    registry_collection,
+    shard_collection,
+    shard_key,
+)
+from server.agents.utils.rate_limiting import get_limiter
+from server.core.config import config
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_SIZE = 1536
+PAYLOAD_INDEXES = {
+    "parent_asin": PayloadSchemaType.KEYWORD,
+    "main_category": PayloadSchemaType.KEYWORD,
+    "price": PayloadSchemaType.FLOAT,
+    "average_rating": PayloadSchemaType.FLOAT,
+    "rating_number": PayloadSchemaType.INTEGER,
+    FAMILY_KEY: PayloadSchemaType.KEYWORD,
+}
+
+
+def read_items(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def to_number(value: Any) -> Optional[float]:
+    """Prices and ratings as floats, so the range filters and their payload indexes see one type."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_payload(item: Dict[str, Any]) -> Dict[str, Any]:
+    description = item.get("description") or []
+    if isinstance(description, list):
+        description = " ".join(description)
+    images = item.get("images") or [{}]
+    return {
+        "description": f"{item['title']} {description}".strip(),
+        "llm_snippet": build_llm_snippet(item["title"], item.get("details"), item.get("features"), description,
+                                         max_tokens=config.llm_snippet_max_tokens),
+        "image": images[0].get("large", ""),
+        "rating_number": item.get("rating_number"),
+        "price": to_number(item.get("price")),
+        "average_rating": to_number(item.get("average_rating")),
+        "parent_asin": item["parent_asin"],
+        "main_category": item.get("main_category"),
+        FAMILY_KEY: family_key(item["title"]),
+    }
+
+
+def plan_shards(path: str, min_shard_size: int) -> Dict[str, str]:
+    """First pass over the file: maps every main_category to its shard key."""
+    counts = Counter(shard_key(item.get("main_category")) for item in read_items(path))
+    return {key: key if count >= min_shard_size else OTHER_SHARD for key, count in counts.items()}
+
+
+def dense_vectors_config(local_embedder: Optional[LocalEmbedder]) -> Dict[str, VectorParams]:
+    vectors = {EMBEDDING_MODEL: VectorParams(size=EMBEDDING_SIZE, distance=Distance.COSINE)}
+    if local_embedder is not None:
+        vectors[local_embedder.vector_name] = VectorParams(size=local_embedder.size, distance=Distance.COSINE)
+    return vectors
+
+
+def create_collection(qd_client: QdrantClient, collection_name: str, recreate: bool,
+                      local_embedder: Optional[LocalEmbedder] = None) -> None:
+    vectors = dense_vectors_config(local_embedder)
+    if qd_client.collection_exists(collection_name):
+        if not recreate:
+            existing = qd_client.get_collection(collection_name).config.params.vectors
+            missing = set(vectors) - set(existing)
+            if missing:
+                raise ValueError(f"{collection_name} has no {sorted(missing)} vector, ingest again with --recreate")
+            return
+        qd_client.delete_collection(collection_name)
+    qd_client.create_collection(
+        collection_name=collection_name,
+        vectors_config=vectors,
+        sparse_vectors_config={"bm25": SparseVectorParams(modifier=models.Modifier.IDF)},
+    )
+    create_payload_indexes(qd_client, collection_name)
+
+
+def create_payload_indexes(qd_client: QdrantClient, collection_name: str) -> None:
+    """Keyword indexes for lookups, range indexes for the price and rating filters of the query constraints."""
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        qd_client.create_payload_index(collection_name, field_name=field_name, field_schema=field_schema)
+
+
+def write_registry(qd_client: QdrantClient, base_collection: str, sums: Dict[str, Dict[str, np.ndarray]],
+                   counts: Counter, local_embedder: Optional[LocalEmbedder] = None) -> None:
+    """One point per shard with the centroid of each dense vector, so routing works with either backend."""
+    collection_name = registry_collection(base_collection)
+    if qd_client.collection_exists(collection_name):
+        qd_client.delete_collection(collection_name)
+    qd_client.create_collection(
+        collection_name=collection_name,
+        vectors_config=dense_vectors_config(local_embedder),
+    )
+    points = []
+    for shard, totals in sums.items():
+        centroids = {name: (total / (np.linalg.norm(total) or 1.0)).tolist() for name, total in totals.items()}
+        points.append(PointStruct(
+            id=str(uuid.uuid5(uuid.NAMESPACE_URL, shard)),
+            vector=centroids,
+            payload={"shard": shard, "collection": shard_collection(base_collection, shard), "count": counts[shard]},
+        ))
+    qd_client.upsert(collection_name=collection_name, points=points, wait=True)
+
+
+def ingest(path: str, layout: str, chunk_size: int, min_shard_size: int, recreate: bool,
+           local_vector: bool = False) -> Counter:
+    qd_client = QdrantClient(url=config.qdrant_url)
+    base_collection = config.collection_name
+    local_embedder = get_local_embedder() if local_vector else None
+    shards = plan_shards(path, min_shard_size) if layout == "sharded" else {}
+    counts: Counter = Counter()
+    sums: Dict[str, Dict[str, np.ndarray]] = {}
+    created = set()
+
+    def flush(items: List[Dict[str, Any]]) -> None:
+        payloads = [to_payload(item) for item in items]
+        texts = [payload["description"] for payload in payloads]
+        dense = {EMBEDDING_MODEL: create_embeddings_batch(texts, model=EMBEDDING_MODEL,
+                                                          batch_size=config.embedding_batch_size)}
+        if local_embedder is not None:
+            dense[local_embedder.vector_name] = local_embedder.embed(texts)
+        by_collection: Dict[str, List[PointStruct]] = {}
+        for i, payload in enumerate(payloads):
+            vectors = {name: embeddings[i] for name, embeddings in dense.items()}
+            if layout == "sharded":
+                shard = shards[shard_key(payload["main_category"])]
+                collection_name = shard_collection(base_collection, shard)
+                totals = sums.setdefault(shard, {})
+                for name, embedding in vectors.items():
+                    vector = np.asarray(embedding, dtype=np.float64)
+                    totals[name] = totals.get(name, 0.0) + vector / (np.linalg.norm(vector) or 1.0)
+                counts[shard] += 1
+            else:
+                collection_name = base_collection
+                counts[collection_name] += 1
+            by_collection.setdefault(collection_name, []).append(PointStruct(
+                # stable ids, so re-ingesting a product overwrites it instead of duplicating it
+                id=str(uuid.uuid5(uuid.NAMESPACE_URL, payload["parent_asin"])),
+                vector={**vectors, "bm25": Document(text=payload["description"], model="Qdrant/bm25")},
+                payload=payload,
+            ))
+        for collection_name, points in by_collection.items():
+            if collection_name not in created:
+                create_collection(qd_client, collection_name, recreate, local_embedder)
+                created.add(collection_name)
+            get_limiter("qdrant").call(qd_client.upsert, collection_name=collection_name, points=points, wait=True)
+
+    chunk = []
+    for item in read_items(path):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    if layout == "sharded":
+        write_registry(qd_client, base_collection, sums, counts, local_embedder)
+    return counts
+
+
+def backfill_snippets(qd_client: QdrantClient, batch_size: int = 256) -> Counter:
+    """Adds llm_snippet to collections ingested before it existed, without re-embedding."""
+    counts: Counter = Counter()
+    for collection_name in lookup_collections(qd_client, config.collection_name):
+        offset = None
+        while True:
+            points, offset = qd_client.scroll(collection_name, limit=batch_size, offset=offset,
+                                              with_payload=["description"], with_vectors=False)
+            operations = [
+                SetPayloadOperation(set_payload=SetPayload(
+                    payload={"llm_snippet": build_llm_snippet("", description=point.payload.get("description"),
+                                                              max_tokens=config.llm_snippet_max_tokens)},
+                    points=[point.id],
+                ))
+                for point in points
+            ]
+            if operations:
+                qd_client.batch_update_points(collection_name, update_operations=operations)
+            counts[collection_name] += len(points)
+            if offset is None:
+                break
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="product metadata JSONL")
+    parser.add_argument("--layout", choices=["single", "sharded"], default="sharded" if config.sharding_enabled else "single")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="products embedded and upserted per step")
+    parser.add_argument("--min-shard-size", type=int, default=config.shard_min_size,
+                        help=f'categories with fewer products share the "{OTHER_SHARD}" shard')
+    parser.add_argument("--recreate", action="store_true", help="drop existing collections first")
+    parser.add_argument("--local-vector", action=argparse.BooleanOptionalAction,
+                        default=config.embedding_backend != "remote",
+                        help=f"also store {config.local_embedding_model} embeddings for local query embedding")
+    parser.add_argument("--indexes-only", action="store_true",
+                        help="only add the payload indexes to the existing collections")
+    parser.add_argument("--backfill-snippets", action="store_true",
+                        help="only add llm_snippet to existing points, built from their stored description")
+    args = parser.parse_args()
+
+    if args.backfill_snippets:
+        for collection_name, count in backfill_snippets(QdrantClient(url=config.qdrant_url)).items():
+            print(f"{collection_name}: {count} snippets written")
+        return
+
+    if args.indexes_only:
+        qd_client = QdrantClient(url=config.qdrant_url)
+        for collection_name in lookup_collections(qd_client, config.collection_name):
+            create_payload_indexes(qd_client, collection_name)
+            print(f"{collection_name}: payload indexes created")
+        return
+    if not args.input:
+        parser.error("--input is required")
+
+    counts = ingest(args.input, args.layout, args.chunk_size, args.min_shard_size, args.recreate,
+                    args.local_vector)
+    for name, count in sorted(counts.items()):
+        print(f"{name}: {count} products")
+
+
+if __name__ == "__main__":
+    main()
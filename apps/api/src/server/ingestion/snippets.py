@@ -0,0 +1,67 @@
+import html
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+from server.agents.context_packing import count_tokens
+
+# product details worth a prompt token, in the order they are listed
+SNIPPET_DETAILS = ["Brand", "Model Name", "Color", "Connectivity Technology", "Compatible Devices",
+                   "Screen Size", "Capacity", "Wattage", "Item Weight"]
+
+_TAGS = re.compile(r"<[^>]+>")
+_REPEATED_PUNCTUATION = re.compile(r"([!?.,;:*~=_-])\1+")
+_SPACES = re.compile(r"\s+")
+_SPACE_BEFORE_PUNCTUATION = re.compile(r"\s+([!?.,;:])")
+_SENTENCES = re.compile(r"(?<=[.!?;])\s+|\n+|\s*•\s*")
+
+
+def normalize_text(text: Any) -> str:
+    """Plain single-line text: no markup, entities, repeated punctuation or runs of whitespace."""
+    text = html.unescape(_TAGS.sub(" ", str(text or "")))
+    text = _REPEATED_PUNCTUATION.sub(r"\1", text)
+    text = _SPACE_BEFORE_PUNCTUATION.sub(r"\1", _SPACES.sub(" ", text))
+    return text.strip(" .;,")
+
+
+def _unique(parts: Iterable[str]) -> List[str]:
+    seen, unique = set(), []
+    for part in parts:
+        key = part.lower()
+        if part and key not in seen:
+            seen.add(key)
+            unique.append(part)
+    return unique
+
+
+def build_llm_snippet(title: str, details: Optional[Dict[str, Any]] = None, features: Optional[List[str]] = None,
+                      description: Optional[str] = None, max_tokens: int = 80, model: str = "gpt-4.1-mini") -> str:
+    """
+    Compact text of a product for the LLM prompt: the title, key attributes from `details`,
+    then as many whole features (or description sentences when there are none) as fit in
+    `max_tokens`. The full description stays in the payload for BM25 and embeddings.
+    """
+    snippet = normalize_text(title)
+    attributes = [f"{name}: {normalize_text(details[name])}" for name in SNIPPET_DETAILS
+                  if details and details.get(name)]
+    if attributes:
+        snippet = f"{snippet}. {'; '.join(attributes)}"
+
+    if features:
+        parts = [normalize_text(feature) for feature in features]
+    else:
+        parts = [normalize_text(sentence) for sentence in _SENTENCES.split(description or "")]
+    for part in _unique(parts):
+        if part.lower() in snippet.lower():
+            continue
+        candidate = f"{snippet}. {part}" if snippet else part
+        if count_tokens(candidate, model) > max_tokens:
+            if not snippet:
+                # nothing fits yet, keep the first part and cut it below
+                snippet = candidate
+            break
+        snippet = candidate
+
+    # a title alone can exceed the budget, cut it on a word boundary
+    while count_tokens(snippet, model) > max_tokens and " " in snippet:
+        snippet = snippet.rsplit(" ", 1)[0]
+    return snippet
@@ -0,0 +1,9 @@
+import os
+
+# server.core.config is read at import time, so the settings the tests depend on are set first
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ["LANGSMITH_TRACING"] = "false"
+os.environ["CACHE_SHARED_PATH"] = ""
+os.environ["CACHE_REDIS_URL"] = ""
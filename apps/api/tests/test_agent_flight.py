@@ -0,0 +1,112 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.memory import InMemorySaver
+
+from server.agents import graph as agent_graph
+from server.agents.models import Toolcall
+
+
+def retrieve_embedding(query: str):
+    """Searches the catalogue."""
+    return "B1 - Anker USB-C cable", [{"id": "B1", "title": "Anker USB-C cable"}]
+
+
+class Agent:
+    """The router, rewriter and agent nodes; the leader's first agent step waits for `release`."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.runs = 0
+
+    def router(self, state):
+        return {"query_relevant": True}
+
+    def rewriter(self, state):
+        return {"expanded_queries": [state.messages[-1].content]}
+
+    def agent(self, state):
+        if state.iteration == 0:
+            self.runs += 1
+            self.release.wait(5)
+            call = {"name": "retrieve_embedding", "args": {"query": "usb c cable"}, "id": "call-1", "type": "tool_call"}
+            return {"messages": [AIMessage(content="", tool_calls=[call])], "iteration": 1,
+                    "tool_calls": [Toolcall(name="retrieve_embedding", arguments={"query": "usb c cable"})]}
+        return {"messages": [AIMessage(content="The Anker cable.")], "iteration": state.iteration + 1,
+                "tool_calls": [], "final_answer": True, "answer": "The Anker cable."}
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    agent = Agent()
+    checkpointer = InMemorySaver()
+
+    class Saver:
+        @staticmethod
+        @contextmanager
+        def from_conn_string(conn_string):
+            yield checkpointer
+
+    monkeypatch.setattr(agent_graph, "RequestSaver", Saver)
+    monkeypatch.setattr(agent_graph, "graph_callbacks", lambda: [])
+    monkeypatch.setattr(agent_graph, "tools", [retrieve_embedding])
+    monkeypatch.setattr(agent_graph, "router_node", agent.router)
+    monkeypatch.setattr(agent_graph, "query_rewriter_node", agent.rewriter)
+    monkeypatch.setattr(agent_graph, "agent_node", agent.agent)
+    agent.checkpointer = checkpointer
+    yield agent
+    agent.release.set()
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.001)
+
+
+def test_follower_gets_the_leaders_steps_and_tool_messages(agent):
+    steps = {"leader": [], "follower": []}
+    results = {}
+
+    def ask(thread_id, question):
+        results[thread_id] = agent_graph.run_agent(question, thread_id, steps[thread_id].append)
+
+    leader = threading.Thread(target=ask, args=("leader", "USB-C cable?"))
+    leader.start()
+    wait_for(lambda: steps["leader"] == ["router", "query_rewriter"])
+    follower = threading.Thread(target=ask, args=("follower", "  usb-c cable? "))
+    follower.start()
+    # the follower joins the flight and first gets the steps the leader already took
+    wait_for(lambda: steps["follower"] == ["router", "query_rewriter"])
+    agent.release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert agent.runs == 1
+    assert steps["follower"] == steps["leader"] == ["router", "query_rewriter", "agent_node", "tools", "agent_node"]
+    assert results["follower"]["answer"] == "The Anker cable."
+
+    thread = agent_graph.build_graph().compile(checkpointer=agent.checkpointer)
+    messages = thread.get_state({"configurable": {"thread_id": "follower"}}).values["messages"]
+    assert [type(message) for message in messages] == [HumanMessage, AIMessage, ToolMessage, AIMessage]
+    assert messages[0].content == "  usb-c cable? "
+    assert messages[1].tool_calls[0]["id"] == messages[2].tool_call_id
+    assert messages[2].artifact == [{"id": "B1", "title": "Anker USB-C cable"}]
+    assert messages[3].content == "The Anker cable."
+    leader_messages = thread.get_state({"configurable": {"thread_id": "leader"}}).values["messages"]
+    assert not {message.id for message in messages} & {message.id for message in leader_messages}
+
+
+def test_shared_turn_strips_tool_calls_the_leader_left_unanswered():
+    call = {"name": "retrieve_embedding", "args": {"query": "usb c"}, "id": "call-3", "type": "tool_call"}
+    result = {"messages": [HumanMessage(content="usb c cable?"), AIMessage(content="", tool_calls=[call])],
+              "answer": "I could not finish the search."}
+
+    messages = agent_graph.shared_turn("USB-C cable?", result)["messages"]
+    assert [type(message) for message in messages] == [HumanMessage, AIMessage, AIMessage]
+    assert not messages[1].tool_calls
+    assert messages[2].content == "I could not finish the search."
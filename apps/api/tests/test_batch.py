@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from starlette.requests import Request
+
+from server.agents import retrieval_generation
+from server.agents.utils.deadline import Deadline, RequestCancelledError, current_deadline
+from server.api import endpoints
+from server.api.models import RAGBatchRequest
+
+
+class Pipeline:
+    """Stands in for retrieval and generation; each answer waits until the test releases it."""
+
+    def __init__(self):
+        self.started = []
+        self.deadlines = []
+        self.release = threading.Event()
+
+    def retrieve(self, qdrant_client, questions, **kwargs):
+        self.deadlines.append(current_deadline())
+        return [{"question": question} for question in questions]
+
+    def answer(self, question, retrieved_context, model, top_k):
+        self.started.append(question)
+        self.deadlines.append(current_deadline())
+        if question != "q0":
+            self.release.wait(5)
+        return {"answer": f"answer to {question}", "references": []}
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = Pipeline()
+    monkeypatch.setattr(retrieval_generation, "QdrantClient", lambda **kwargs: None)
+    monkeypatch.setattr(retrieval_generation, "retrieve_embedding_data_batch", pipeline.retrieve)
+    monkeypatch.setattr(retrieval_generation, "answer_from_retrieved_context", pipeline.answer)
+    monkeypatch.setattr(retrieval_generation, "get_used_context", lambda result: [])
+    yield pipeline
+    pipeline.release.set()
+
+
+def test_cancel_drops_the_questions_not_started(pipeline):
+    deadline = Deadline(30)
+    questions = [f"q{i}" for i in range(5)]
+    batch = retrieval_generation.integrated_rag_pipeline_batch(questions, max_concurrency=1, deadline=deadline)
+
+    assert next(batch) == (0, {"answer": "answer to q0", "references": []})
+    end = time.monotonic() + 2
+    while "q1" not in pipeline.started:
+        assert time.monotonic() < end
+        time.sleep(0.001)
+    # q1 is running on the only worker, the rest are queued behind it
+    deadline.cancel()
+    pipeline.release.set()
+    rest = dict(batch)
+
+    assert pipeline.started == ["q0", "q1"]
+    assert rest[1] == {"answer": "answer to q1", "references": []}
+    assert all(isinstance(rest[i], RequestCancelledError) for i in (2, 3, 4))
+    # retrieval and every worker ran within the batch's deadline
+    assert pipeline.deadlines and all(d is deadline for d in pipeline.deadlines)
+
+
+def batch_request():
+    scope = {"type": "http", "method": "POST", "path": "/product_assistant/batch", "headers": [],
+             "query_string": b"", "state": {"request_id": "batch-1"}}
+    return Request(scope)
+
+
+def test_abandoned_response_cancels_the_batch(pipeline, monkeypatch):
+    logged = []
+    monkeypatch.setattr(endpoints.query_log, "record", lambda kind, query, **fields: logged.append((kind, query)))
+    monkeypatch.setattr(endpoints.config, "batch_max_concurrency", 1)
+    deadlines = []
+    wrapper = retrieval_generation.rag_pipeline_batch_wrapper
+    monkeypatch.setattr(endpoints, "rag_pipeline_batch_wrapper",
+                        lambda queries, deadline: deadlines.append(deadline) or wrapper(queries, deadline=deadline))
+
+    async def first_line_then_disconnect():
+        payload = RAGBatchRequest(queries=["q0", "q1", "q2"])
+        response = await endpoints.amazon_product_assistant_batch(batch_request(), payload)
+        lines = response.body_iterator
+        first = await lines.__anext__()
+        await lines.aclose()
+        return first
+
+    assert '"answer":"answer to q0"' in asyncio.run(first_line_then_disconnect())
+    assert deadlines[0].cancelled
+    assert logged == [("question", "q0"), ("question", "q1"), ("question", "q2")]
@@ -0,0 +1,242 @@
+import builtins
+import pickle
+import socket
+import sqlite3
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from server.core.cache import _MISSING, LocalLRU, RedisTier, SQLiteTier, TieredCache
+from server.core.metrics import metrics
+
+
+class _RESPHandler(socketserver.StreamRequestHandler):
+    """The subset of the Redis protocol RedisTier uses: HELLO, GET, SET with EX, anything else answers +OK."""
+
+    def _read_command(self):
+        header = self.rfile.readline()
+        if not header:
+            return None
+        parts = []
+        for _ in range(int(header[1:])):
+            length = int(self.rfile.readline()[1:])
+            parts.append(self.rfile.read(length + 2)[:-2])
+        return parts
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        store = self.server.store
+        while True:
+            try:
+                command = self._read_command()
+            except (OSError, ValueError):
+                return
+            if command is None:
+                return
+            name = command[0].upper()
+            if name == b"HELLO":
+                # the client negotiates RESP3, the handshake only has to confirm the version
+                self.wfile.write(b"%%1\r\n+proto\r\n:%s\r\n" % command[1])
+            elif name == b"GET":
+                value, expires = store.get(command[1], (None, 0))
+                if value is None or expires < time.time():
+                    self.wfile.write(b"$-1\r\n")
+                else:
+                    self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif name == b"SET":
+                options = [option.upper() for option in command[3::2]]
+                ttl = int(command[4 + 2 * options.index(b"EX")]) if b"EX" in options else 3600
+                store[command[1]] = (command[2], time.time() + ttl)
+                self.server.ttls.append(ttl)
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"+OK\r\n")
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RESPHandler)
+        self.store = {}
+        self.ttls = []
+        self.connections = []
+        self.running = True
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.shutdown()
+        self.server_close()
+        # the open client connections too, as when the server goes away
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # already closed by the client
+                pass
+
+
+@pytest.fixture
+def redis_server():
+    pytest.importorskip("redis")
+    server = RedisStandIn()
+    yield server
+    server.stop()
+
+
+def test_local_lru_evicts_least_recently_used():
+    tier = LocalLRU(max_items=2)
+    tier.set("a", 1, ttl=60)
+    tier.set("b", 2, ttl=60)
+    tier.get("a")
+    tier.set("c", 3, ttl=60)
+    assert tier.get("b") is _MISSING
+    assert tier.get("a") == 1 and tier.get("c") == 3
+
+
+def test_local_lru_expires_entries():
+    tier = LocalLRU(max_items=10)
+    tier.set("a", 1, ttl=-1)
+    assert tier.get("a") is _MISSING
+
+
+def test_sqlite_tier_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    SQLiteTier(path, max_bytes=1 << 20).set("key", {"value": [1, 2]}, ttl=60)
+    # a second instance on the same file is what another worker on the host sees
+    assert SQLiteTier(path, max_bytes=1 << 20).get("key") == {"value": [1, 2]}
+
+
+def test_sqlite_tier_expires_entries(tmp_path):
+    tier = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=1 << 20)
+    tier.set("key", "value", ttl=-1)
+    assert tier.get("key") is _MISSING
+
+
+def test_sqlite_tier_evicts_least_recently_accessed(tmp_path):
+    tier = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=10_000, evict_every=1, touch_after=0)
+    for i in range(20):
+        tier.set(f"key{i}", "x" * 1000, ttl=60)
+        tier.get("key0")
+    assert tier.get("key0") is not _MISSING
+    assert tier.get("key1") is _MISSING
+    assert tier.get("key19") is not _MISSING
+
+
+def test_sqlite_tier_hits_do_not_write(tmp_path):
+    tier = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=1 << 20, touch_after=60)
+    tier.set("key", "value", ttl=60)
+    writes = tier._conn().total_changes
+    for _ in range(10):
+        assert tier.get("key") == "value"
+    # the access time is fresh, so the hits leave the file alone
+    assert tier._conn().total_changes == writes
+
+
+class _RunsCode:
+    def __reduce__(self):
+        return exec, ("import builtins; builtins.cache_payload_ran = True",)
+
+
+def test_sqlite_tier_does_not_unpickle(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    tier = SQLiteTier(path, max_bytes=1 << 20)
+    blob = pickle.dumps(_RunsCode())
+    # whoever can write to the file
+    sqlite3.connect(path, isolation_level=None).execute(
+        "INSERT INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+        ("key", blob, len(blob), time.time() + 60, time.time()))
+    assert tier.get("key") is _MISSING
+    assert not hasattr(builtins, "cache_payload_ran")
+
+
+def test_sqlite_tier_concurrent_writers(tmp_path):
+    tier = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=1 << 30, evict_every=7)
+
+    def write(worker):
+        for i in range(50):
+            tier.set(f"{worker}:{i}", i, ttl=60)
+            assert tier.get(f"{worker}:{i}") == i
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(write, range(8)))
+    assert tier._writes == 400
+
+
+def test_tiered_cache_promotes_hits_to_faster_tiers(tmp_path):
+    shared = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=1 << 20)
+    TieredCache("test", [LocalLRU(10), shared], ttl=60).set("key", "value")
+
+    local = LocalLRU(10)
+    cache = TieredCache("test", [local, shared], ttl=60)
+    assert cache.get("key") == "value"
+    assert local.get(cache._key("key")) == "value"
+
+
+def test_get_or_compute_does_not_store_none():
+    cache = TieredCache("test_none", [LocalLRU(10)], ttl=60)
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        return None if len(calls) == 1 else "found"
+
+    assert cache.get_or_compute("product", lookup) is None
+    # a product missing on the first lookup is looked up again, not cached as missing for the TTL
+    assert cache.get_or_compute("product", lookup) == "found"
+    assert cache.get_or_compute("product", lookup) == "found"
+    assert len(calls) == 2
+
+
+def test_get_or_compute_from_many_threads(tmp_path):
+    shared = SQLiteTier(str(tmp_path / "cache.sqlite"), max_bytes=1 << 20)
+    cache = TieredCache("test_threads", [LocalLRU(1000), shared], ttl=60)
+
+    def lookup(i):
+        return cache.get_or_compute(i % 10, lambda: f"value-{i % 10}")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lookup, range(200)))
+    assert results == [f"value-{i % 10}" for i in range(200)]
+
+
+def test_redis_tier_round_trip(redis_server):
+    tier = RedisTier(redis_server.url)
+    tier.set("key", {"ids": ["B1", "B2"]}, ttl=30.5)
+    assert tier.get("key") == {"ids": ["B1", "B2"]}
+    assert tier.get("other") is _MISSING
+    assert redis_server.ttls == [30]
+
+
+def test_redis_tier_does_not_unpickle(redis_server):
+    redis_server.store[b"key"] = (pickle.dumps(_RunsCode()), time.time() + 60)
+    assert RedisTier(redis_server.url).get("key") is _MISSING
+    assert not hasattr(builtins, "cache_payload_ran")
+
+
+def test_redis_tier_shares_values_across_hosts(redis_server):
+    # each host has its own local tier, the network tier is the only thing they share
+    TieredCache("test_hosts", [LocalLRU(10), RedisTier(redis_server.url)], ttl=60).set("key", "value")
+    assert TieredCache("test_hosts", [LocalLRU(10), RedisTier(redis_server.url)], ttl=60).get("key") == "value"
+
+
+def test_redis_tier_outage_is_a_miss(redis_server):
+    tier = RedisTier(redis_server.url)
+    tier.set("key", "value", ttl=60)
+    redis_server.stop()
+    errors = metrics.get("cache_errors_total", tier="network")
+
+    assert tier.get("key") is _MISSING
+    tier.set("key", "value", ttl=60)
+    assert metrics.get("cache_errors_total", tier="network") == errors + 2
@@ -0,0 +1,61 @@
+from typing import TypedDict
+from unittest import mock
+
+import pytest
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.graph import END, START, StateGraph
+
+from server.agents import graph as agent_graph
+from server.agents.utils.deadline import Deadline
+
+
+class TurnState(TypedDict):
+    steps: list
+
+
+@pytest.fixture
+def saver(monkeypatch):
+    """A RequestSaver whose Postgres writes are recorded instead of sent."""
+    puts, writes = [], []
+    monkeypatch.setattr(PostgresSaver, "put", lambda self, config, checkpoint, metadata, new_versions:
+                        puts.append(metadata) or {"configurable": {**config["configurable"], "checkpoint_id": checkpoint["id"]}})
+    monkeypatch.setattr(PostgresSaver, "put_writes", lambda self, config, batch, task_id, task_path="":
+                        writes.append(batch))
+    monkeypatch.setattr(PostgresSaver, "get_tuple", lambda self, config: None)
+    monkeypatch.setattr(agent_graph, "graph_callbacks", lambda: [])
+    saver = agent_graph.RequestSaver(mock.MagicMock())
+    saver.deadline = Deadline(60)
+    saver.puts, saver.writes = puts, writes
+    return saver
+
+
+def turn_graph(saver, on_second=lambda: None):
+    def first(state):
+        return {"steps": state["steps"] + ["first"]}
+
+    def second(state):
+        on_second()
+        return {"steps": state["steps"] + ["second"]}
+
+    workflow = StateGraph(TurnState)
+    workflow.add_node("first", first)
+    workflow.add_node("second", second)
+    workflow.add_edge(START, "first")
+    workflow.add_edge("first", "second")
+    workflow.add_edge("second", END)
+    return workflow.compile(checkpointer=saver)
+
+
+@pytest.mark.parametrize("on_step", [None, lambda node: None])
+def test_turn_is_checkpointed_once_when_it_ends(saver, on_step):
+    result = agent_graph.invoke_graph(turn_graph(saver), {"steps": []}, {"configurable": {"thread_id": "t"}}, on_step)
+    assert result["steps"] == ["first", "second"]
+    # not one checkpoint per node, which is what left a partial turn behind on disconnect
+    assert len(saver.puts) == 1
+
+
+def test_abandoned_turn_is_not_persisted(saver):
+    # the client goes away while the second node runs, after the first has finished
+    graph = turn_graph(saver, on_second=saver.deadline.cancel)
+    agent_graph.invoke_graph(graph, {"steps": []}, {"configurable": {"thread_id": "t"}})
+    assert saver.puts == [] and saver.writes == []
@@ -0,0 +1,65 @@
+from array import array
+
+import pytest
+
+from server.agents import context_packing
+from server.agents.context_packing import count_tokens, get_context_budget, pack_context
+from server.agents.retrieval_result import RetrievalResult
+
+TEMPLATE = "{id}|{rating}|{description}"
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # the ~4 characters per token estimate, so the counts do not depend on a downloaded BPE
+    monkeypatch.setattr(context_packing, "tiktoken", None)
+
+
+def products(*descriptions):
+    n = len(descriptions)
+    return RetrievalResult([f"B{i}" for i in range(n)], list(descriptions), [4.5] * n, [None] * n, [None] * n,
+                           array("d", [1.0] * n))
+
+
+def test_packed_context_fits_the_budget_and_keeps_every_title():
+    filler = " ".join(f"Filler sentence number {i} about nothing much." for i in range(40))
+    result = products(f"Anker USB-C cable. {filler}", f"Belkin HDMI cable. {filler}", f"Ugreen charger. {filler}")
+    packed = pack_context(result, "usb c cable", template=TEMPLATE, token_budget=120)
+
+    assert packed.tokens_after <= 120 < packed.tokens_before
+    assert sum(count_tokens(entry) for entry in packed.entries) <= 120
+    assert [entry.split("|")[2].split(". ")[0] for entry in packed.entries] == [
+        "Anker USB-C cable", "Belkin HDMI cable", "Ugreen charger"]
+
+
+def test_sentences_matching_the_query_are_kept_first():
+    result = products("Anker cable. Ships in a recyclable box. Braided nylon jacket for durability. "
+                      "Supports 100W fast charging over USB-C.")
+    packed = pack_context(result, "fast charging usb-c cable", template=TEMPLATE, token_budget=20)
+
+    description = packed.entries[0].split("|")[2]
+    assert description == "Anker cable. Supports 100W fast charging over USB-C."
+
+
+def test_sentences_repeated_by_a_variant_are_dropped():
+    shared = "Supports 100W fast charging."
+    packed = pack_context(products(f"Anker cable, black. {shared}", f"Anker cable, white. {shared}"),
+                          "fast charging", template=TEMPLATE, token_budget=1000)
+
+    assert shared in packed.entries[0]
+    assert shared not in packed.entries[1]
+
+
+def test_unused_budget_rolls_over_to_later_products():
+    long = "Anker cable. " + " ".join(f"Detail {i} about the braided jacket." for i in range(20))
+    short_then_long = pack_context(products("Tiny.", long), "cable", template=TEMPLATE, token_budget=100)
+    long_alone_half = pack_context(products(long), "cable", template=TEMPLATE, token_budget=50)
+
+    # the first product used a few tokens of its half, the second gets the rest
+    assert len(short_then_long.entries[1]) > len(long_alone_half.entries[0])
+    assert short_then_long.tokens_after <= 100
+
+
+def test_budget_per_model():
+    assert get_context_budget("gpt-4.1") == 3000
+    assert get_context_budget("some-new-model") == context_packing.DEFAULT_CONTEXT_TOKEN_BUDGET
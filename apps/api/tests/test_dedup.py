@@ -0,0 +1,72 @@
+from array import array
+
+import pytest
+
+from server.agents.dedup import collapse_near_duplicates, family_key, family_title, minhash_similarity
+from server.agents.retrieval_result import RetrievalResult
+from server.core.config import config
+
+# Listings of one product that differ in colour, size or pack count
+VARIANTS = [
+    ("Anker USB C Cable, PowerLine III USB A to USB C Charger Cable (6ft) - Black",
+     "Anker USB C Cable, PowerLine III USB A to USB C Charger Cable (6ft) - White"),
+    ("Apple AirPods Pro Case Cover, Silicone Protective Skin, Blue",
+     "Apple AirPods Pro Case Cover, Silicone Protective Skin, Pink"),
+    ("SanDisk 128GB Ultra microSDXC UHS-I Memory Card with Adapter, 2 Pack",
+     "SanDisk 128GB Ultra microSDXC UHS-I Memory Card with Adapter, 3 Pack"),
+    ("JBL Tune 510BT Wireless On-Ear Headphones with Purebass Sound - Black",
+     "JBL Tune 510BT Wireless On-Ear Headphones with Purebass Sound - Rose Gold"),
+    ("Logitech M185 Wireless Mouse, 2.4GHz with USB Mini Receiver, Gray",
+     "Logitech M185 Wireless Mouse, 2.4GHz with USB Mini Receiver, Red"),
+    ("Amazon Basics Lightning to USB Cable, MFi Certified, 6 Foot, White, 2-Pack",
+     "Amazon Basics Lightning to USB Cable, MFi Certified, 6 Foot, Black, 12-Pack"),
+    ("OtterBox Commuter Series Case for iPhone 13 - Black",
+     "OtterBox Commuter Series Case for iPhone 13 - Blue"),
+    ("Fire TV Stick Remote Cover, Silicone Case (Purple)",
+     "Fire TV Stick Remote Cover, Silicone Case (Green)"),
+]
+
+# Different products with mostly the same words, which must both stay
+DISTINCT = [
+    ("Anker USB C Cable, PowerLine III USB A to USB C Charger Cable (6ft) - Black",
+     "Anker USB C to Lightning Cable, PowerLine II MFi Certified (6ft) - Black"),
+    ("SanDisk 128GB Ultra microSDXC UHS-I Memory Card with Adapter",
+     "SanDisk 256GB Extreme microSDXC UHS-I Memory Card with Adapter"),
+    ("JBL Tune 510BT Wireless On-Ear Headphones with Purebass Sound - Black",
+     "JBL Tune 760NC Wireless Over-Ear Noise Cancelling Headphones - Black"),
+    ("Logitech M185 Wireless Mouse, 2.4GHz with USB Mini Receiver, Gray",
+     "Logitech M325 Wireless Mouse, 2.4GHz with USB Unifying Receiver, Gray"),
+    ("OtterBox Commuter Series Case for iPhone 13 - Black",
+     "OtterBox Commuter Series Case for iPhone 14 Pro - Black"),
+    ("Apple AirPods Pro Case Cover, Silicone Protective Skin, Blue",
+     "Apple AirPods 3rd Generation Case Cover, Silicone Protective Skin, Blue"),
+    ("Amazon Basics Lightning to USB Cable, MFi Certified, 6 Foot, White",
+     "Amazon Basics USB-C to Lightning Cable, MFi Certified, 6 Foot, White"),
+    ("Fire TV Stick Remote Cover, Silicone Case (Purple)",
+     "Roku Remote Cover, Silicone Case (Purple)"),
+]
+
+
+def retrieval(titles):
+    n = len(titles)
+    return RetrievalResult(ids=[f"B{i}" for i in range(n)], descriptions=list(titles), ratings=[4.5] * n,
+                           prices=[10.0] * n, images=[None] * n, scores=array("d", [1.0] * n))
+
+
+def test_family_title_and_key():
+    assert family_title("USB-C Cable (6ft) - Black, 2 Pack") == "usb c cable"
+    assert family_key("USB-C Cable (6ft) - Black, 2 Pack") == family_key("USB-C Cable - White")
+    assert len(family_key("USB-C Cable")) == 8
+
+
+@pytest.mark.parametrize("first, second", VARIANTS)
+def test_variants_collapse_at_the_default_threshold(first, second):
+    assert minhash_similarity([first, second])[0, 1] >= config.dedup_minhash_threshold
+    assert collapse_near_duplicates(retrieval([first, second]), threshold=config.dedup_minhash_threshold).context_ids == ["B0"]
+
+
+@pytest.mark.parametrize("first, second", DISTINCT)
+def test_distinct_products_are_kept_at_the_default_threshold(first, second):
+    # the closest of these pairs scores ~0.62, well under the threshold
+    assert minhash_similarity([first, second])[0, 1] < config.dedup_minhash_threshold - 0.1
+    assert len(collapse_near_duplicates(retrieval([first, second]), threshold=config.dedup_minhash_threshold)) == 2
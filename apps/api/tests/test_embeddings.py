@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from qdrant_client import QdrantClient, models
+
+from server.agents import retrieval_generation
+from server.agents.utils.deadline import Deadline, deadline_scope
+from server.core.config import config
+from server.core.metrics import metrics
+
+LOCAL_VECTOR = "bge-small-en-v1.5"
+
+
+class FakeEmbedder:
+    model_name = "BAAI/bge-small-en-v1.5"
+    vector_name = LOCAL_VECTOR
+
+    def __init__(self):
+        self.queries = []
+
+    def embed(self, texts):
+        raise AssertionError("queries must use the query embedding")
+
+    def embed_queries(self, texts):
+        self.queries.extend(texts)
+        return [[0.1, 0.2] for _ in texts]
+
+
+def qdrant_with_vectors(*names):
+    vectors = {name: object() for name in names}
+    info = SimpleNamespace(config=SimpleNamespace(params=SimpleNamespace(vectors=vectors)))
+    return mock.Mock(get_collection=mock.Mock(return_value=info))
+
+
+@pytest.fixture
+def local_first(monkeypatch):
+    embedder = FakeEmbedder()
+    monkeypatch.setattr(config, "embedding_backend", "local_first")
+    monkeypatch.setattr(config, "sharding_enabled", False)
+    monkeypatch.setattr(retrieval_generation, "get_local_embedder", lambda: embedder)
+    monkeypatch.setattr(retrieval_generation, "create_embeddings", lambda text: [0.3, 0.4])
+    retrieval_generation.collection_vectors_cache.tiers[0]._items.clear()
+    retrieval_generation.embedding_cache.tiers[0]._items.clear()
+    return embedder
+
+
+def test_local_first_uses_the_query_embedding(local_first):
+    qd_client = qdrant_with_vectors("text-embedding-3-small", LOCAL_VECTOR, "bm25")
+    using, embeddings = retrieval_generation.embed_queries(["usb c cable"], qd_client, "products")
+    assert using == LOCAL_VECTOR
+    assert embeddings == [[0.1, 0.2]]
+    assert local_first.queries == ["usb c cable"]
+
+
+def test_local_first_falls_back_without_the_local_vector(local_first):
+    qd_client = qdrant_with_vectors("text-embedding-3-small", "bm25")
+    using, embeddings = retrieval_generation.embed_queries(["usb c cable"], qd_client, "products")
+    assert using == retrieval_generation.REMOTE_VECTOR
+    assert embeddings == [[0.3, 0.4]]
+    assert local_first.queries == []
+
+    # the collection's vectors are looked up once, not on every query
+    retrieval_generation.embed_queries(["hdmi cable"], qd_client, "products")
+    assert qd_client.get_collection.call_count == 1
+
+
+def test_local_first_inside_a_request_deadline(local_first):
+    # a real client: under a deadline the qdrant limiter adds a timeout argument, which
+    # get_collection rejects, and the API always runs with one
+    qd_client = QdrantClient(location=":memory:")
+    qd_client.create_collection("products", vectors_config={
+        name: models.VectorParams(size=2, distance=models.Distance.COSINE)
+        for name in (retrieval_generation.REMOTE_VECTOR, LOCAL_VECTOR)
+    })
+    with deadline_scope(Deadline(30)):
+        using, embeddings = retrieval_generation.embed_queries(["usb c cable"], qd_client, "products")
+    assert using == LOCAL_VECTOR
+    assert embeddings == [[0.1, 0.2]]
+
+
+def test_local_first_falls_back_when_the_check_fails(local_first):
+    qd_client = mock.Mock(get_collection=mock.Mock(side_effect=ConnectionError("qdrant is down")))
+    errors = metrics.get("embedding_fallbacks_total", backend="local", reason="error")
+    using, embeddings = retrieval_generation.embed_queries(["usb c cable"], qd_client, "products")
+    assert using == retrieval_generation.REMOTE_VECTOR
+    assert metrics.get("embedding_fallbacks_total", backend="local", reason="error") == errors + 1
+    # not cached as "no local vector", the next query checks again
+    retrieval_generation.embed_queries(["usb c cable"], qd_client, "products")
+    assert qd_client.get_collection.call_count == 2
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from server.agents.utils.priority import PrioritySlots, resolve_priority
+from server.core.config import config
+
+
+@pytest.fixture(autouse=True)
+def api_keys(monkeypatch):
+    monkeypatch.setattr(config, "priority_api_keys", {"ui-key": "interactive", "etl-key": "background"})
+
+
+@pytest.mark.parametrize("headers, default, expected", [
+    ({}, "interactive", "interactive"),
+    ({}, "background", "background"),
+    # without a known key the header can lower the route's class, not raise it
+    ({"X-Priority": "interactive"}, "background", "background"),
+    ({"X-Priority": "interactive", "X-API-Key": "made-up"}, "background", "background"),
+    ({"X-Priority": "eval"}, "background", "eval"),
+    ({"X-Priority": "eval"}, "interactive", "eval"),
+    # a known key sets the ceiling, and its own class without the header
+    ({"X-API-Key": "ui-key", "X-Priority": "interactive"}, "background", "interactive"),
+    ({"X-API-Key": "ui-key"}, "background", "interactive"),
+    ({"X-API-Key": "etl-key", "X-Priority": "interactive"}, "interactive", "background"),
+    ({"X-API-Key": "etl-key", "X-Priority": "eval"}, "interactive", "eval"),
+    ({"X-Priority": "urgent"}, "background", "background"),
+])
+def test_resolve_priority(headers, default, expected):
+    assert resolve_priority(headers, default=default) == expected
+
+
+def slots(capacity, **kwargs):
+    return PrioritySlots("test", capacity, shares={}, max_queued={"interactive": 10, "background": 10, "eval": 1},
+                         **kwargs)
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.001)
+
+
+def test_freed_slot_goes_to_the_highest_waiting_class():
+    pool = slots(1, reserved_fraction=0)
+    assert pool.acquire("interactive", timeout=1)
+    order = []
+
+    def take(priority):
+        assert pool.acquire(priority, timeout=5)
+        order.append(priority)
+        pool.release(priority)
+
+    background = threading.Thread(target=take, args=("background",))
+    background.start()
+    wait_for(lambda: pool.waiting["background"] == 1)
+    interactive = threading.Thread(target=take, args=("interactive",))
+    interactive.start()
+    wait_for(lambda: pool.waiting["interactive"] == 1)
+
+    pool.release("interactive")
+    background.join(5)
+    interactive.join(5)
+    assert order == ["interactive", "background"]
+
+
+def test_release_wakes_the_waiter():
+    pool = slots(1, reserved_fraction=0)
+    assert pool.acquire("interactive", timeout=1)
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: pool.acquire("interactive", timeout=30) and acquired.set())
+    waiter.start()
+    wait_for(lambda: pool.waiting["interactive"] == 1)
+    # the waiter blocks on its condition, with nothing to wake it but the release
+    assert not acquired.wait(0.3)
+    pool.release("interactive")
+    assert acquired.wait(1)
+    waiter.join(1)
+
+
+def test_hold_back_ends_as_the_interactive_wait_decays():
+    pool = slots(4, reserved_fraction=0.25, wait_slo=0.2, decay_seconds=0.05)
+    assert pool.acquire("interactive", timeout=1) and pool.acquire("interactive", timeout=1)
+    # interactive calls queued well past the SLO: half of the slots are kept for them
+    pool._interactive_wait, pool._interactive_wait_at = 1.0, time.monotonic()
+    assert pool.slo_at_risk()
+
+    start = time.monotonic()
+    assert pool.acquire("background", timeout=5)
+    # no release happened; it is admitted once the wait decays under the SLO (~0.08s)
+    assert 0.05 < time.monotonic() - start < 1
+
+
+def test_full_queue_and_timeout():
+    pool = slots(1, reserved_fraction=0)
+    assert pool.acquire("interactive", timeout=1)
+    assert pool.acquire("eval", timeout=0.05) is False
+
+    blocked = threading.Thread(target=pool.acquire, args=("eval", 1))
+    blocked.start()
+    wait_for(lambda: pool.waiting["eval"] == 1)
+    # eval may queue one call
+    assert pool.acquire("eval", timeout=1) is None
+    blocked.join(2)
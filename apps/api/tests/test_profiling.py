@@ -0,0 +1,129 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.tools import tool
+from langgraph.graph import END, START, MessagesState, StateGraph
+from langgraph.prebuilt import ToolNode
+
+from server.agents.utils import profiling
+from server.core.config import config
+
+
+def spin(seconds: float) -> int:
+    end, n = time.thread_time() + seconds, 0
+    while time.thread_time() < end:
+        n += 1
+    return n
+
+
+def spin_in_pool(seconds: float) -> int:
+    return spin(seconds)
+
+
+@tool
+def busy_search(query: str) -> str:
+    """Searches the catalogue, on the CPU and on a pool thread like the shard fan-out."""
+    spin(0.2)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(profiling.profiled(spin_in_pool), 0.2).result()
+    return "found"
+
+
+@pytest.fixture
+def profiles_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "profiling_dir", str(tmp_path))
+    return tmp_path
+
+
+def test_tool_threads_are_sampled(profiles_dir):
+    workflow = StateGraph(MessagesState)
+    workflow.add_node("tools", ToolNode([busy_search]))
+    workflow.add_edge(START, "tools")
+    workflow.add_edge("tools", END)
+    graph = workflow.compile()
+    call = AIMessage(content="", tool_calls=[{"name": "busy_search", "args": {"query": "usb c"}, "id": "call-1"}])
+
+    with profiling.request_profiling("tool-profile"), profiling.profile_scope():
+        graph.invoke({"messages": [call]}, config={"callbacks": profiling.graph_callbacks()})
+
+    stacks = (profiles_dir / "tool-profile.collapsed").read_text().splitlines()
+    # ToolNode runs the tool on an executor thread of its own, sampled under the node and tool
+    assert any(line.startswith("tools/busy_search;") and "test_profiling.py:spin " in line.replace(";", " ")
+               for line in stacks)
+    # and the pool thread the tool hands work to, under the tool's label
+    assert any(line.startswith("tools/busy_search;") and "test_profiling.py:spin_in_pool" in line
+               for line in stacks)
+
+    nodes = json.loads((profiles_dir / "tool-profile.json").read_text())["nodes"]
+    assert nodes["tools/busy_search"]["cpu_seconds"] >= 0.15
+
+
+def test_profiled_without_a_profile_is_the_function():
+    assert profiling.profiled(spin) is spin
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setattr(config, "profiling_secret", "s3cret")
+    monkeypatch.setattr(profiling, "_window_until", 0.0)
+
+
+def test_tokens_are_signed_and_expire(secret, monkeypatch):
+    token = profiling.make_token(60)
+    assert profiling.verify_token(token)
+    expires, _, signature = token.partition(".")
+    assert not profiling.verify_token(f"{int(expires) + 60}.{signature}")
+    assert not profiling.verify_token(profiling.make_token(-1))
+    assert not profiling.verify_token(None) and not profiling.verify_token("garbage")
+    # no secret, no profiling, whatever the token
+    monkeypatch.setattr(config, "profiling_secret", None)
+    assert not profiling.verify_token(token)
+
+
+def test_window_profiles_every_request_until_it_closes(secret, monkeypatch):
+    monkeypatch.setattr(config, "profiling_max_window_seconds", 0.1)
+    assert not profiling.wants_profile({})
+    assert profiling.wants_profile({"X-Profile-Token": profiling.make_token(60)})
+
+    # capped at the configured maximum
+    assert profiling.open_window(3600) == 0.1
+    assert profiling.wants_profile({})
+    time.sleep(0.15)
+    assert not profiling.wants_profile({})
+
+
+def test_concurrent_profiles_are_capped(profiles_dir, monkeypatch):
+    monkeypatch.setattr(profiling, "_active", threading.BoundedSemaphore(1))
+    second = {}
+
+    def another_request():
+        with profiling.request_profiling("second"), profiling.profile_scope() as profile:
+            second["profile"] = profile
+
+    with profiling.request_profiling("first"), profiling.profile_scope() as first:
+        assert first is not None
+        # a request on another thread while the only slot is taken runs unprofiled
+        thread = threading.Thread(target=contextvars.Context().run, args=(another_request,))
+        thread.start()
+        thread.join(5)
+    assert second["profile"] is None
+    assert profiling.list_profiles(str(profiles_dir)) == ["first"]
+
+
+def test_only_the_newest_profiles_are_kept(profiles_dir, monkeypatch):
+    monkeypatch.setattr(config, "profiling_max_files", 2)
+    for i, profile_id in enumerate(["a", "b", "c"]):
+        with profiling.request_profiling(profile_id), profiling.profile_scope():
+            pass
+        os.utime(profiles_dir / f"{profile_id}.json", (i + 1, i + 1))
+    with profiling.request_profiling("d"), profiling.profile_scope():
+        pass
+
+    assert set(profiling.list_profiles(str(profiles_dir))) == {"c", "d"}
+    assert not (profiles_dir / "a.collapsed").exists()
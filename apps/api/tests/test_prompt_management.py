@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from server.agents.utils import prompt_management
+from server.agents.utils.llm_usage import record_llm_usage
+from server.agents.utils.prompt_management import get_prompt_from_config, render_messages
+from server.core.metrics import metrics
+
+PROMPTS = Path(prompt_management.__file__).parents[1] / "prompts"
+
+
+@pytest.mark.parametrize("file, key, variables", [
+    ("router_agent.yml", "router_agent", {"question": "{}"}),
+    ("query_expand_agent.yml", "query_expand_agent", {"query": "{}"}),
+    ("rag_system.yml", "retrieval_generation", {"question": "{}", "preprocessed_context": "Product ID: B{}"}),
+])
+def test_request_content_only_in_the_user_message(file, key, variables):
+    first = render_messages(str(PROMPTS / file), key, **{k: v.format("usb c cable") for k, v in variables.items()})
+    second = render_messages(str(PROMPTS / file), key, **{k: v.format("hdmi adapter") for k, v in variables.items()})
+
+    assert [m["role"] for m in first] == ["system", "user"]
+    # the instructions are an identical prefix for every request
+    assert first[0] == second[0]
+    assert "usb c cable" not in first[0]["content"] and "usb c cable" in first[1]["content"]
+
+
+def test_agent_prompt_ends_with_the_tool_schemas():
+    template = get_prompt_from_config(str(PROMPTS / "search_agent.yml"), "search_agent")
+    prompt = template.render(available_tools=[{"name": "retrieve_embedding"}])
+    assert prompt.rstrip().endswith('[{"name": "retrieve_embedding"}]\n</Available tools>')
+
+
+def write_prompts(path, body):
+    path.write_text("prompts:\n" + body)
+
+
+def test_prompt_without_input_part_is_one_system_message(tmp_path):
+    path = tmp_path / "prompts.yml"
+    write_prompts(path, "  summary: |\n    Summarize {{ text }}\n")
+    assert render_messages(str(path), "summary", text="this") == [{"role": "system", "content": "Summarize this"}]
+
+
+def test_prompts_are_reloaded_when_the_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / "prompts.yml"
+    write_prompts(path, "  greet: |\n    Hello {{ name }}\n")
+    os.utime(path, (1, 1))
+    reads = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda *args, **kwargs: reads.append(args[0]) or real_open(*args, **kwargs))
+
+    assert render_messages(str(path), "greet", name="Ana")[0]["content"] == "Hello Ana"
+    assert render_messages(str(path), "greet", name="Bo")[0]["content"] == "Hello Bo"
+    assert reads == [str(path)]
+
+    write_prompts(path, "  greet: |\n    Hi {{ name }}\n")
+    os.utime(path, (2, 2))
+    assert render_messages(str(path), "greet", name="Ana")[0]["content"] == "Hi Ana"
+    assert reads == [str(path), str(path)]
+
+
+def test_cached_prompt_tokens_are_recorded():
+    usage = SimpleNamespace(prompt_tokens=1800, completion_tokens=40, total_tokens=1840,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1536))
+    before = metrics.get("llm_cached_prompt_tokens_total", node="test_node", model="gpt-4.1-mini")
+    record_llm_usage(SimpleNamespace(usage=usage), "gpt-4.1-mini", "test_node")
+    assert metrics.get("llm_cached_prompt_tokens_total", node="test_node", model="gpt-4.1-mini") - before == 1536
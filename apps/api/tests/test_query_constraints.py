@@ -0,0 +1,49 @@
+import pytest
+
+from server.agents.query_constraints import QueryConstraints, extract_constraints
+
+CASES = [
+    # numbers that are not prices
+    ("at least 4-star headphones", {"min_rating": 4}),
+    ("toys for kids over 5", {}),
+    ("phone up to 2", {}),
+    ("toys for ages 3 to 5", {}),
+    ("battery lasting over 10 hours", {}),
+    ("3 pack of usb cables", {}),
+    ("tv over 55 inches under $500", {"max_price": 500}),
+    # prices with a currency marker
+    ("headphones under $50 with at least 4 stars", {"max_price": 50, "min_rating": 4}),
+    ("usb c cable under 20 dollars", {"max_price": 20}),
+    ("3 pack of cables under 10 bucks", {"max_price": 10}),
+    ("webcam over $40", {"min_price": 40}),
+    ("ssd at least 100$", {"min_price": 100}),
+    # bare numbers after a price word
+    ("laptop priced under 800", {"max_price": 800}),
+    ("monitor with a budget up to 300", {"max_price": 300}),
+    ("price under 50 for a 2 year old", {"max_price": 50}),
+    ("speaker that costs more than 100", {"min_price": 100}),
+    # ranges
+    ("earbuds 20 to 40 dollars", {"min_price": 20, "max_price": 40}),
+    ("earbuds 20-40$", {"min_price": 20, "max_price": 40}),
+    ("keyboards between $30 and $60", {"min_price": 30, "max_price": 60}),
+    ("keyboards between $30 and 60", {"min_price": 30, "max_price": 60}),
+    ("speakers between 30 and 60 dollars", {"min_price": 30, "max_price": 60}),
+    ("mice priced between 10 and 25", {"min_price": 10, "max_price": 25}),
+    ("cables $5-$15", {"min_price": 5, "max_price": 15}),
+    ("chargers from $20 to 10", {"min_price": 10, "max_price": 20}),
+    ("mice between 10 and 25", {}),
+    # ratings
+    ("rated at least 4.5 with 1k+ reviews", {"min_rating": 4.5, "min_rating_count": 1000}),
+    ("lamp with 4+ stars and 2,500 ratings", {"min_rating": 4, "min_rating_count": 2500}),
+]
+
+
+@pytest.mark.parametrize("query, expected", CASES)
+def test_extract_constraints(query, expected):
+    assert extract_constraints(query).model_dump(exclude_none=True) == expected
+
+
+def test_filter_from_constraints():
+    assert QueryConstraints().to_filter() is None
+    conditions = QueryConstraints(max_price=50, min_rating=4).to_filter().must
+    assert [(c.key, c.range.gte, c.range.lte) for c in conditions] == [("price", None, 50), ("average_rating", 4, None)]
@@ -0,0 +1,49 @@
+import json
+import os
+import stat
+import time
+
+from server.core.config import Config
+from server.core.query_log import QueryLog
+
+
+def test_log_is_off_by_default():
+    assert Config.model_fields["query_log_path"].default is None
+    log = QueryLog(None, max_bytes=1 << 20, max_age=3600)
+    log.record("question", "usb c cable under $20")
+    # the warmup CLI reads it whether or not a path is set
+    assert list(log.read(since_seconds=3600)) == []
+
+
+def test_log_is_only_readable_by_its_owner(tmp_path):
+    path = str(tmp_path / "queries.jsonl")
+    log = QueryLog(path, max_bytes=1 << 20, max_age=3600)
+    log.record("question", "usb c cable under $20", priority="interactive")
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert [entry["query"] for entry in log.read()] == ["usb c cable under $20"]
+
+
+def test_log_rotates_by_size(tmp_path):
+    path = str(tmp_path / "queries.jsonl")
+    log = QueryLog(path, max_bytes=100, max_age=3600)
+    for i in range(10):
+        log.record("search", f"query {i} " + "x" * 20)
+    assert os.path.getsize(path) <= 200
+    # the previous file is kept, the one before it is gone
+    assert [entry["query"][:8] for entry in log.read()][-1] == "query 9 "
+    assert len(list(log.read())) < 10
+
+
+def test_log_rotates_by_age(tmp_path):
+    path = str(tmp_path / "queries.jsonl")
+    with open(path, "w") as file:
+        file.write(json.dumps({"ts": time.time() - 7200, "kind": "question", "query": "two hours old"}) + "\n")
+    with open(path + ".1", "w") as file:
+        file.write(json.dumps({"ts": time.time() - 10800, "kind": "question", "query": "three hours old"}) + "\n")
+
+    log = QueryLog(path, max_bytes=1 << 20, max_age=3600)
+    log.record("question", "new")
+    assert [entry["query"] for entry in log.read()] == ["two hours old", "new"]
+    log.record("question", "newer")
+    # the current file now starts with a recent entry and is not rotated again
+    assert [entry["query"] for entry in log.read()] == ["two hours old", "new", "newer"]
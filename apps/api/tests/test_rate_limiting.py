@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+from server.agents.utils import rate_limiting
+from server.agents.utils.deadline import Deadline, deadline_scope
+from server.agents.utils.rate_limiting import TokenBucket, UpstreamLimiter, UpstreamRejectedError, is_retryable
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class Flaky:
+    """Raises the given errors in turn, then answers."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(rate_limiting.time, "sleep", slept.append)
+    return slept
+
+
+def limiter(**kwargs):
+    return UpstreamLimiter("test", rate=1000, max_concurrency=2, max_queue_wait=1, **kwargs)
+
+
+def test_bucket_allows_a_burst_then_paces_at_its_rate():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket.reserve(max_wait=1) for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.1, abs=0.01)
+    # the next token is already promised, the one after is ~0.2s away
+    assert bucket.reserve(max_wait=0.15) is None
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.2, abs=0.01)
+
+
+def test_bucket_refills_over_time():
+    bucket = TokenBucket(rate=50, capacity=1)
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) is None
+    time.sleep(0.05)
+    assert bucket.reserve(max_wait=0) == 0
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (UpstreamError(429), True),
+    (UpstreamError(503), True),
+    (UpstreamError(400), False),
+    (TimeoutError(), True),
+    (ValueError("bad schema"), False),
+])
+def test_retryable_errors(error, retryable):
+    assert is_retryable(error) is retryable
+
+
+def test_wrapped_upstream_error_is_retryable():
+    try:
+        try:
+            raise UpstreamError(429)
+        except UpstreamError as e:
+            raise RuntimeError("the client wrapper gave up") from e
+    except RuntimeError as wrapped:
+        assert is_retryable(wrapped)
+
+
+def test_retries_with_jittered_exponential_backoff(sleeps, monkeypatch):
+    monkeypatch.setattr(rate_limiting.random, "uniform", lambda low, high: high)
+    fn = Flaky(UpstreamError(503), UpstreamError(503), UpstreamError(503))
+    assert limiter(max_retries=3, base_delay=0.5, max_delay=1.5).call(fn) == "ok"
+    assert len(fn.calls) == 4
+    # the jitter's upper bound doubles each attempt, up to max_delay
+    assert sleeps == [0.5, 1.0, 1.5]
+
+
+def test_retry_after_header_sets_the_delay(sleeps):
+    fn = Flaky(UpstreamError(429, {"retry-after": "2"}), UpstreamError(429, {"retry-after-ms": "250"}))
+    assert limiter(max_delay=20).call(fn) == "ok"
+    assert sleeps == [2.0, 0.25]
+
+
+def test_gives_up_after_max_retries(sleeps):
+    fn = Flaky(*[UpstreamError(429)] * 3)
+    with pytest.raises(UpstreamError):
+        limiter(max_retries=2).call(fn)
+    assert len(fn.calls) == 3
+
+
+def test_client_errors_are_not_retried(sleeps):
+    fn = Flaky(UpstreamError(400))
+    with pytest.raises(UpstreamError):
+        limiter().call(fn)
+    assert len(fn.calls) == 1 and sleeps == []
+
+
+def test_no_retry_that_cannot_finish_before_the_deadline(sleeps):
+    fn = Flaky(UpstreamError(429, {"retry-after": "30"}))
+    with deadline_scope(Deadline(5)), pytest.raises(UpstreamError):
+        limiter(max_delay=60).call(fn)
+    assert len(fn.calls) == 1 and sleeps == []
+
+
+def test_timeout_comes_from_the_remaining_deadline(sleeps):
+    fn = Flaky()
+    with deadline_scope(Deadline(5)):
+        limiter(timeout_arguments=lambda seconds: {"timeout": seconds}).call(fn)
+    assert 4 < fn.calls[0]["timeout"] <= 5
+
+
+def test_rejected_when_the_rate_token_is_too_far_away():
+    slow = UpstreamLimiter("test", rate=1, max_concurrency=2, max_queue_wait=0.1)
+    assert slow.call(lambda: "first") == "first"
+    with pytest.raises(UpstreamRejectedError) as rejected:
+        slow.call(lambda: "second")
+    assert rejected.value.retry_after == 1
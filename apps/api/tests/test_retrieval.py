@@ -0,0 +1,98 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from server.agents import retrieval_generation
+from server.agents.models import RAGResponse
+from server.agents.retrieval_result import RetrievalResult
+from server.core.config import config
+
+
+def qdrant_missing_snippets(missing: int):
+    return mock.Mock(count=mock.Mock(return_value=SimpleNamespace(count=missing)))
+
+
+@pytest.fixture(autouse=True)
+def single_collection(monkeypatch):
+    monkeypatch.setattr(config, "sharding_enabled", False)
+    monkeypatch.setattr(config, "dedup_method", "minhash")
+    retrieval_generation.snippet_coverage_cache.tiers[0]._items.clear()
+
+
+def test_payload_reads_only_snippets_once_backfilled(monkeypatch):
+    monkeypatch.setattr(config, "llm_snippets_enabled", True)
+    qd_client = qdrant_missing_snippets(0)
+    fields = retrieval_generation.payload_fields(qd_client, "products")
+    assert "llm_snippet" in fields and "description" not in fields
+    # checked once, not on every search
+    retrieval_generation.payload_fields(qd_client, "products")
+    assert qd_client.count.call_count == 1
+
+
+def test_payload_reads_descriptions_until_backfilled(monkeypatch):
+    monkeypatch.setattr(config, "llm_snippets_enabled", True)
+    fields = retrieval_generation.payload_fields(qdrant_missing_snippets(120), "products")
+    assert "llm_snippet" in fields and "description" in fields
+
+
+def test_payload_without_snippets(monkeypatch):
+    monkeypatch.setattr(config, "llm_snippets_enabled", False)
+    qd_client = qdrant_missing_snippets(0)
+    fields = retrieval_generation.payload_fields(qd_client, "products")
+    assert "description" in fields and "llm_snippet" not in fields
+    qd_client.count.assert_not_called()
+
+
+def test_points_without_snippet_use_the_description():
+    points = [
+        SimpleNamespace(vector=None, score=0.9, payload={"parent_asin": "B1", "llm_snippet": "USB-C cable, 6ft",
+                                                         "description": "USB-C cable, 6ft, braided nylon..."}),
+        SimpleNamespace(vector=None, score=0.8, payload={"parent_asin": "B2", "description": "HDMI cable, 4K"}),
+    ]
+    assert RetrievalResult.from_points(points).context == ["USB-C cable, 6ft", "HDMI cable, 4K"]
+
+
+def reranked_products():
+    points = [
+        SimpleNamespace(vector=None, score=0.9, payload={"parent_asin": "B1", "description": "USB-C cable, 6ft",
+                                                         "average_rating": 4.5, "price": 9.99,
+                                                         "image": "https://images.example/B1.jpg"}),
+        SimpleNamespace(vector=None, score=0.8, payload={"parent_asin": "B2", "description": "HDMI cable, 4K",
+                                                         "average_rating": 4.1, "price": None, "image": None}),
+    ]
+    return RetrievalResult.from_points(points)
+
+
+def test_pipeline_result_is_plain_json():
+    products = reranked_products()
+    response = RAGResponse(answer="Take the USB-C cable.", references=[{"id": "B1", "description": "USB-C cable"}])
+    result = retrieval_generation.pipeline_result("usb c cable", products, products.take([1, 0]), response)
+
+    assert json.loads(json.dumps(result)) == result
+    assert [record["id"] for record in result["reranked_context"]] == ["B2", "B1"]
+    assert result["reranked_context"][1] == {"id": "B1", "description": "USB-C cable, 6ft", "rating": 4.5,
+                                             "price": 9.99, "image": "https://images.example/B1.jpg", "score": 0.9}
+
+
+def test_used_context_looks_up_references_outside_the_reranked_products(monkeypatch):
+    looked_up = []
+
+    def lookup(qdrant_client, product_id):
+        looked_up.append(product_id)
+        return {"parent_asin": product_id, "image": "https://images.example/B9.jpg", "price": 25.0}
+
+    monkeypatch.setattr(retrieval_generation, "get_product_metadata", lookup)
+    monkeypatch.setattr(retrieval_generation, "thumbnail_url", lambda product_id, image: image)
+    result = {
+        "references": [{"id": "B1", "description": "USB-C cable"}, {"id": "B2", "description": "HDMI cable"},
+                       {"id": "B9", "description": "Charger from the earlier candidates"}],
+        "reranked_context": reranked_products().to_records(),
+    }
+
+    used = retrieval_generation.get_used_context(result, qdrant_client=mock.Mock())
+    # B1 is read from the reranked products, B9 from Qdrant; B2 has no image
+    assert looked_up == ["B9"]
+    assert [(item["id"], item["image_url"], item["price"]) for item in used] == [
+        ("B1", "https://images.example/B1.jpg", 9.99), ("B9", "https://images.example/B9.jpg", 25.0)]
@@ -0,0 +1,91 @@
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from qdrant_client.models import ScoredPoint
+
+from server.agents import sharding
+from server.agents.sharding import ShardRegistry, rrf_merge, search_shards, shard_key
+
+
+def point(product_id, score, **payload):
+    return ScoredPoint(id=abs(hash(product_id)) % 10 ** 9, version=0, score=score,
+                       payload={"parent_asin": product_id, **payload})
+
+
+def registry():
+    # three categories along the axes of a 3-dimensional embedding space
+    return ShardRegistry(["products-audio", "products-cables", "products-toys"], np.eye(3, dtype=np.float32),
+                         [100, 100, 100])
+
+
+@pytest.mark.parametrize("category, key", [
+    ("Cell Phones & Accessories", "cell-phones-accessories"),
+    ("All Electronics", "all-electronics"),
+    ("", "other"),
+    (None, "other"),
+])
+def test_shard_key(category, key):
+    assert shard_key(category) == key
+
+
+def test_confident_query_goes_to_one_shard():
+    assert registry().predict([0.05, 1.0, 0.0], max_fanout=2, min_coverage=0.8, temperature=0.05) == ["products-cables"]
+
+
+def test_ambiguous_query_goes_to_the_likely_shards():
+    route = registry().predict([1.0, 1.0, 0.0], max_fanout=2, min_coverage=0.8, temperature=0.05)
+    assert sorted(route) == ["products-audio", "products-cables"]
+
+
+def test_no_confident_route_falls_back_to_every_shard():
+    assert registry().predict([1.0, 1.0, 1.0], max_fanout=2, min_coverage=0.8, temperature=0.05) is None
+
+
+def test_rrf_merge_ranks_by_fused_rank_and_cuts_each_branch():
+    branches = {
+        "dense": [point("B1", 0.9), point("B2", 0.8), point("B3", 0.7)],
+        "bm25": [point("B2", 12.0), point("B3", 9.0), point("B1", 1.0)],
+    }
+    merged = rrf_merge(branches, k=3, prefetch_limit=2)
+    # B1 only counts in the dense branch once the branches are cut to their top 2
+    assert [p.payload["parent_asin"] for p in merged] == ["B2", "B1", "B3"]
+    assert merged[0].score == pytest.approx(1 / 3 + 1 / 2)
+
+
+def test_rrf_merge_keeps_one_point_per_group():
+    branches = {"dense": [point("B1", 0.9, family_key="f1"), point("B2", 0.8, family_key="f1"),
+                          point("B3", 0.7, family_key="f2")]}
+    merged = rrf_merge(branches, k=2, prefetch_limit=10, group_by="family_key")
+    assert [p.payload["parent_asin"] for p in merged] == ["B1", "B3"]
+
+
+class ShardedQdrant:
+    """query_batch_points over fixed per-shard hits, recording which shard each query reached."""
+
+    def __init__(self, hits):
+        self.hits = hits
+        self.searched = []
+        self._lock = threading.Lock()
+
+    def query_batch_points(self, collection_name, requests, **kwargs):
+        with self._lock:
+            self.searched.append((collection_name, len(requests) // 2))
+        return [SimpleNamespace(points=self.hits[collection_name]) for _ in requests]
+
+
+def test_search_shards_routes_each_query_and_merges(monkeypatch):
+    monkeypatch.setattr(sharding, "get_shard_registry", lambda qd_client, base, vector_name: registry())
+    qd_client = ShardedQdrant({
+        "products-audio": [point("A1", 0.9), point("A2", 0.5)],
+        "products-cables": [point("C1", 0.8)],
+        "products-toys": [point("T1", 0.7)],
+    })
+
+    results = search_shards(qd_client, "products", ["usb c cable", "gift"], [[0, 1, 0], [1, 1, 1]], k=3)
+
+    assert [p.payload["parent_asin"] for p in results[0]] == ["C1"]
+    # the ambiguous query searched every shard and gets the best hit of each
+    assert [p.payload["parent_asin"] for p in results[1]] == ["A1", "C1", "T1"]
+    assert sorted(qd_client.searched) == [("products-audio", 1), ("products-cables", 2), ("products-toys", 1)]
@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from server.agents.utils.deadline import Deadline, DeadlineExceededError, RequestCancelledError, deadline_scope
+from server.agents.utils.single_flight import SingleFlight
+
+
+class Leader:
+    """A call that blocks until released, then returns or raises what the test set."""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(self.outcome, BaseException):
+            raise self.outcome
+        return self.outcome
+
+
+def run_leader_and_follower(flight, leader_fn, follower_fn):
+    """Starts a leader, joins a follower once it is in flight, then releases the leader."""
+    joined = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, "key", leader_fn)
+        assert leader_fn.started.wait(5)
+        follower = executor.submit(flight.do, "key", follower_fn, on_follow=lambda shared: joined.set())
+        assert joined.wait(5)
+        leader_fn.release.set()
+        return leader, follower
+
+
+def test_followers_share_the_result():
+    flight = SingleFlight("test")
+    leader_fn = Leader("answer")
+    follower_fn = Leader("never")
+    leader, follower = run_leader_and_follower(flight, leader_fn, follower_fn)
+    assert leader.result(5) == follower.result(5) == "answer"
+    assert follower_fn.calls == 0
+
+
+def test_followers_get_the_leaders_error():
+    flight = SingleFlight("test")
+    leader_fn = Leader(ValueError("upstream said no"))
+    follower_fn = Leader("never")
+    leader, follower = run_leader_and_follower(flight, leader_fn, follower_fn)
+    with pytest.raises(ValueError, match="upstream said no"):
+        leader.result(5)
+    with pytest.raises(ValueError, match="upstream said no"):
+        follower.result(5)
+    assert follower_fn.calls == 0
+
+
+@pytest.mark.parametrize("error", [RequestCancelledError("client gone"), DeadlineExceededError("out of time")])
+def test_followers_rerun_a_call_the_leader_abandoned(error):
+    flight = SingleFlight("test")
+    leader_fn = Leader(error)
+    follower_fn = Leader("own answer")
+    follower_fn.release.set()
+    leader, follower = run_leader_and_follower(flight, leader_fn, follower_fn)
+    with pytest.raises(type(error)):
+        leader.result(5)
+    # the leader's own cancellation is not the follower's failure
+    assert follower.result(5) == "own answer"
+    assert follower_fn.calls == 1
+
+
+def test_follower_stops_waiting_at_its_own_deadline():
+    flight = SingleFlight("test", timeout=30)
+    leader_fn = Leader("slow answer")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader = executor.submit(flight.do, "key", leader_fn)
+        assert leader_fn.started.wait(5)
+        start = time.monotonic()
+        with deadline_scope(Deadline(0.1)), pytest.raises(DeadlineExceededError):
+            flight.do("key", Leader("never"))
+        assert time.monotonic() - start < 1
+        leader_fn.release.set()
+        assert leader.result(5) == "slow answer"
+
+
+def test_nothing_is_cached_after_the_call():
+    flight = SingleFlight("test")
+    calls = []
+    assert flight.do("key", lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do("key", lambda: calls.append(1) or len(calls)) == 2
@@ -0,0 +1,125 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from server.agents.models import AgentResponse, Toolcall
+from server.agents.utils import structured_output
+from server.agents.utils.structured_output import StructuredOutputError, response_format, structured_completion
+from server.core.metrics import metrics
+
+
+def objects(schema):
+    """Every object node of a JSON schema."""
+    if isinstance(schema, list):
+        for item in schema:
+            yield from objects(item)
+    elif isinstance(schema, dict):
+        if schema.get("type") == "object":
+            yield schema
+        for value in schema.values():
+            yield from objects(value)
+
+
+def test_schema_is_strict():
+    compiled = response_format(AgentResponse)
+    assert compiled["json_schema"]["strict"] is True
+    schema = compiled["json_schema"]["schema"]
+    for node in objects(schema):
+        assert node["additionalProperties"] is False
+        assert node["required"] == list(node["properties"])
+    assert '"title"' not in json.dumps(schema) and '"default"' not in json.dumps(schema)
+    # free-form objects have no strict form, the arguments are requested as JSON text
+    assert schema["$defs"]["Toolcall"]["properties"]["arguments"]["type"] == "string"
+    assert response_format(AgentResponse) is compiled
+
+
+def test_tool_call_arguments_are_decoded_from_json_text():
+    call = Toolcall(name="retrieve_embedding", arguments='{"query": "usb c cable", "max_price": 20}')
+    assert call.arguments == {"query": "usb c cable", "max_price": 20}
+    # what the graph stores decodes back to the same call
+    assert Toolcall.model_validate_json(call.model_dump_json()) == call
+    assert Toolcall(name="retrieve_embedding", arguments={"query": "hdmi"}).arguments == {"query": "hdmi"}
+
+
+@pytest.mark.parametrize("arguments", ['{"query": "usb c', '["usb c cable"]', '"usb c cable"'])
+def test_tool_call_arguments_must_be_a_json_object(arguments):
+    with pytest.raises(ValidationError):
+        Toolcall(name="retrieve_embedding", arguments=arguments)
+
+
+def reply(content, finish_reason="stop", refusal=None, total_tokens=100):
+    usage = SimpleNamespace(prompt_tokens=total_tokens - 10, completion_tokens=10, total_tokens=total_tokens,
+                            prompt_tokens_details=None)
+    message = SimpleNamespace(content=content, refusal=refusal)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)], usage=usage)
+
+
+class Model:
+    """chat.completions.create returning the given replies in turn, recording what it was sent."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.replies.pop(0)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    def use(*replies):
+        fake = Model(*replies)
+        monkeypatch.setattr(structured_output, "get_openai_client", lambda: fake)
+        return fake
+    return use
+
+
+ANSWER = {"answer": "Take the Anker cable.", "references": [{"id": "B1", "description": "Anker cable"}],
+          "final_answer": True,
+          "tool_calls": [{"name": "retrieve_embedding", "arguments": '{"query": "usb c cable"}'}]}
+
+
+def test_strict_reply_is_parsed_with_its_json_arguments(model):
+    fake = model(reply(json.dumps(ANSWER)))
+    response, _ = structured_completion(AgentResponse, [{"role": "user", "content": "usb c?"}],
+                                        model="gpt-4.1-mini", node="test_strict")
+
+    assert response.tool_calls[0].arguments == {"query": "usb c cable"}
+    assert fake.requests[0]["response_format"] == response_format(AgentResponse)
+
+
+def test_truncated_reply_is_asked_again_and_counted(model):
+    fake = model(reply(json.dumps(ANSWER)[:40], finish_reason="length", total_tokens=300), reply(json.dumps(ANSWER)))
+    labels = {"node": "test_truncated", "model": "gpt-4.1-mini"}
+    before = metrics.get("llm_structured_retries_total", reason="truncated", **labels)
+
+    response, _ = structured_completion(AgentResponse, [{"role": "user", "content": "usb c?"}],
+                                        model="gpt-4.1-mini", node="test_truncated", max_retries=1)
+
+    assert response.answer == "Take the Anker cable."
+    assert metrics.get("llm_structured_retries_total", reason="truncated", **labels) == before + 1
+    # the retry is sent with the broken reply and the error
+    assert [m["role"] for m in fake.requests[1]["messages"]] == ["user", "assistant", "user"]
+    assert metrics.get("llm_structured_retry_tokens_total", **labels) >= 100
+
+
+def test_bad_arguments_are_a_validation_retry(model):
+    bad = {**ANSWER, "tool_calls": [{"name": "retrieve_embedding", "arguments": "{query: usb c}"}]}
+    model(reply(json.dumps(bad)), reply(json.dumps(bad)))
+    with pytest.raises(StructuredOutputError):
+        structured_completion(AgentResponse, [{"role": "user", "content": "usb c?"}],
+                              model="gpt-4.1-mini", node="test_bad_arguments", max_retries=1)
+    assert metrics.get("llm_structured_retries_total", node="test_bad_arguments", model="gpt-4.1-mini",
+                       reason="validation") == 2
+
+
+def test_refusal_is_not_retried(model):
+    fake = model(reply(None, refusal="I can't help with that."))
+    with pytest.raises(StructuredOutputError, match="refused"):
+        structured_completion(AgentResponse, [{"role": "user", "content": "usb c?"}],
+                              model="gpt-4.1-mini", node="test_refusal", max_retries=2)
+    assert len(fake.requests) == 1
@@ -0,0 +1,75 @@
+import io
+import os
+
+import httpx
+import pytest
+from PIL import Image
+
+from server.core import thumbnails
+from server.core.config import config
+from server.core.thumbnails import ThumbnailStore, content_type, make_thumbnail
+
+
+def encoded(image: Image.Image, format: str) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format=format)
+    return output.getvalue()
+
+
+@pytest.fixture
+def source(monkeypatch):
+    """Serves the bytes put in `source["image"]` as the product's source image."""
+    served = {}
+    client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=served["image"])))
+    monkeypatch.setattr(thumbnails, "_http_client", client)
+    return served
+
+
+def test_thumbnail_is_a_card_sized_jpeg(source):
+    source["image"] = encoded(Image.new("RGB", (1500, 1000), (200, 30, 30)), "PNG")
+    data = make_thumbnail("https://images.example/B1.png", size=280)
+
+    assert content_type(data) == "image/jpeg"
+    thumbnail = Image.open(io.BytesIO(data))
+    # fits the box, keeps the aspect ratio
+    assert thumbnail.size == (280, 187)
+    assert len(data) < len(source["image"]) / 4
+
+
+def test_transparent_image_is_flattened_on_white(source):
+    image = Image.new("RGBA", (600, 600), (0, 0, 0, 0))
+    image.paste((0, 0, 255, 255), (200, 200, 400, 400))
+    source["image"] = encoded(image, "PNG")
+    thumbnail = Image.open(io.BytesIO(make_thumbnail("https://images.example/B2.png", size=100)))
+
+    assert thumbnail.mode == "RGB" and thumbnail.size == (100, 100)
+    assert all(channel > 245 for channel in thumbnail.getpixel((2, 2)))
+    red, green, blue = thumbnail.getpixel((50, 50))
+    assert blue > 200 and red < 40 and green < 40
+
+
+def test_small_image_is_not_enlarged(source):
+    source["image"] = encoded(Image.new("RGB", (120, 80), (10, 120, 10)), "JPEG")
+    thumbnail = Image.open(io.BytesIO(make_thumbnail("https://images.example/B3.jpg", size=280)))
+    assert thumbnail.size == (120, 80)
+
+
+def test_source_over_the_size_limit_is_refused(source, monkeypatch):
+    monkeypatch.setattr(config, "thumbnail_max_source_bytes", 1000)
+    source["image"] = b"\x89PNG" + b"\0" * 5000
+    with pytest.raises(ValueError):
+        make_thumbnail("https://images.example/B4.png")
+
+
+def test_store_evicts_least_recently_read(tmp_path):
+    store = ThumbnailStore(str(tmp_path), max_bytes=3500, evict_every=1)
+    store.put("B1", b"x" * 1000)
+    store.put("B2", b"x" * 1000)
+    os.utime(tmp_path / "B1.img", (1, 1))
+    os.utime(tmp_path / "B2.img", (2, 2))
+    assert store.get("B1") is not None
+    store.put("B3", b"x" * 1000)
+    store.put("B4", b"x" * 1000)
+
+    assert store.get("B2") is None
+    assert store.get("B1") is not None and store.get("B4") is not None
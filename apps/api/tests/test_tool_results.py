@@ -0,0 +1,67 @@
+from array import array
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from server.agents import context_packing
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.tool_results import compact_history, product_store, short_title, store_products
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    monkeypatch.setattr(context_packing, "tiktoken", None)
+    product_store.tiers[0]._items.clear()
+
+
+def refs(*ids):
+    return [{"id": product_id, "title": f"Cable {product_id}", "rating": 4.5, "price": 9.99} for product_id in ids]
+
+
+def tool_result(call_id, *ids):
+    full = "\n".join(f"Product ID: {product_id} - a long packed description of several sentences" for product_id in ids)
+    return ToolMessage(content=full, tool_call_id=call_id, artifact=refs(*ids))
+
+
+def call(call_id):
+    return AIMessage(content="", tool_calls=[{"name": "retrieve_embedding", "args": {"query": "cable"},
+                                              "id": call_id, "type": "tool_call"}])
+
+
+def test_seen_tool_results_are_compacted_and_fresh_ones_kept():
+    old, fresh_a, fresh_b = tool_result("c1", "B1", "B2"), tool_result("c2", "B3"), tool_result("c3", "B4")
+    history = [HumanMessage(content="usb c cable"), call("c1"), old, AIMessage(content="Here are two."),
+               HumanMessage(content="and hdmi?"), call("c2"), fresh_a, fresh_b]
+
+    compacted = compact_history(history)
+
+    assert compacted[2].content == ("Product ID: B1 - Description: Cable B1 - Rating: 4.5\n"
+                                    "Product ID: B2 - Description: Cable B2 - Rating: 4.5")
+    assert compacted[2].tool_call_id == "c1"
+    # the results this iteration answers go out in full
+    assert compacted[6:] == [fresh_a, fresh_b]
+    assert [m.content for m in compacted[3:6]] == [m.content for m in history[3:6]]
+    # the state's messages are not changed
+    assert old.content.startswith("Product ID: B1 - a long")
+
+
+def test_results_without_artifact_are_left_as_they_are():
+    legacy = ToolMessage(content="Product ID: B1 - full text", tool_call_id="c1")
+    history = [HumanMessage(content="usb c cable"), call("c1"), legacy, AIMessage(content="Here.")]
+    assert compact_history(history) == history
+
+
+def test_store_products_keeps_payloads_out_of_the_references():
+    result = RetrievalResult(["B1"], ["Anker USB-C cable, 6ft. Braided nylon. Supports 100W charging."], [4.6],
+                             [12.5], ["https://images.example/B1.jpg"], array("d", [0.9]))
+
+    assert store_products(result) == [{"id": "B1", "title": "Anker USB-C cable, 6ft", "rating": 4.6, "price": 12.5}]
+    assert product_store.get("B1") == {"parent_asin": "B1", "description": result.context[0], "average_rating": 4.6,
+                                       "image": "https://images.example/B1.jpg", "price": 12.5}
+
+
+def test_short_title_is_the_first_sentence_cut_on_a_word():
+    assert short_title("Anker cable. Braided.", max_tokens=16) == "Anker cable"
+    title = short_title("Anker Nano USB-C to USB-C braided charging cable for phones and laptops", max_tokens=8)
+    assert title == "Anker Nano USB-C to USB-C"
+    assert context_packing.count_tokens(title) <= 8
@@ -0,0 +1,83 @@
+from array import array
+from unittest import mock
+
+import pytest
+from langsmith.run_helpers import get_tracing_context
+
+from server.agents.models import RAGUsedContext
+from server.agents.retrieval_result import RetrievalResult
+from server.agents.utils import tracing
+from server.agents.utils.tracing import cap_payload, request_tracing, sample_rate
+from server.core.config import config
+from server.core.metrics import metrics
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(config, "trace_max_string_chars", 10)
+    monkeypatch.setattr(config, "trace_max_list_items", 3)
+    monkeypatch.setattr(config, "trace_redact_min_chars", 20)
+
+
+@pytest.mark.parametrize("route, priority, rate", [
+    ("/product_assistant/", "interactive", 1.0),
+    ("/product_assistant/batch", "background", 0.05),
+    ("/metrics", "interactive", 0.0),
+    ("/ready/", "eval", 0.0),
+    ("/product_assistant/", "unknown", 1.0),
+])
+def test_sample_rate(route, priority, rate):
+    assert sample_rate(route, priority) == rate
+
+
+@pytest.mark.parametrize("draw, sampled", [(0.01, True), (0.5, False)])
+def test_request_is_sampled_once_on_arrival(monkeypatch, draw, sampled):
+    monkeypatch.setattr(tracing, "tracing_is_enabled", lambda: True)
+    monkeypatch.setattr(tracing.random, "random", lambda: draw)
+    client = mock.Mock()
+    before = metrics.get("requests_traced_total", sampled=str(sampled).lower(), priority="background")
+
+    with request_tracing("/product_assistant/batch", "background", client=client) as traced:
+        context = get_tracing_context()
+        assert traced is sampled
+        if sampled:
+            # every span of the request goes through the capped client
+            assert context["client"] is client and context["enabled"] is None
+        else:
+            # an unsampled request creates no run trees at all
+            assert context["enabled"] is False
+    assert metrics.get("requests_traced_total", sampled=str(sampled).lower(), priority="background") == before + 1
+
+
+def test_nothing_is_sampled_with_tracing_off():
+    with request_tracing("/product_assistant/", "interactive") as traced:
+        assert traced is False
+
+
+def test_long_strings_and_lists_are_cut(limits):
+    capped = cap_payload({"answer": "x" * 25, "ids": list(range(5))})
+    assert capped["answer"] == "x" * 10 + "... <15 more chars>"
+    assert capped["ids"] == [0, 1, 2, "<2 more items>"]
+
+
+def test_context_keys_are_sent_as_their_size(limits):
+    capped = cap_payload({"question": "usb cable", "retrieved_context": ["a" * 15, "b" * 15],
+                          "context": "short"})
+    assert capped["retrieved_context"] == "<redacted: 30 chars>"
+    # under the redaction threshold a context key is only capped
+    assert capped["context"] == "short"
+    assert capped["question"] == "usb cable"
+
+
+def test_retrieval_results_and_models_are_reduced(limits):
+    result = RetrievalResult([f"B{i}" for i in range(5)], ["d"] * 5, [None] * 5, [None] * 5, [None] * 5,
+                             array("d", [0.5] * 5))
+    assert cap_payload({"products": result}) == {"products": {"products": 5, "ids": ["B0", "B1", "B2"]}}
+    assert cap_payload(RAGUsedContext(id="B1", description="A long description")) == {
+        "id": "B1", "description": "A long des... <8 more chars>"}
+
+
+def test_deep_payloads_stop_at_the_depth_limit():
+    nested = {"a": {"b": {"c": {"d": {"e": {"f": {"g": "deep"}}}}}}}
+    capped = cap_payload(nested)
+    assert capped["a"]["b"]["c"]["d"]["e"]["f"] == "<dict>"
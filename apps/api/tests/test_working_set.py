@@ -0,0 +1,80 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from server.agents import tools
+from server.agents.models import WorkingSet
+from server.agents.tool_results import product_store
+from server.agents.working_set import fresh_tool_refs, search_working_set, update_working_set
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    product_store.tiers[0]._items.clear()
+
+
+def ref(product_id, price=None, rating=None):
+    return {"id": product_id, "title": f"Product {product_id}", "rating": rating, "price": price}
+
+
+def working_set():
+    return WorkingSet(
+        ids=["B1", "B2", "B3", "B4"],
+        descriptions=["Anker USB-C cable, braided", "Sony bluetooth headphones", "JBL bluetooth speaker, waterproof",
+                      "Belkin HDMI cable"],
+        prices=[12.0, 199.0, None, 15.0],
+        ratings=[4.6, 4.4, 4.7, None],
+        images=[None] * 4,
+    )
+
+
+def test_new_products_go_first_with_their_stored_payload():
+    product_store.set("B9", {"parent_asin": "B9", "description": "Ugreen 65W charger", "price": 35.0,
+                             "average_rating": 4.5, "image": "https://images.example/B9.jpg"})
+    updated = update_working_set(working_set(), [ref("B9"), ref("B8", price=5.0, rating=3.9)], max_items=10)
+
+    assert updated.ids == ["B9", "B8", "B1", "B2", "B3", "B4"]
+    assert (updated.descriptions[0], updated.prices[0], updated.images[0]) == (
+        "Ugreen 65W charger", 35.0, "https://images.example/B9.jpg")
+    # evicted from the store: what the reference carries
+    assert (updated.descriptions[1], updated.prices[1], updated.ratings[1]) == ("Product B8", 5.0, 3.9)
+
+
+def test_products_read_again_move_to_the_front_and_the_oldest_are_dropped():
+    updated = update_working_set(working_set(), [ref("B3"), ref("B7"), ref("B3")], max_items=4)
+    assert updated.ids == ["B3", "B7", "B1", "B2"]
+    assert updated.descriptions[0] == "JBL bluetooth speaker, waterproof"
+
+
+def test_fresh_refs_are_the_trailing_tool_results():
+    old = ToolMessage(content="", tool_call_id="c1", artifact=[ref("B1")])
+    messages = [HumanMessage(content="cables"), old, AIMessage(content="Here."),
+                ToolMessage(content="", tool_call_id="c2", artifact=[ref("B2")]),
+                ToolMessage(content="", tool_call_id="c3", artifact=[ref("B3"), ref("B4")])]
+    assert [r["id"] for r in fresh_tool_refs(messages)] == ["B2", "B3", "B4"]
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ({}, ["B1", "B2", "B3", "B4"]),
+    ({"query": "bluetooth"}, ["B2", "B3"]),
+    ({"query": "bluetooth speaker"}, ["B3", "B2"]),
+    ({"sort_by": "price"}, ["B1", "B4", "B2", "B3"]),
+    ({"sort_by": "rating", "descending": True}, ["B3", "B1", "B2", "B4"]),
+    ({"max_price": 20}, ["B1", "B4"]),
+    ({"min_rating": 4.5}, ["B1", "B3"]),
+    ({"product_ids": ["B4", "B2"], "sort_by": "price"}, ["B4", "B2"]),
+    ({"query": "cable", "limit": 1}, ["B1"]),
+    ({"query": "toaster"}, []),
+])
+def test_search_working_set(filters, expected):
+    current = working_set()
+    assert [current.ids[i] for i in search_working_set(current, **filters)] == expected
+
+
+def test_tool_answers_from_the_state_without_a_search():
+    text, refs = tools._search_working_set(working_set(), query="bluetooth", sort_by="price")
+    assert text.splitlines()[0] == ("Product ID: B2 - Description: Sony bluetooth headphones - Rating: 4.4"
+                                    " - Price: 199.0")
+    assert [r["id"] for r in refs] == ["B2", "B3"]
+
+    text, refs = tools._search_working_set(working_set(), query="toaster")
+    assert refs == [] and "retrieve_embedding" in text
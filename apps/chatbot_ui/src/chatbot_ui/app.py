@@ -1,9 +1,12 @@
 import streamlit as st
 import html
+import json
 import uuid
 
 from chatbot_ui.core.config import config
-import requests  
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 st.set_page_config(page_title="Amazon Product Assistant", layout="wide")
 
@@ -41,27 +44,65 @@ st.caption("Ask about items in our inventory and see the products used.")
 st.divider()
 
 
-def api_call(method, url, **kwargs):
-    
+# progress shown while the agent works, by LangGraph node
+STEP_LABELS = {
+    "router": "Checking the question",
+    "query_rewriter": "Rewriting the query",
+    "agent_node": "Thinking",
+    "tools": "Searching products",
+}
+
+
+@st.cache_resource
+def get_session():
+    """One keep-alive connection pool to the API, shared by every browser session and rerun."""
+    session = requests.Session()
+    # only failed connects are retried, a request the API may have started is never sent twice
+    retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.API_POOL_SIZE, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def stream_api_call(url, on_step, **kwargs):
+    """
+    POSTs to a streaming endpoint and reads its NDJSON events as they arrive, calling
+    `on_step` for each progress event. Returns (ok, answer or error data).
+    """
+
     def _show_error_popup(message):
         """Show an error popup with the given message"""
         st.session_state["error_popup"] = {"visible": True,
          "message": message,
         }
-    
+
     try:
-        response = getattr(requests, method)(url, **kwargs)
-        
-        try:
-            response_data = response.json()
-        except requests.exceptions.JSONDecodeError:
-            response_data = {"message": "Invalid JSON formt response"}
-        
-        if response.status_code == 200:
-            return True, response_data
-        
-        return False, response_data
-    
+        with get_session().post(url, stream=True, timeout=(config.API_CONNECT_TIMEOUT, config.API_READ_TIMEOUT),
+                                **kwargs) as response:
+            if response.status_code != 200:
+                try:
+                    return False, {"message": response.json().get("detail", "Request failed.")}
+                except requests.exceptions.JSONDecodeError:
+                    return False, {"message": "Invalid JSON formt response"}
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                    kind = event["event"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # a partial or malformed line, the stream broke off
+                    break
+                if kind == "step":
+                    on_step(event.get("node"))
+                elif kind == "answer":
+                    return True, event
+                elif kind == "error":
+                    return False, {"message": event.get("detail", "Request failed.")}
+            return False, {"message": "The answer was cut off, please try again."}
+
     except requests.exceptions.ConnectionError as e:
         _show_error_popup("Connection Error. Please check your internet connection and try again.")
         return False, {"message": f"Connection Error. {str(e)}"}
@@ -99,37 +140,53 @@ def render_used_context(context_items, container):
         )
 
 
+def render_messages(messages):
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+
+@st.fragment
+def render_earlier_messages(messages):
+    """Older turns, drawn only while shown; toggling them reruns this fragment, not the app."""
+    if st.toggle(f"Show {len(messages)} earlier messages", key="show_earlier"):
+        render_messages(messages)
+
+
 if "thread_id" not in st.session_state:
     st.session_state.thread_id = str(uuid.uuid4())
 if "messages" not in st.session_state:
     st.session_state.messages = [{"role": "assistant", "content": "Hello, how can I help you on Amazon Products?"}]
 if "latest_context" not in st.session_state:
     st.session_state.latest_context = []
-    
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+
+# each run draws at most HISTORY_WINDOW messages, however long the conversation gets
+earlier = len(st.session_state.messages) - config.HISTORY_WINDOW
+if earlier > 0:
+    render_earlier_messages(st.session_state.messages[:earlier])
+render_messages(st.session_state.messages[max(earlier, 0):])
 
 if prompt := st.chat_input("Hello, how can I help you on Amazon Products?"):
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.markdown(prompt)
-    
+
     with st.chat_message("assistant"):
-        output = api_call(
-            "post",
-            f"{config.API_URL}",
-            json={"query": prompt, "thread_id": st.session_state.thread_id},
-        )
+        with st.status("Working on it...") as status:
+            output = stream_api_call(
+                f"{config.API_URL}/stream",
+                on_step=lambda node: status.update(label=STEP_LABELS.get(node, "Working on it...")),
+                json={"query": prompt, "thread_id": st.session_state.thread_id},
+            )
+            status.update(label="Done" if output[0] else "Failed", state="complete" if output[0] else "error")
         if output[0]:
             answer = output[1].get("answer", "")
-            used_context = output[1].get("used_context", [])
-            st.write(answer)
-            st.session_state.latest_context = used_context
+            st.markdown(answer)
+            st.session_state.latest_context = output[1].get("used_context", [])
             st.session_state.messages.append(
                 {"role": "assistant", "content": answer}
             )
-            st.rerun()
+            # no st.rerun(): the new turn is already drawn and the sidebar below renders the new context
         else:
             st.write(output[1].get("message", "Request failed."))
 
@@ -4,5 +4,14 @@ class Config(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env")
 
     API_URL: str = "http://api:8000/product_assistant"
-    
+
+    # keep-alive connections to the API shared by every browser session, and the seconds to
+    # connect / to wait between two streamed events
+    API_POOL_SIZE: int = 10
+    API_CONNECT_TIMEOUT: float = 3.05
+    API_READ_TIMEOUT: float = 120.0
+
+    # messages drawn on every run, earlier ones only when the user opens them
+    HISTORY_WINDOW: int = 20
+
 config = Config()